@@ -43,6 +43,13 @@ function hier = niak_hierarchical_clustering(S,opt)
 %       FLAG_VERBOSE
 %           (boolean, default 1) print an advancement information
 %
+%       BACKEND
+%           (string, default the NIAK_HIERARCHY_BACKEND environment variable
+%           if set, 'octave' otherwise) 'octave' or 'python'. The python
+%           backend (niak_cmd.py hierarchy, the command can be set with the
+%           NIAK_CMD environment variable) works on the vectorized matrix in
+%           O(N^2), see COMMENTS below.
+%
 % _________________________________________________________________________
 % OUTPUTS:
 %
@@ -85,6 +92,10 @@ function hier = niak_hierarchical_clustering(S,opt)
 %
 % If symmetric, the matrix can be "vectorized" using NIAK_VEC2MAT.
 %
+% The python backend uses the nearest-neighbour chain (complete, average and
+% Ward linkage) or a maximum spanning tree (single linkage), and never builds
+% the square matrix if S is vectorized. The hierarchy is the same up to ties.
+%
 % Copyright (c) Pierre Bellec, 
 % Centre de recherche de l'institut de Gériatrie de Montréal
 % Département d'informatique et de recherche opérationnelle
@@ -112,16 +123,30 @@ function hier = niak_hierarchical_clustering(S,opt)
 % THE SOFTWARE.
 
 if size(S,2) == 1
-    S = niak_vec2mat(S);
+    N = round((1+sqrt(1+8*length(S)))/2);
+else
+    N = size(S,1);
 end
-N = size(S,1);
 
 %% Options
+backend = getenv('NIAK_HIERARCHY_BACKEND');
+if isempty(backend)
+    backend = 'octave';
+end
 gb_name_structure = 'opt';
-gb_list_fields    = {'p'         , 'type_sim' , 'flag_verbose' , 'nb_classes' };
-gb_list_defaults  = {ones([N,1]) , 'ward'     , true           , 1            };
+gb_list_fields    = {'p'         , 'type_sim' , 'flag_verbose' , 'nb_classes' , 'backend' };
+gb_list_defaults  = {ones([N,1]) , 'ward'     , true           , 1            , backend   };
 niak_set_defaults
 
+if strcmp(backend,'python')
+    hier = sub_python_backend(S,p,type_sim,nb_classes,flag_verbose);
+    return
+end
+
+if size(S,2) == 1
+    S = niak_vec2mat(S);
+end
+
 perc_verb = 0.05;
 list_objects = 1:N;             % Initialization of the object list
 S(eye(size(S))==1) = -Inf; 
@@ -218,3 +243,30 @@ if flag_verbose
 end
 
         
+
+%% SUBFUNCTIONS
+%__________________________________________________________________________
+function hier = sub_python_backend(S,p,type_sim,nb_classes,flag_verbose)
+
+file_in = niak_file_tmp('_sim.mat');
+file_out = niak_file_tmp('_hier.mat');
+if exist('OCTAVE_VERSION','builtin')
+    save('-mat7-binary',file_in,'S','p');
+else
+    save(file_in,'S','p','-v7');
+end
+niak_cmd = getenv('NIAK_CMD');
+if isempty(niak_cmd)
+    niak_cmd = 'niak_cmd.py';
+end
+if flag_verbose
+    fprintf('     Hierarchical clustering with the python backend\n');
+end
+[status,msg] = system(sprintf('%s hierarchy %s %s --type_sim %s --nb_classes %i',niak_cmd,file_in,file_out,type_sim,nb_classes));
+delete(file_in);
+if status ~= 0
+    error('The python backend of the hierarchical clustering failed:\n%s',msg);
+end
+data = load(file_out);
+delete(file_out);
+hier = data.hier;
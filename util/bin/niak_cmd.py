@@ -6,13 +6,19 @@ __author__ = 'poquirion'
 
 
 import argparse
+import collections
+import json
 import os
 import re
 import sys
 import logging
 
 sys.path.append("{}/..".format(os.path.dirname(os.path.realpath(__file__))))
+import pyniak.job_index
 import pyniak.load_pipeline
+import pyniak.manifest
+import pyniak.metrics
+import pyniak.octave_path
 
 OPTION_PREFIX = "--opt"
 ESCAPE_STRING = "666_____666_____666"
@@ -45,6 +51,328 @@ def build_opt(option):
     return opt_dico
 
 
+def set_log_level():
+    try:
+        log_level = os.getenv("NIAK_LOG_LEVEL")
+        logging.basicConfig(level=log_level, format=('%(lineno)s - %(name)s - %(levelname)s - %(message)s'))
+    except ValueError:  # Unknown level
+        logging.basicConfig(level=logging.INFO, format=('%(lineno)s - %(name)s - %(levelname)s - %(message)s'))
+
+
+def manifest_main(args):
+    """
+    Run all the variants of a manifest file, see pyniak.manifest
+    """
+    parser = argparse.ArgumentParser(description='Run a niak manifest of option sets')
+    parser.add_argument("manifest", help="A json file listing the option sets")
+    parser.add_argument("--dry_run", action="store_true", default=False,
+                        help="Validate the manifest and print the run plan")
+    parsed = parser.parse_args(args)
+
+    set_log_level()
+
+    manifest = pyniak.manifest.Manifest(parsed.manifest)
+    failed = manifest.run(dry_run=parsed.dry_run)
+    if parsed.dry_run:
+        print(manifest.describe())
+    if failed:
+        logging.error("Failed variants: {0}".format(", ".join(failed)))
+        sys.exit(1)
+
+
+def path_main(args):
+    """
+    Build the octave path file, see pyniak.octave_path
+    """
+    parser = argparse.ArgumentParser(description='Build the flat niak octave path file')
+    parser.add_argument("--path_file", default="{0}/{1}".format(pyniak.load_pipeline.LOCAL_CONFIG_PATH,
+                                                                pyniak.octave_path.PATH_FILE))
+    parser.add_argument("--niak_root", default=pyniak.octave_path.NIAK_ROOT)
+    parser.add_argument("--exclude", nargs="*", default=pyniak.octave_path.EXCLUDED_DIRS,
+                        help="Directory names left out of the path")
+    parser.add_argument("--force", action="store_true", default=False,
+                        help="Rewrite the file even if it is up to date")
+    parser.add_argument("--benchmark", type=int, default=0,
+                        help="Time that many octave startups with genpath and with the path file")
+    parsed = parser.parse_args(args)
+
+    set_log_level()
+
+    pyniak.octave_path.setup(parsed.path_file, root=parsed.niak_root, excluded=parsed.exclude,
+                             force=parsed.force)
+
+    if parsed.benchmark:
+        times = pyniak.octave_path.benchmark(parsed.path_file, root=parsed.niak_root, n_rep=parsed.benchmark)
+        for k in ["bare", "genpath", "path_file"]:
+            print("{0:>10}: {1:.3f} s".format(k, times[k]))
+
+
+def confounds_main(args):
+    """
+    Build and regress confounds with the python backend, see pyniak.confounds
+    """
+    parser = argparse.ArgumentParser(description='Confound estimation and regression of many runs')
+    parser.add_argument("jobs", help=(
+        'A json file {"build_confounds": [...], "regress_confounds": [...]}, each job being '
+        '{"files_in": ..., "files_out": ..., "opt": ...} as for the niak bricks'))
+    parser.add_argument("--n_workers", type=int, default=1)
+    parser.add_argument("--batch_size", type=int, default=8, help="Runs regressed together")
+    parser.add_argument("--block_mb", type=int, default=256, help="Memory used by a block of voxels")
+    parsed = parser.parse_args(args)
+
+    set_log_level()
+
+    # Imported here, numpy is only needed by the python backends
+    import pyniak.confounds
+
+    with open(parsed.jobs) as fp:
+        jobs = json.load(fp)
+
+    def job_list(brick):
+        return [(j["files_in"], j.get("files_out", {}), j.get("opt", {})) for j in jobs.get(brick, [])]
+
+    pyniak.confounds.run(job_list("build_confounds"), job_list("regress_confounds"),
+                         n_workers=parsed.n_workers, batch_size=parsed.batch_size,
+                         block_bytes=parsed.block_mb * 1024 ** 2)
+
+
+def region_growing_main(args):
+    """
+    Run the region growing stage of BASC with the python backend, see pyniak.region_growing
+    """
+    parser = argparse.ArgumentParser(description='Region growing on many areas at once')
+    parser.add_argument("job", help=(
+        'A json file {"files_in": {"fmri": ..., "areas": ..., "mask": ...}, "opt": {"folder_out": ..., ...}} '
+        'as for niak_pipeline_region_growing. The resulting rois/brain_rois can be given to '
+        'niak_pipeline_stability_rest as files_in.atoms'))
+    parser.add_argument("--n_workers", type=int, default=1)
+    parser.add_argument("--cache_dir", default=None, help="Where neighbourhood graphs are cached")
+    parsed = parser.parse_args(args)
+
+    set_log_level()
+
+    # Imported here, numpy is only needed by the python backends
+    import pyniak.region_growing
+
+    with open(parsed.job) as fp:
+        job = json.load(fp)
+
+    print(pyniak.region_growing.run(job["files_in"], job.get("opt", {}), n_workers=parsed.n_workers,
+                                    cache_dir=parsed.cache_dir))
+
+
+def subtype_main(args):
+    """
+    Run the subtype pipeline with the python backend, see pyniak.subtype
+    """
+    parser = argparse.ArgumentParser(description='Subtypes of a large collection of brain maps')
+    parser.add_argument("job", help=(
+        'A json file {"files_in": {"data": {network: {subject: ...}}, "mask": ..., "model": ...}, '
+        '"opt": {"folder_out": ..., "stack": ..., "subtype": ...}} as for niak_pipeline_subtype'))
+    parser.add_argument("--n_workers", type=int, default=1)
+    parsed = parser.parse_args(args)
+
+    set_log_level()
+
+    # Imported here, numpy is only needed by the python backends
+    import pyniak.subtype
+
+    # Subjects and networks are kept in the order of the job file
+    with open(parsed.job) as fp:
+        job = json.load(fp, object_pairs_hook=collections.OrderedDict)
+
+    print(pyniak.subtype.run(job["files_in"], job.get("opt", {}), n_workers=parsed.n_workers))
+
+
+def cmp_files_main(args):
+    """
+    Compare the outputs of two runs, see pyniak.cmp_files
+    """
+    parser = argparse.ArgumentParser(description='Compare reference and new outputs, like niak_test_cmp_files')
+    parser.add_argument("base_source", help="The reference outputs")
+    parser.add_argument("base_target", help="The outputs to check")
+    parser.add_argument("report", help="The csv report, a json report is written next to it")
+    parser.add_argument("--atol", type=float, default=1e-4, help="Absolute tolerance on numbers")
+    parser.add_argument("--rtol", type=float, default=0., help="Relative tolerance on numbers")
+    parser.add_argument("--black_list_source", nargs="*", default=[])
+    parser.add_argument("--black_list_target", nargs="*", default=[])
+    parser.add_argument("--flag_source_only", action="store_true", help=(
+        "Only compare the variables of the source .mat files"))
+    parser.add_argument("--flag_ignore_format", action="store_true", help=(
+        "Compare imaging data regardless of their extension"))
+    parser.add_argument("--n_workers", type=int, default=1)
+    parsed = parser.parse_args(args)
+
+    set_log_level()
+
+    # Imported here, numpy is only needed by the python backends
+    import pyniak.cmp_files
+
+    opt = {"base_source": parsed.base_source, "base_target": parsed.base_target, "atol": parsed.atol,
+           "rtol": parsed.rtol, "black_list_source": parsed.black_list_source,
+           "black_list_target": parsed.black_list_target, "flag_source_only": parsed.flag_source_only,
+           "flag_ignore_format": parsed.flag_ignore_format}
+    summary = pyniak.cmp_files.cmp_files({}, parsed.report, opt, n_workers=parsed.n_workers)["summary"]
+    print(json.dumps(summary, sort_keys=True))
+
+    if summary.get("different"):
+        sys.exit("Some files are different in SOURCE and TARGET. See {0} for more details.".format(parsed.report))
+    if summary.get("unsupported"):
+        sys.exit("Some files have different bytes in SOURCE and TARGET and could not be compared numerically. "
+                 "See {0} for more details.".format(parsed.report))
+    if summary.get("missing_source") or summary.get("missing_target"):
+        logging.warning("All files in common were identical, but some files were unique to either SOURCE or "
+                        "TARGET. See {0} for more details.".format(parsed.report))
+
+
+def stability_main(args):
+    """
+    Run a stability brick with the k-means backend, see pyniak.kmeans
+    """
+    parser = argparse.ArgumentParser(description='Stability of k-means and k-means cores clusterings')
+    parser.add_argument("job", help=(
+        'A json file {"files_in": ..., "files_out": ..., "opt": ...} as for niak_brick_stability_surf '
+        '(clustering type kcores) or niak_brick_stability_surf_tseries'))
+    parser.add_argument("--brick", choices=["surf", "surf_tseries"], default="surf")
+    parser.add_argument("--n_workers", type=int, default=1)
+    parsed = parser.parse_args(args)
+
+    set_log_level()
+
+    # Imported here, numpy is only needed by the python backends
+    import pyniak.kmeans
+
+    with open(parsed.job) as fp:
+        job = json.load(fp)
+
+    brick = {"surf": pyniak.kmeans.brick_stability_surf,
+             "surf_tseries": pyniak.kmeans.brick_stability_surf_tseries}[parsed.brick]
+    print(brick(job["files_in"], job["files_out"], job.get("opt", {}), n_workers=parsed.n_workers))
+
+
+def fir_main(args):
+    """
+    Run a FIR brick with the python backend, see pyniak.fir
+    """
+    parser = argparse.ArgumentParser(description='Estimation and stability of finite impulse responses')
+    parser.add_argument("job", help=(
+        'A json file {"files_in": ..., "files_out": ..., "opt": ...} as for niak_brick_fir_tseries '
+        'or niak_brick_stability_fir'))
+    parser.add_argument("--brick", choices=["fir_tseries", "stability_fir"], default="fir_tseries")
+    parser.add_argument("--n_workers", type=int, default=1, help="Used by stability_fir")
+    parsed = parser.parse_args(args)
+
+    set_log_level()
+
+    # Imported here, numpy is only needed by the python backends
+    import pyniak.fir
+
+    with open(parsed.job) as fp:
+        job = json.load(fp)
+
+    if parsed.brick == "fir_tseries":
+        print(pyniak.fir.brick_fir_tseries(job["files_in"], job["files_out"], job.get("opt", {})))
+    else:
+        print(pyniak.fir.brick_stability_fir(job["files_in"], job["files_out"], job.get("opt", {}),
+                                             n_workers=parsed.n_workers))
+
+
+def status_main(args):
+    """
+    Query the job index of a pipeline, see pyniak.job_index
+    """
+    parser = argparse.ArgumentParser(description='State of the jobs of a PSOM pipeline')
+    parser.add_argument("folder", help="The output folder of the pipeline, or its logs folder")
+    parser.add_argument("--status", choices=pyniak.job_index.STATUSES, default=None)
+    parser.add_argument("--stage", default=None, help="e.g. corsica")
+    parser.add_argument("--subject", default=None)
+    parser.add_argument("--subjects", action="store_true", help="Only list the subjects of the matching jobs")
+    parser.add_argument("--summary", choices=["stage", "subject"], default=None,
+                        help="Count the jobs in each state, by stage or subject")
+    parser.add_argument("--no_update", action="store_true", help="Do not scan the logs folder first")
+    parsed = parser.parse_args(args)
+
+    set_log_level()
+
+    path_logs = os.path.join(parsed.folder, "logs")
+    if not os.path.isdir(path_logs):
+        path_logs = parsed.folder
+    index = pyniak.job_index.JobIndex(path_logs)
+    if not parsed.no_update:
+        index.update()
+
+    if parsed.summary or not (parsed.status or parsed.stage or parsed.subject or parsed.subjects):
+        for group, counts in index.summary(parsed.summary or "stage").items():
+            print("{0}\t{1}".format(group, " ".join("{0}={1}".format(s, counts[s])
+                                                   for s in pyniak.job_index.STATUSES if s in counts)))
+    elif parsed.subjects:
+        for subject in index.subjects(parsed.status, parsed.stage):
+            print(subject)
+    else:
+        for job in index.jobs(parsed.status, parsed.stage, parsed.subject):
+            exit_info = (job["exit_info"] or "").splitlines()
+            print("\t".join([job["name"], job["status"], job["brick"] or "",
+                             exit_info[-1] if exit_info else ""]))
+
+
+def hierarchy_main(args):
+    """
+    Hierarchical clustering of a similarity matrix saved by octave, see
+    pyniak.hierarchy.hierarchical_clustering_vec
+    """
+    parser = argparse.ArgumentParser(description='Hierarchical clustering in O(N^2)')
+    parser.add_argument("file_in", help="A .mat file with S, the similarity matrix or its vector form, "
+                                        "and optionally p, the size of the objects")
+    parser.add_argument("file_out", help="The .mat file with hier, in the format of niak_hierarchical_clustering")
+    parser.add_argument("--type_sim", choices=["single", "complete", "average", "ward"], default="ward")
+    parser.add_argument("--nb_classes", type=int, default=1, help="Stop when that many clusters are left")
+    parsed = parser.parse_args(args)
+
+    set_log_level()
+
+    # Imported here, numpy is only needed by the python backends
+    import pyniak.hierarchy
+    import pyniak.volumes
+
+    variables = pyniak.volumes.load_mat(parsed.file_in)
+    sim = variables["S"]
+    if sim.ndim == 2 and min(sim.shape) > 1:
+        sim = pyniak.hierarchy.mat2vec(sim)
+    hier = pyniak.hierarchy.hierarchical_clustering_vec(sim, p=variables.get("p"), type_sim=parsed.type_sim)
+    pyniak.volumes.save_mat(parsed.file_out, {"hier": hier[:max(len(hier) + 1 - parsed.nb_classes, 0)]})
+    print(parsed.file_out)
+
+
+def filtering_main(args):
+    """
+    Smooth and filter runs with the python backend, see pyniak.filtering
+    """
+    parser = argparse.ArgumentParser(description='Spatial smoothing and temporal filtering of many runs')
+    parser.add_argument("jobs", help=(
+        'A json file {"smooth_vol": [...], "time_filter": [...]}, each job being '
+        '{"files_in": ..., "files_out": ..., "opt": ...} as for niak_brick_smooth_vol and '
+        'niak_brick_time_filter'))
+    parser.add_argument("--n_threads", type=int, default=1)
+    parser.add_argument("--block_mb", type=int, default=256, help="Memory used by the blocks of all threads")
+    parsed = parser.parse_args(args)
+
+    set_log_level()
+
+    # Imported here, numpy is only needed by the python backends
+    import pyniak.filtering
+
+    with open(parsed.jobs) as fp:
+        jobs = json.load(fp)
+
+    def job_list(brick):
+        return [(j["files_in"], j.get("files_out", {} if brick == "time_filter" else ""), j.get("opt", {}))
+                for j in jobs.get(brick, [])]
+
+    for files_out in pyniak.filtering.run(job_list("smooth_vol"), job_list("time_filter"),
+                                          block_bytes=parsed.block_mb * 1024 ** 2, n_threads=parsed.n_threads):
+        print(files_out)
+
+
 def main(args=None):
     # return
     if args is None:
@@ -52,6 +380,29 @@ def main(args=None):
 
     print('{0} {1}'.format(__file__, " ".join(args)))
 
+    if args and args[0] == "manifest":
+        return manifest_main(args[1:])
+    if args and args[0] == "path":
+        return path_main(args[1:])
+    if args and args[0] == "confounds":
+        return confounds_main(args[1:])
+    if args and args[0] == "region_growing":
+        return region_growing_main(args[1:])
+    if args and args[0] == "subtype":
+        return subtype_main(args[1:])
+    if args and args[0] == "cmp_files":
+        return cmp_files_main(args[1:])
+    if args and args[0] == "stability":
+        return stability_main(args[1:])
+    if args and args[0] == "fir":
+        return fir_main(args[1:])
+    if args and args[0] == "status":
+        return status_main(args[1:])
+    if args and args[0] == "hierarchy":
+        return hierarchy_main(args[1:])
+    if args and args[0] == "filtering":
+        return filtering_main(args[1:])
+
     parser = argparse.ArgumentParser(description='Run a niak script')
 
     # default options
@@ -76,6 +427,19 @@ def main(args=None):
 
     parser.add_argument("--subjects", default=None)
 
+    parser.add_argument("--metrics_port", type=int, default=pyniak.metrics.env_port(), help=(
+        'Serve live progress metrics of the pipeline on http://localhost:METRICS_PORT/metrics, '
+        'they are also written to FOLDER_OUT/logs/niak_metrics.prom. NIAK_METRICS_PORT by default'))
+
+    parser.add_argument("--restart_failed", action="store_true", help=(
+        'Only run again the jobs that failed in the previous run, as found in the job index '
+        'of FOLDER_OUT/logs: their PSOM status is reset before the pipeline starts'))
+
+    parser.add_argument("--hierarchy_backend", choices=pyniak.load_pipeline.BASC.HIERARCHY_BACKENDS,
+                        default="octave", help=(
+        'BASC only: run the hierarchical clustering in octave, or in python in O(N^2) '
+        '(see niak_cmd.py hierarchy) for thousands of regions'))
+
     parsed, unformated_options = parser.parse_known_args(args)
 
     pipeline_name = parsed.pipeline
@@ -88,22 +452,46 @@ def main(args=None):
     if not pyniak.load_pipeline.suported(pipeline_name):
         raise IOError("Pipeline {} not supported".format(pipeline_name))
 
-    if pipeline_name == "Niak_fmri_preprocess":
+    set_log_level()
 
-        try:
-            log_level = os.getenv("NIAK_LOG_LEVEL")
-            logging.basicConfig(level=log_level, format=('%(lineno)s - %(name)s - %(levelname)s - %(message)s'))
-        except ValueError:  # Unknown level
-            logging.basicConfig(level=logging.INFO, format=('%(lineno)s - %(name)s - %(levelname)s - %(message)s'))
+    restart = None
+    if parsed.restart_failed:
+        path_logs = os.path.join(parsed.folder_out, "logs") if parsed.folder_out else None
+        if path_logs is None:
+            logging.info("No --folder_out, nothing to restart")
+        elif not os.path.isdir(path_logs):
+            logging.info("No logs of a previous run in {0}, nothing to restart".format(path_logs))
+        else:
+            index = pyniak.job_index.JobIndex(path_logs)
+            index.update()
+            restart = index.failed_jobs()
+            if restart:
+                logging.info("Restarting {0} failed jobs".format(len(restart)))
+            else:
+                logging.info("No failed job in {0}, nothing to restart".format(path_logs))
+
+    if pipeline_name == "Niak_fmri_preprocess":
 
         pipeline = pyniak.load_pipeline.FmriPreprocess(folder_in=parsed.file_in,
                                                        folder_out=parsed.folder_out,
                                                        subjects=parsed.subjects,
                                                        options=options,
                                                        func_hint=parsed.func_hint,
-                                                       anat_hint=parsed.anat_hint)
+                                                       anat_hint=parsed.anat_hint,
+                                                       metrics_port=parsed.metrics_port,
+                                                       restart=restart)
+
+    elif pipeline_name in ["Niak_basc", "Niak_stability_rest"]:
+
+        pipeline = pyniak.load_pipeline.BASC(folder_in=parsed.file_in,
+                                             folder_out=parsed.folder_out,
+                                             subjects=parsed.subjects,
+                                             options=options,
+                                             metrics_port=parsed.metrics_port,
+                                             restart=restart,
+                                             hierarchy_backend=parsed.hierarchy_backend)
 
-    pipeline.run()
+    sys.exit(pipeline.run())
 
 
 
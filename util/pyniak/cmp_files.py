@@ -0,0 +1,343 @@
+"""
+Python version of niak_brick_cmp_files, to check the outputs of a NIAK
+image against reference outputs.
+
+Files are compared in two passes over a process pool. Files that have the
+same size in the source and the target are first hashed, identical bytes
+make identical files. The others are compared numerically within an
+absolute and a relative tolerance (see numpy.isclose): volumes by slabs of
+slices, .mat files variable by variable and csv/tsv files cell by cell.
+NIfTI volumes are memory mapped, MINC volumes are read as a whole.
+Files of other types that differ are reported as "unsupported", which
+niak_cmd.py cmp_files counts as a failure since their bytes differ.
+
+The report is the csv file of niak_brick_cmp_files, with one line per
+file, and a json file next to it that gives for each file its status and
+which part of the files differ.
+"""
+__author__ = 'poquirion'
+
+import csv
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+import pyniak.volumes as volumes
+from pyniak.common import defaults, run_pool
+
+DEFAULTS = {"base_source": None, "base_target": None, "black_list_source": [], "black_list_target": [],
+            "flag_source_only": False, "flag_ignore_format": False, "atol": 1e-4, "rtol": 0.}
+COLUMNS = ["source", "target", "identical", "same_labels", "same_variables", "same_header_info", "same_dim",
+           "dice_mask_brain", "max_diff", "min_diff", "mean_diff", "max_corr", "min_corr", "mean_corr"]
+VOLUME_EXT = volumes.NIFTI_EXT + volumes.MINC_EXT
+IMAGE_EXT = re.compile(r"(\.mnc|\.mnc\.gz|\.img|\.nii|\.nii\.gz)$")
+TABLE_EXT = [".csv", ".tsv", ".csv.gz", ".tsv.gz"]
+HASH_BYTES = 16 * 1024 ** 2
+
+
+def grab_folder(base, black_list=None):
+    """
+    Like niak_grab_folder
+    :param black_list: files or folders to ignore, relative to base or absolute
+    :return: the files found in base, relative to base
+    """
+    base = os.path.abspath(base)
+    black_list = set(os.path.normpath(os.path.join(base, b)) for b in (black_list or []))
+    files = []
+    for root, dirs, names in os.walk(base):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) not in black_list)
+        files.extend(os.path.relpath(os.path.join(root, n), base) for n in sorted(names)
+                     if os.path.join(root, n) not in black_list)
+    return files
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(HASH_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ext_of(path):
+    return volumes.fileparts(path)[2]
+
+
+def empty_row(is_source, is_target):
+    row = dict((c, np.nan) for c in COLUMNS)
+    row.update(source=float(is_source), target=float(is_target))
+    return row
+
+
+def close(x, y, atol, rtol):
+    """
+    :return: a boolean array, the values equal within tolerance, NaN equal to NaN
+    """
+    return np.isclose(x, y, rtol=rtol, atol=atol, equal_nan=True)
+
+
+def cmp_volumes(file_source, file_target, atol, rtol):
+    """
+    Compare two NIfTI or MINC volumes by slabs of slices. The "brain" masks are the
+    non zero voxels of each volume, differences and correlations are computed
+    in the intersection of the masks, as in niak_brick_cmp_files
+    :return: the row of the report, the list of differences
+    """
+    row = empty_row(True, True)
+    row["same_labels"] = row["same_variables"] = np.nan
+    with volumes.open_volume(file_source) as vol_s, volumes.open_volume(file_target) as vol_t:
+        diffs = []
+        same_header = vol_s.affine.shape == vol_t.affine.shape \
+            and np.allclose(vol_s.affine, vol_t.affine, atol=1e-6) \
+            and vol_s.zooms == vol_t.zooms \
+            and vol_s.units == vol_t.units \
+            and vol_s.header.get_data_dtype() == vol_t.header.get_data_dtype()
+        if not same_header:
+            diffs.append("header")
+        row["same_header_info"] = float(same_header)
+        if vol_s.shape != vol_t.shape:
+            row["same_dim"] = row["identical"] = 0.
+            return row, diffs + ["dim"]
+        row["same_dim"] = 1.
+
+        nb_t = vol_s.shape[3] if len(vol_s.shape) > 3 else 1
+        size_s = size_t = size_st = nb_out = nb_in = 0
+        max_diff, min_diff, sum_diff = 0., np.inf, 0.
+        corr = []
+        for z_slice in volumes.slabs(vol_s.shape, 8 * 4 * nb_t):
+            y_s = vol_s.block(z_slice).reshape(-1, nb_t)
+            y_t = vol_t.block(z_slice).reshape(-1, nb_t)
+            nb_out += (~close(y_s, y_t, atol, rtol)).sum()
+            mask_s = np.any(y_s != 0, axis=1)
+            mask_t = np.any(y_t != 0, axis=1)
+            mask = mask_s & mask_t
+            size_s += mask_s.sum()
+            size_t += mask_t.sum()
+            size_st += mask.sum()
+            if not mask.any():
+                continue
+            y_s, y_t = y_s[mask], y_t[mask]
+            diff = np.abs(y_s - y_t)
+            max_diff = max(max_diff, diff.max())
+            min_diff = min(min_diff, diff.min())
+            sum_diff += diff.sum()
+            nb_in += diff.size
+            if nb_t > 1:
+                y_s = y_s - y_s.mean(axis=1, keepdims=True)
+                y_t = y_t - y_t.mean(axis=1, keepdims=True)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    corr.append((y_s * y_t).sum(axis=1) / np.sqrt((y_s ** 2).sum(axis=1) * (y_t ** 2).sum(axis=1)))
+
+    row["dice_mask_brain"] = 2. * size_st / (size_s + size_t) if size_s + size_t else 1.
+    if nb_in:
+        row.update(max_diff=max_diff, min_diff=min_diff, mean_diff=sum_diff / nb_in)
+    else:
+        row.update(max_diff=0., min_diff=0., mean_diff=0.)
+    if corr:
+        corr = np.concatenate(corr)
+        row.update(max_corr=np.nanmax(corr), min_corr=np.nanmin(corr), mean_corr=np.nanmean(corr))
+    if nb_out:
+        diffs.append("{0} values out of tolerance".format(nb_out))
+    row["identical"] = float(same_header and not nb_out)
+    return row, diffs
+
+
+def read_table(path):
+    """
+    :return: the cells of a csv/tsv file (gzipped or not), quotes removed
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    separator = "\t" if ".tsv" in os.path.basename(path) else ","
+    with opener(path, "rt") as fp:
+        return [[c.strip().strip("'\"") for c in row] for row in csv.reader(fp, delimiter=separator) if row]
+
+
+def to_number(cell):
+    try:
+        return float(cell)
+    except ValueError:
+        return None
+
+
+def cmp_tables(file_source, file_target, atol, rtol):
+    """
+    Compare two spreadsheets: cells that are not numbers (the labels) have to
+    be identical, numbers have to be equal within tolerance
+    """
+    row = empty_row(True, True)
+    tab_s, tab_t = read_table(file_source), read_table(file_target)
+    if [len(r) for r in tab_s] != [len(r) for r in tab_t]:
+        row.update(same_dim=0., identical=0., same_labels=0.)
+        return row, ["dim"]
+    row["same_dim"] = 1.
+    cells_s = [to_number(c) for r in tab_s for c in r]
+    cells_t = [to_number(c) for r in tab_t for c in r]
+    text_s = [c for r in tab_s for c in r]
+    text_t = [c for r in tab_t for c in r]
+    is_num = np.array([s is not None and t is not None for s, t in zip(cells_s, cells_t)], dtype=bool)
+    same_labels = all(s == t for s, t, n in zip(text_s, text_t, is_num) if not n)
+    row["same_labels"] = float(same_labels)
+    diffs = [] if same_labels else ["labels"]
+    x_s = np.array([c for c, n in zip(cells_s, is_num) if n], dtype=np.float64)
+    x_t = np.array([c for c, n in zip(cells_t, is_num) if n], dtype=np.float64)
+    same_nan = np.array_equal(np.isnan(x_s), np.isnan(x_t))
+    nb_out = (~close(x_s, x_t, atol, rtol)).sum()
+    if nb_out:
+        diffs.append("{0} values out of tolerance".format(nb_out))
+    diff = np.abs(np.nan_to_num(x_s) - np.nan_to_num(x_t))
+    if diff.size:
+        row.update(max_diff=diff.max(), min_diff=diff.min(), mean_diff=diff.mean())
+    row["identical"] = float(same_labels and same_nan and not nb_out)
+    return row, diffs
+
+
+def cmp_var(var_s, var_t, atol, rtol, flag_source_only=False, name=""):
+    """
+    Like psom_cmp_var, with tolerances on numbers
+    :return: the list of the variables (or fields, or cells) that differ
+    """
+    var_s, var_t = np.asarray(var_s), np.asarray(var_t)
+    if var_s.dtype.names or var_t.dtype.names:
+        names_s, names_t = var_s.dtype.names or (), var_t.dtype.names or ()
+        missing = [n for n in names_s if n not in names_t]
+        if not flag_source_only:
+            missing += [n for n in names_t if n not in names_s]
+        if missing or var_s.shape != var_t.shape:
+            return [name or "."]
+        diffs = []
+        for index in np.ndindex(var_s.shape):
+            for field in names_s:
+                diffs += cmp_var(var_s[index][field], var_t[index][field], atol, rtol, flag_source_only,
+                                 "{0}.{1}".format(name, field))
+        return diffs
+    if var_s.shape != var_t.shape or (var_s.dtype.kind in "biufc") != (var_t.dtype.kind in "biufc"):
+        return [name or "."]
+    if var_s.dtype.kind == "O" or var_t.dtype.kind == "O":
+        return [d for index in np.ndindex(var_s.shape)
+                for d in cmp_var(var_s[index], var_t[index], atol, rtol, flag_source_only,
+                                 "{0}{{{1}}}".format(name, ",".join(str(i + 1) for i in index)))]
+    if var_s.dtype.kind in "biufc":
+        return [] if close(var_s, var_t, atol, rtol).all() else [name or "."]
+    return [] if np.array_equal(var_s, var_t) else [name or "."]
+
+
+def cmp_mat(file_source, file_target, atol, rtol, flag_source_only=False):
+    row = empty_row(True, True)
+    data_s, data_t = volumes.load_mat(file_source), volumes.load_mat(file_target)
+    missing = [v for v in data_s if v not in data_t]
+    if not flag_source_only:
+        missing += [v for v in data_t if v not in data_s]
+    row["same_variables"] = float(not missing)
+    diffs = ["missing variable " + v for v in missing]
+    for var in data_s:
+        if var in data_t:
+            diffs += cmp_var(data_s[var], data_t[var], atol, rtol, flag_source_only, var)
+    row["identical"] = float(not diffs)
+    return row, diffs
+
+
+def _compare(job):
+    file_source, file_target, opt = job
+    ext = ext_of(file_source)
+    try:
+        if ext in VOLUME_EXT and ext_of(file_target) in VOLUME_EXT:
+            return cmp_volumes(file_source, file_target, opt["atol"], opt["rtol"])
+        if ext in TABLE_EXT:
+            return cmp_tables(file_source, file_target, opt["atol"], opt["rtol"])
+        if ext == ".mat":
+            return cmp_mat(file_source, file_target, opt["atol"], opt["rtol"], opt["flag_source_only"])
+    except Exception as e:
+        row = empty_row(True, True)
+        row["identical"] = 0.
+        return row, ["error: {0}".format(e)]
+    return empty_row(True, True), ["unsupported"]
+
+
+def status_of(row, diffs):
+    if not row["source"]:
+        return "missing_source"
+    if not row["target"]:
+        return "missing_target"
+    if row["identical"] == 1:
+        return "identical"
+    if diffs == ["unsupported"]:
+        return "unsupported"
+    return "different"
+
+
+def write_report(path, files, rows):
+    """
+    Write the report as niak_write_csv would, one line per file
+    """
+    with open(path, "w") as fp:
+        fp.write(",".join([""] + COLUMNS) + "\n")
+        for name, row in zip(files, rows):
+            fp.write(",".join([name] + [volumes.format_csv_value(row[c]) for c in COLUMNS]) + "\n")
+
+
+def cmp_files(files_in, files_out, opt=None, n_workers=1):
+    """
+    Python version of niak_brick_cmp_files
+    :param files_in: {"source": [...], "target": [...]}, the files relative
+        to opt["base_source"] and opt["base_target"], all the files found in
+        the base folders if missing or empty
+    :param files_out: the csv report, the json report is written next to it
+    :param opt: base_source, base_target, black_list_source, black_list_target,
+        flag_source_only, flag_ignore_format, and the absolute (atol) and
+        relative (rtol) tolerances
+    :return: the json report, as a dictionary
+    """
+    log = logging.getLogger(__file__)
+    opt = defaults(opt, DEFAULTS)
+    if not opt["base_source"] or not opt["base_target"]:
+        raise ValueError("OPT.BASE_SOURCE and OPT.BASE_TARGET are mandatory")
+    files_in = files_in or {}
+    source = files_in.get("source") or grab_folder(opt["base_source"], opt["black_list_source"])
+    target = files_in.get("target") or grab_folder(opt["base_target"], opt["black_list_target"])
+
+    def key(name):
+        return IMAGE_EXT.sub(".*", name) if opt["flag_ignore_format"] else name
+    source = dict((key(f), os.path.join(opt["base_source"], f)) for f in source)
+    target = dict((key(f), os.path.join(opt["base_target"], f)) for f in target)
+    files = sorted(set(source) | set(target))
+    log.info("Found {0} unique files to compare, source {1}, target {2}"
+             .format(len(files), opt["base_source"], opt["base_target"]))
+
+    common = [f for f in files if f in source and f in target]
+    same_size = [f for f in common if os.path.getsize(source[f]) == os.path.getsize(target[f])]
+    paths = [source[f] for f in same_size] + [target[f] for f in same_size]
+    hashes = dict(zip(paths, run_pool(file_hash, paths, n_workers)))
+    to_compare = [f for f in common if f not in same_size or hashes[source[f]] != hashes[target[f]]]
+    log.info("{0} files have identical content, {1} files to compare numerically"
+             .format(len(common) - len(to_compare), len(to_compare)))
+    compared = dict(zip(to_compare, run_pool(_compare, [(source[f], target[f], opt) for f in to_compare],
+                                             n_workers)))
+
+    rows, report = [], {}
+    for name in files:
+        if name in compared:
+            row, diffs = compared[name]
+        elif name in source and name in target:
+            row, diffs = empty_row(True, True), []
+            row["identical"] = 1.
+        else:
+            row, diffs = empty_row(name in source, name in target), []
+        rows.append(row)
+        report[name] = {"status": status_of(row, diffs), "differences": diffs,
+                        "metrics": dict((c, None if np.isnan(v) else float(v)) for c, v in row.items())}
+
+    summary = {}
+    for entry in report.values():
+        summary[entry["status"]] = summary.get(entry["status"], 0) + 1
+    out = {"base_source": opt["base_source"], "base_target": opt["base_target"], "atol": opt["atol"],
+           "rtol": opt["rtol"], "summary": summary, "files": report}
+    write_report(files_out, files, rows)
+    folder, name, ext = volumes.fileparts(files_out)
+    with open(os.path.join(folder, name + ".json"), "w") as fp:
+        json.dump(out, fp, indent=2, sort_keys=True)
+    return out
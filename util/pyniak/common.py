@@ -0,0 +1,59 @@
+"""
+Helpers shared by the python backends of the NIAK bricks: options merged
+with their defaults as niak_set_defaults would, the tag of omitted outputs,
+the normalization of time series and a process pool whose workers share
+read-only arrays.
+"""
+__author__ = 'poquirion'
+
+from multiprocessing import Pool
+
+import numpy as np
+
+# The value of an output that is not generated, as in the octave bricks
+OMITTED = "gb_niak_omitted"
+# The arrays shared with the jobs of run_pool, in each worker
+SHARED = {}
+
+
+def defaults(opt, default):
+    """
+    Like psom_struct_defaults, without the check on unknown fields
+    """
+    out = dict(default)
+    out.update(opt or {})
+    return out
+
+
+def normalize(tseries, type_norm="mean_var", axis=0):
+    """
+    Like niak_normalize_tseries for 'mean' and 'mean_var', along axis
+    """
+    tseries = np.asarray(tseries, dtype=np.float64)
+    tseries_n = tseries - tseries.mean(axis=axis, keepdims=True)
+    if type_norm == "mean":
+        return tseries_n
+    nt = tseries.shape[axis]
+    std_ts = np.sqrt(np.sum(tseries_n ** 2, axis=axis, keepdims=True) / (nt - 1))
+    return np.divide(tseries_n, std_ts, out=tseries_n, where=std_ts != 0)
+
+
+def _init_worker(shared):
+    SHARED.update(shared)
+
+
+def run_pool(function, jobs, n_workers=1, shared=None):
+    """
+    Run function on each job over a process pool. The arrays of shared are
+    handed once to every worker, in SHARED, rather than with each job.
+    :return: the results, in the order of the jobs
+    """
+    if n_workers <= 1:
+        SHARED.update(shared or {})
+        return [function(job) for job in jobs]
+    pool = Pool(n_workers, initializer=_init_worker, initargs=(shared or {},))
+    try:
+        return pool.map(function, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,558 @@
+"""
+Python backend of the confound stages of fmri_preprocess, see
+niak_brick_build_confounds and niak_brick_regress_confounds.
+
+The fMRI run is never loaded as a whole. It is memory mapped and walked
+in slabs of slices, and every confound that needs the whole brain
+(white matter and ventricle averages, PCA of the global signal, COMPCOR)
+only needs sums and time x time cross-products, which are accumulated slab
+by slab. The regression of many runs of the same length is done together:
+the least-squares projection of each run is computed once from its
+confounds and applied to every slab with batched matrix products.
+
+Outputs follow the octave bricks. Principal components are only defined up
+to their sign, so the COMPCOR and motion components may have the opposite
+sign of the octave ones, which does not change the denoised data.
+"""
+__author__ = 'poquirion'
+
+import logging
+import math
+import os
+import warnings
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import pyniak.volumes as volumes
+from pyniak.common import OMITTED, defaults, normalize
+
+# A missing output is not generated, an empty one gets the default name
+BUILD_OUTPUTS = {"confounds": OMITTED, "compcor_mask": OMITTED}
+REGRESS_OUTPUTS = {"filtered_data": OMITTED, "scrubbing": OMITTED}
+BUILD_DEFAULTS = {"thre_fd": 0.5, "ww_fd": [3, 6], "nb_min_vol": 40, "compcor": {}, "folder_out": "",
+                  "flag_verbose": True}
+COMPCOR_DEFAULTS = {"nb_comp": 5, "perc": 0.02, "type": "a", "nb_samps": 100, "p": 0.05}
+REGRESS_DEFAULTS = {"flag_compcor": False, "nb_vol_min": 40, "flag_scrubbing": True, "thre_fd": 0.5,
+                    "flag_slow": True, "flag_high": False, "folder_out": "", "flag_verbose": True,
+                    "flag_motion_params": True, "flag_wm": True, "flag_vent": True, "flag_gsc": False,
+                    "flag_pca_motion": True, "pct_var_explained": 0.95}
+
+
+def octave_round(x):
+    return math.copysign(math.floor(abs(x) + 0.5), x)
+
+
+def transf2param(transf):
+    """
+    Rotation (degrees) and translation parameters of rigid-body
+    transformations, like niak_transf2param
+    :param transf: a 4x4xN array
+    :return: rot, tsl, two 3xN arrays
+    """
+    transf = np.asarray(transf, dtype=np.float64)
+    if transf.ndim == 2:
+        transf = transf[:, :, np.newaxis]
+    n = transf.shape[2]
+    rot = np.zeros((3, n))
+    tsl = np.zeros((3, n))
+    for num_n in range(n):
+        r_mat = transf[:3, :3, num_n]
+        d = octave_round(r_mat[2, 0] * 1e12) / 1e12
+        if d == 1:
+            y = math.atan2(r_mat[1, 1], r_mat[0, 1])
+            p = -math.pi / 2
+            r = -math.pi / 2
+        elif d == -1:
+            y = math.atan2(r_mat[1, 1], r_mat[0, 1])
+            p = math.pi / 2
+            r = math.pi / 2
+        else:
+            sg = np.cross([0., 0., 1.], r_mat[:, 0])
+            j2 = sg / np.sqrt(sg.dot(sg))
+            k2 = np.cross(r_mat[:, 0], j2)
+            r = math.atan2(k2.dot(r_mat[:, 1]), j2.dot(r_mat[:, 1]))
+            p = math.atan2(-r_mat[2, 0], k2[2])
+            y = math.atan2(-j2[0], j2[1])
+        y1, p1, r1 = [a + (1 - np.sign(a) - np.sign(a) ** 2) * math.pi for a in (y, p, r)]
+        if np.linalg.norm([y1, p1, r1]) < np.linalg.norm([y, p, r]):
+            rot[:, num_n] = [r1, -p1, y1]
+        else:
+            rot[:, num_n] = [r, p, y]
+        tsl[:, num_n] = transf[:3, 3, num_n]
+    return rot / math.pi * 180, tsl
+
+
+def frame_displacement(rot, tsl):
+    """
+    Frame displacement (Power et al. 2012), with a 0 for the last volume as
+    in niak_brick_build_confounds
+    """
+    rot_d = 50 * (rot / 360) * math.pi * 2
+    rot_d = np.diff(rot_d, axis=1)
+    tsl_d = np.diff(tsl, axis=1)
+    fd = np.sum(np.abs(rot_d) + np.abs(tsl_d), axis=0)
+    return np.append(fd, 0)
+
+
+def fd2mask(fd, time_frames=None, thre=0.5, ww=(1, 2), nb_min_vol=40):
+    """
+    Scrubbing mask from the frame displacement, like niak_fd2mask
+    """
+    fd = np.asarray(fd).ravel()
+    if time_frames is None:
+        time_frames = np.arange(1, len(fd) + 1)
+    time_frames = np.asarray(time_frames, dtype=np.float64).ravel()
+    mask = np.zeros(len(fd), dtype=bool)
+    for peak in np.flatnonzero(fd > thre):
+        mask_scrub = ((time_frames[peak] > time_frames) & (time_frames >= time_frames[peak] - ww[0])) \
+            | ((time_frames[peak] < time_frames) & (time_frames <= time_frames[peak] + ww[1]))
+        mask_scrub[peak] = True
+        if np.sum(~(mask | mask_scrub)) >= nb_min_vol:
+            mask |= mask_scrub
+        else:
+            warnings.warn("There was not enough time frames left after scrubbing, kept {0} time frames. "
+                          "See OPT.NB_VOL_MIN.".format(np.sum(~mask)))
+            break
+    return mask
+
+
+def gram_pca(gram, n_features):
+    """
+    niak_pca of a features x time array, from its time x time cross-product
+    :param gram: the time x time cross-product data'*data
+    :param n_features: the number of features (rows) of data
+    :return: eigen values and eigen vectors in descending order, cut at the
+        rank of data
+    """
+    eig_val, eig_vec = np.linalg.eigh(gram)
+    order = np.argsort(eig_val)[::-1]
+    eig_val = eig_val[order]
+    eig_vec = eig_vec[:, order]
+    sing = np.sqrt(np.clip(eig_val, 0, None))
+    tol = max(n_features, gram.shape[0]) * (sing[0] if len(sing) else 0) * np.finfo(np.float64).eps
+    rank = int(np.sum(sing > tol))
+    return eig_val[:rank], eig_vec[:, :rank]
+
+
+def compcor_slice_mask(std_slab, perc):
+    """
+    niak_compcor_mask with the 'slice' method, for a slab of whole slices
+    """
+    mask = np.zeros(std_slab.shape, dtype=bool)
+    for iz in range(std_slab.shape[2]):
+        val = np.sort(std_slab[:, :, iz].ravel())[::-1]
+        mask[:, :, iz] = std_slab[:, :, iz] >= val[int(math.floor(perc * len(val))) - 1]
+    return mask
+
+
+class ConfoundAccumulator(object):
+    """
+    Sums and cross-products needed by niak_brick_build_confounds,
+    accumulated over slabs of the fMRI run
+    """
+
+    def __init__(self, nt, compcor):
+
+        self.nt = nt
+        self.compcor = compcor
+        self.sum_wm = np.zeros(nt)
+        self.sum_vent = np.zeros(nt)
+        self.n_wm = 0
+        self.n_vent = 0
+        self.sum_brain = np.zeros(nt)
+        self.gram_brain = np.zeros((nt, nt))
+        self.n_brain = 0
+        self.gram_compcor = np.zeros((nt, nt))
+        self.n_compcor = 0
+
+    def add(self, slab, brain, wm, vent):
+        """
+        :param slab: fMRI data (x, y, nz, t)
+        :param brain, wm, vent: masks (x, y, nz)
+        :return: the COMPCOR mask of the slab
+        """
+        y = slab.reshape(-1, self.nt)
+        y_mean = y - y.mean(axis=1, keepdims=True)
+
+        self.sum_wm += y_mean[wm.ravel()].sum(axis=0)
+        self.n_wm += int(wm.sum())
+        self.sum_vent += y_mean[vent.ravel()].sum(axis=0)
+        self.n_vent += int(vent.sum())
+
+        y_brain = y[brain.ravel()]
+        self.sum_brain += y_brain.sum(axis=0)
+        self.gram_brain += y_brain.T.dot(y_brain)
+        self.n_brain += y_brain.shape[0]
+
+        mask = np.zeros(brain.shape, dtype=bool)
+        if self.compcor["type"] in ["a", "at"]:
+            mask |= wm | vent
+        if self.compcor["type"] in ["t", "at"]:
+            std_vol = np.sqrt(np.sum(y_mean ** 2, axis=1) / (self.nt - 1)).reshape(brain.shape)
+            mask |= compcor_slice_mask(std_vol, self.compcor["perc"])
+        if self.compcor["type"] not in ["a", "t", "at"]:
+            raise ValueError("{0} is an unknown type".format(self.compcor["type"]))
+
+        y_comp = normalize(y[mask.ravel()], axis=1)
+        self.gram_compcor += y_comp.T.dot(y_comp)
+        self.n_compcor += y_comp.shape[0]
+        return mask
+
+    def global_signal_pca(self):
+        """
+        sub_pc_spatial_av of niak_brick_build_confounds
+        """
+        spatial_av = normalize(self.sum_brain / self.n_brain)
+        eig_val, eig_vec = gram_pca(self.gram_brain, self.n_brain)
+        eig_vec = normalize(eig_vec)
+        r = spatial_av.dot(eig_vec) / (len(spatial_av) - 1)
+        pc = eig_vec[:, np.argmax(np.abs(r))]
+        return pc * np.sign(pc.dot(spatial_av))
+
+    def compcor_components(self, rng=None):
+        """
+        niak_compcor from the accumulated cross-product
+        """
+        val, x = gram_pca(self.gram_compcor, self.n_compcor)
+        if self.compcor["nb_comp"] is not None:
+            return x[:, :min(self.compcor["nb_comp"], x.shape[1])]
+
+        # Number of components selected with a permutation test
+        rng = rng or np.random.RandomState()
+        valg = np.zeros((self.compcor["nb_samps"], len(val)))
+        for num_s in range(self.compcor["nb_samps"]):
+            gram = np.zeros((self.nt, self.nt))
+            for start in range(0, self.n_compcor, 4096):
+                yg = normalize(rng.standard_normal((min(4096, self.n_compcor - start), self.nt)), axis=1)
+                gram += yg.T.dot(yg)
+            samp = gram_pca(gram, self.n_compcor)[0]
+            samp = np.concatenate([samp, np.ones(max(len(val) - len(samp), 0))])
+            valg[num_s] = samp[:len(val)]
+        pce = np.sum(valg >= val[np.newaxis, :], axis=0) / float(self.compcor["nb_samps"])
+        return x[:, pce <= self.compcor["p"]]
+
+
+def build_confounds(files_in, files_out, opt=None):
+    """
+    Python version of niak_brick_build_confounds, with the same inputs
+    """
+    opt = defaults(opt, BUILD_DEFAULTS)
+    compcor = defaults(opt["compcor"], COMPCOR_DEFAULTS)
+    block_bytes = opt.get("block_bytes", volumes.BLOCK_BYTES)
+    log = logging.getLogger(__file__)
+
+    folder, name, ext = volumes.fileparts(files_in["fmri"])
+    folder_out = opt["folder_out"] or folder
+    files_out = defaults(files_out, BUILD_OUTPUTS)
+    if not files_out["confounds"]:
+        files_out["confounds"] = os.path.join(folder_out, "{0}_confounds.tsv.gz".format(name))
+    if not files_out["compcor_mask"]:
+        files_out["compcor_mask"] = os.path.join(folder_out, "{0}_compcor_mask{1}".format(name, ext))
+
+    if opt["flag_verbose"]:
+        log.info("Reading the fMRI dataset {0}".format(files_in["fmri"]))
+
+    with volumes.Volume(files_in["fmri"]) as vol, volumes.Volume(files_in["mask_brain"]) as v_brain, \
+            volumes.Volume(files_in["mask_wm"]) as v_wm, volumes.Volume(files_in["mask_vent"]) as v_vent:
+        nt = vol.shape[3]
+        acc = ConfoundAccumulator(nt, compcor)
+        mask_comp = np.zeros(vol.shape[:3], dtype=bool)
+        # The slab, its float copy and two centred copies
+        for z in volumes.slabs(vol.shape, 8 * nt * 4, block_bytes):
+            mask_comp[:, :, z] = acc.add(vol.block(z), v_brain.block(z) > 0, v_wm.block(z) > 0,
+                                         v_vent.block(z) > 0)
+
+        extra = vol.extra()
+        if "time_frames" in extra:
+            time_frames = extra["time_frames"].ravel()
+        else:
+            time_frames = np.arange(nt) * vol.tr
+
+        labels = ["motion_tx", "motion_ty", "motion_tz", "motion_rx", "motion_ry", "motion_rz"]
+        transf = volumes.load_mat(files_in["motion_param"])["transf"]
+        rot, tsl = transf2param(transf)
+        x = [tsl.T, rot.T]
+
+        fd = frame_displacement(rot, tsl)
+        labels.append("FD")
+        x.append(fd[:, np.newaxis])
+
+        scrub = fd2mask(fd, time_frames, opt["thre_fd"], opt["ww_fd"], opt["nb_min_vol"])
+        labels.append("scrub")
+        x.append(scrub[:, np.newaxis].astype(np.float64))
+
+        slow_drift = np.atleast_2d(volumes.load_mat(files_in["dc_low"])["tseries_dc_low"])
+        slow_drift = slow_drift[:, np.std(slow_drift, axis=0, ddof=1) != 0]
+        labels += ["slow_drift"] * slow_drift.shape[1]
+        x.append(slow_drift)
+
+        high_freq = volumes.load_mat(files_in["dc_high"])["tseries_dc_high"]
+        if high_freq.size == 0:
+            high_freq = np.zeros((nt, 0))
+        labels += ["high_freq"] * high_freq.shape[1]
+        x.append(high_freq)
+
+        labels += ["wm_avg", "vent_avg", "global_signal_pca"]
+        x += [(acc.sum_wm / acc.n_wm)[:, np.newaxis], (acc.sum_vent / acc.n_vent)[:, np.newaxis],
+              acc.global_signal_pca()[:, np.newaxis]]
+
+        x_comp = acc.compcor_components()
+        nb_comp_max = int(math.floor((nt - sum(a.shape[1] for a in x)) / 2.))
+        x_comp = x_comp[:, :max(min(x_comp.shape[1], nb_comp_max), 0)]
+        labels += ["compcor"] * x_comp.shape[1]
+        x.append(x_comp)
+
+        if files_in.get("custom_param", OMITTED) != OMITTED:
+            covar = volumes.load_mat(files_in["custom_param"])["covar"]
+            if "mask_suppressed" in extra:
+                covar = covar[~extra["mask_suppressed"].ravel().astype(bool)]
+            if covar.size == 0 or covar.shape[0] != nt:
+                raise ValueError("The dimensions of the user-specified covariates are inappropriate "
+                                 "({0} samples, functional datasets has {1} time points)".format(covar.shape[0], nt))
+            covar = normalize(covar)
+            labels += ["custom"] * covar.shape[1]
+            x.append(covar)
+
+        x = np.concatenate(x, axis=1)
+
+        if files_out["compcor_mask"] != OMITTED:
+            volumes.write_vol(files_out["compcor_mask"], vol, mask_comp)
+        if files_out["confounds"] != OMITTED:
+            volumes.write_csv(files_out["confounds"], labels, x)
+
+    return files_in, files_out, opt
+
+
+def regression_design(labels, x, opt):
+    """
+    The confounds niak_brick_regress_confounds regresses out, with the
+    selection of its flags
+    :return: the confounds (time x confounds), their labels, the scrubbing
+        mask and the frame displacement
+    """
+    labels = np.array(labels)
+    mask_scrubbing = x[:, labels == "scrub"].ravel().astype(bool)
+    fd = x[:, labels == "FD"].ravel()[:-1]
+
+    x2 = []
+    labels2 = []
+
+    def add(flag, label):
+        if opt[flag]:
+            x2.append(x[:, labels == label])
+            labels2.extend([label] * int(np.sum(labels == label)))
+
+    add("flag_slow", "slow_drift")
+    add("flag_high", "high_freq")
+
+    rot = normalize(x[:, np.isin(labels, ["motion_rx", "motion_ry", "motion_rz"])])
+    tsl = normalize(x[:, np.isin(labels, ["motion_tx", "motion_ty", "motion_tz"])])
+    motion_param = np.concatenate([rot, tsl, rot ** 2, tsl ** 2], axis=1)
+    if opt["flag_pca_motion"]:
+        # niak_pca of motion_param', keeping pct_var_explained of the energy.
+        # The eigen vectors of motion_param*motion_param' are its left
+        # singular vectors.
+        u, sing, vt = np.linalg.svd(motion_param, full_matrices=False)
+        eig_val = sing ** 2
+        cum_energy = np.cumsum(eig_val) / np.sum(eig_val)
+        nb_comp = int(np.flatnonzero(cum_energy > opt["pct_var_explained"])[0]) + 1
+        motion_param = u[:, :nb_comp]
+    if opt["flag_motion_params"]:
+        x2.append(motion_param)
+        labels2.extend(["motion"] * motion_param.shape[1])
+
+    add("flag_wm", "wm_avg")
+    add("flag_vent", "vent_avg")
+    add("flag_gsc", "global_signal_pca")
+    add("flag_compcor", "compcor")
+    x2.append(x[:, labels == "manual"])
+    labels2.extend(["manual"] * int(np.sum(labels == "manual")))
+
+    x2 = np.concatenate(x2, axis=1) if x2 else np.zeros((x.shape[0], 0))
+    return x2, labels2, mask_scrubbing, fd
+
+
+def projection(x2, mask_scrubbing):
+    """
+    The standardized confounds and the matrix that gives their regression
+    coefficients on the frames that are not scrubbed
+    :return: x2 (time x k), m (k x time) with null columns on scrubbed frames
+    """
+    keep = ~mask_scrubbing
+    x2 = (x2 - x2[keep].mean(axis=0)) / x2[keep].std(axis=0, ddof=1)
+    xs = x2[keep]
+    m = np.zeros((x2.shape[1], x2.shape[0]))
+    m[:, keep] = np.linalg.solve(xs.T.dot(xs), xs.T)
+    return x2, m
+
+
+class RegressionJob(object):
+    """
+    One run of niak_brick_regress_confounds
+    """
+
+    def __init__(self, files_in, files_out, opt=None):
+
+        self.opt = defaults(opt, REGRESS_DEFAULTS)
+        folder, name, ext = volumes.fileparts(files_in["fmri"])
+        folder_out = self.opt["folder_out"] or folder
+        files_out = defaults(files_out, REGRESS_OUTPUTS)
+        if not files_out["filtered_data"]:
+            files_out["filtered_data"] = os.path.join(folder_out, "{0}_cor{1}".format(name, ext))
+        if not files_out["scrubbing"]:
+            files_out["scrubbing"] = os.path.join(folder_out, "{0}_scrub.mat".format(name))
+        self.files_in = files_in
+        self.files_out = files_out
+
+        labels, x = volumes.read_csv(files_in["confounds"])
+        self.x2, self.labels, self.mask_scrubbing, self.fd = regression_design(labels, x, self.opt)
+        self.m = None
+        if self.x2.shape[1]:
+            self.x2, self.m = projection(self.x2, self.mask_scrubbing)
+
+
+def regress_block(y, x2, m, keep):
+    """
+    Regress the confounds of many runs at once
+    :param y: data (runs x time x voxels)
+    :param x2: standardized confounds (runs x time x k)
+    :param m: regression matrices (runs x k x time)
+    :param keep: frames used for the regression (runs x time)
+    :return: the residuals of the standardized data, plus the mean
+    """
+    weights = keep[:, :, np.newaxis].astype(np.float64)
+    n_keep = weights.sum(axis=1, keepdims=True)
+    y_mean = np.sum(y * weights, axis=1, keepdims=True) / n_keep
+    y_std = np.sqrt(np.sum(((y - y_mean) * weights) ** 2, axis=1, keepdims=True) / (n_keep - 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = (y - y_mean) / y_std
+    y -= np.matmul(x2, np.matmul(m, y))
+    return y + y_mean
+
+
+def pad(arrays, axis):
+    """
+    Pad the confound matrices of runs with null confounds, so they can be stacked
+    """
+    k_max = max(a.shape[axis] for a in arrays)
+    out = []
+    for a in arrays:
+        width = [(0, 0)] * a.ndim
+        width[axis] = (0, k_max - a.shape[axis])
+        out.append(np.pad(a, width, mode="constant"))
+    return np.stack(out)
+
+
+def write_side_outputs(job, vol):
+    if job.files_out["scrubbing"] != OMITTED:
+        volumes.save_mat(job.files_out["scrubbing"], {"mask_scrubbing": job.mask_scrubbing.astype(np.float64),
+                                                      "fd": job.fd})
+    if job.files_out["filtered_data"] == OMITTED:
+        return
+    extra = vol.extra()
+    extra["mask_scrubbing"] = job.mask_scrubbing.astype(np.float64)
+    extra["confounds"] = job.x2
+    extra["labels_confounds"] = np.array(job.labels, dtype=object).reshape(-1, 1)
+    volumes.write_extra(job.files_out["filtered_data"], extra, vol.shape[3])
+
+
+def regress_group(jobs, block_bytes=volumes.BLOCK_BYTES, n_threads=1):
+    """
+    Regress the confounds of runs with the same dimensions, slab by slab
+    """
+    vols = []
+    outs = []
+    try:
+        for job in jobs:
+            vols.append(volumes.Volume(job.files_in["fmri"]))
+            outs.append(volumes.OutputVolume(job.files_out["filtered_data"], vols[-1]))
+        shape = vols[0].shape
+        nt = shape[3]
+        x2 = pad([j.x2 for j in jobs], axis=1)
+        m = pad([j.m for j in jobs], axis=0)
+        keep = np.stack([~j.mask_scrubbing for j in jobs])
+
+        def process(z):
+            y = np.stack([v.block(z).reshape(-1, nt).T for v in vols])
+            res = regress_block(y, x2, m, keep)
+            for out, r in zip(outs, res):
+                out.write_block(z, r.T.reshape(shape[0], shape[1], -1, nt))
+
+        # Data, standardized copy and products, for all runs of the group
+        z_slabs = volumes.slabs(shape, 8 * nt * 4 * len(jobs), block_bytes // max(n_threads, 1))
+        pool = ThreadPool(n_threads)
+        try:
+            pool.map(process, z_slabs)
+        finally:
+            pool.close()
+            pool.join()
+
+        for job, vol, out in zip(jobs, vols, outs):
+            out.close()
+            write_side_outputs(job, vol)
+    except BaseException:
+        for out in outs:
+            out.discard()
+        raise
+    finally:
+        for vol in vols:
+            vol.close()
+
+
+def copy_run(job, block_bytes=volumes.BLOCK_BYTES):
+    """
+    No confound to regress, the data is left as is
+    """
+    warnings.warn("Found no confounds to regress! Leaving the dataset as is")
+    with volumes.Volume(job.files_in["fmri"]) as vol, \
+            volumes.OutputVolume(job.files_out["filtered_data"], vol) as out:
+        for z in volumes.slabs(vol.shape, 8 * vol.shape[3], block_bytes):
+            out.write_block(z, vol.block(z))
+        write_side_outputs(job, vol)
+
+
+def regress_confounds(jobs, batch_size=8, block_bytes=volumes.BLOCK_BYTES, n_threads=1):
+    """
+    Python version of niak_brick_regress_confounds for many runs
+    :param jobs: a list of (files_in, files_out, opt) of the brick
+    :param batch_size: maximal number of runs regressed together
+    """
+    jobs = [RegressionJob(*job) for job in jobs]
+    groups = {}
+    for job in jobs:
+        if job.files_out["filtered_data"] == OMITTED:
+            # Only the scrubbing mask is written, as in the octave brick
+            write_side_outputs(job, None)
+        elif job.m is None:
+            copy_run(job, block_bytes)
+        else:
+            groups.setdefault(volumes.read_shape(job.files_in["fmri"]), []).append(job)
+
+    for shape, group in sorted(groups.items()):
+        for start in range(0, len(group), batch_size):
+            regress_group(group[start:start + batch_size], block_bytes, n_threads)
+    return jobs
+
+
+def _build(job):
+    return build_confounds(*job)
+
+
+def run(build_jobs=None, regress_jobs=None, n_workers=1, batch_size=8, block_bytes=volumes.BLOCK_BYTES):
+    """
+    Build the confounds of many runs over a process pool, then regress them
+    in batches
+    :param build_jobs: a list of (files_in, files_out, opt) for niak_brick_build_confounds
+    :param regress_jobs: a list of (files_in, files_out, opt) for niak_brick_regress_confounds
+    """
+    if build_jobs:
+        pool = Pool(n_workers)
+        try:
+            pool.map(_build, build_jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    if regress_jobs:
+        regress_confounds(regress_jobs, batch_size, block_bytes, n_workers)
@@ -0,0 +1,504 @@
+"""
+Python backend of niak_brick_smooth_vol and niak_brick_time_filter.
+
+niak_smooth_vol writes every frame of a run to a MINC file, calls mincblur
+on it and reads the result back, one frame at a time. Here the Gaussian
+kernel is separable, so a whole batch of frames is convolved along x, then
+y, then z. Along each axis the convolution is done directly, one tap at a
+time over the whole batch, when the kernel is short, and through the FFT of
+the zero padded axis as in niak_conv3_sep when it is long compared with the
+log of the axis length. The run is memory mapped, frames are contiguous in
+the NIfTI file, and batches of frames are smoothed on a thread pool. A batch
+holds as many frames as fit in block_bytes / n_threads, so the memory used
+does not depend on the length of the run.
+
+The temporal filter regresses the discrete cosines of niak_build_dc out of
+every time series, like niak_filter_tseries. These cosines,
+cos(pi * t * k / nt) for t = 0..nt-1, are not orthogonal over the run, so
+the least-squares fit is not a plain band stop in the Fourier or DCT domain:
+filtering through an FFT would change the results. The projection on the
+cosines is computed once per run and applied to slabs of slices with
+matrix products, spread over a thread pool, which costs the number of
+cosines per sample. Voxels outside the brain mask of niak_mask_brain are
+left as they are.
+
+The kernel of mincblur is a Gaussian sampled on the voxel grid and cut at
+KERNEL_WIDTH standard deviations, the smoothed volumes match the octave
+ones up to the truncation of the kernel and the border handling of mincblur.
+"""
+__author__ = 'poquirion'
+
+import logging
+import math
+import os
+import shutil
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import pyniak.volumes as volumes
+from pyniak.common import OMITTED, defaults, normalize
+
+SMOOTH_DEFAULTS = {"flag_edge": True, "fwhm": 6, "folder_out": "", "flag_skip": False, "flag_verbose": True}
+FILTER_DEFAULTS = {"flag_mean": True, "tr": -np.inf, "hp": 0.01, "lp": np.inf, "folder_out": "",
+                   "flag_verbose": True}
+FILTER_OUTPUTS = ["filtered_data", "var_high", "var_low", "beta_high", "beta_low", "dc_high", "dc_low"]
+FWHM2SIGMA = 1. / math.sqrt(8 * math.log(2))
+# The Gaussian kernel is cut at that many standard deviations
+KERNEL_WIDTH = 4
+# Taps of a kernel per log2 of the padded axis above which the FFT is faster
+FFT_TAPS = 1
+
+log = logging.getLogger(__file__)
+
+
+def gaussian_kernel(fwhm, voxel_size, width=KERNEL_WIDTH):
+    """
+    :param fwhm: the full width at half maximum of the Gaussian, in mm
+    :param voxel_size: the size of a voxel along the axis, in mm
+    :return: a normalized kernel of odd length 2 * N + 1
+    """
+    sigma = fwhm * FWHM2SIGMA / abs(voxel_size)
+    if sigma == 0:
+        return np.ones(1)
+    radius = int(math.ceil(width * sigma))
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+
+def fft_size(n):
+    """
+    :return: the smallest 2^a 3^b 5^c larger or equal to n
+    """
+    best = 2 ** int(math.ceil(math.log(n, 2)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n:
+                p *= 2
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def use_fft(n, m):
+    """
+    :return: True if a kernel of m taps is applied faster through the FFT
+        on an axis of n samples
+    """
+    return m > FFT_TAPS * math.log(fft_size(n + m - 1), 2)
+
+
+def _along(axis, ndim, s):
+    index = [slice(None)] * ndim
+    index[axis] = s
+    return tuple(index)
+
+
+def convolve_axis(data, kernel, axis):
+    """
+    Convolution along one axis, zero padded, the output has the shape of data
+    :param kernel: a kernel of odd length, centered
+    """
+    n = data.shape[axis]
+    m = len(kernel)
+    radius = m // 2
+    if m == 1:
+        return data * kernel[0]
+    if use_fft(n, m):
+        size = fft_size(n + m - 1)
+        shape = [1] * data.ndim
+        shape[axis] = -1
+        fk = np.fft.rfft(kernel, size).reshape(shape)
+        out = np.fft.irfft(np.fft.rfft(data, size, axis=axis) * fk, size, axis=axis)
+        return out[_along(axis, data.ndim, slice(radius, radius + n))]
+    out = np.zeros(data.shape)
+    for j, w in enumerate(kernel):
+        shift = radius - j
+        if abs(shift) >= n:
+            continue
+        if shift >= 0:
+            out[_along(axis, data.ndim, slice(0, n - shift))] += w * data[_along(axis, data.ndim, slice(shift, n))]
+        else:
+            out[_along(axis, data.ndim, slice(-shift, n))] += w * data[_along(axis, data.ndim, slice(0, n + shift))]
+    return out
+
+
+def conv3_sep(vol, fx, fy, fz):
+    """
+    Separable 3D convolution of a volume or of a batch of frames (x, y, z[, t]),
+    like niak_conv3_sep
+    """
+    for axis, kernel in enumerate([fx, fy, fz]):
+        vol = convolve_axis(vol, np.asarray(kernel, dtype=np.float64), axis)
+    return vol
+
+
+def smooth_kernels(fwhm, voxel_size):
+    fwhm = np.atleast_1d(np.asarray(fwhm, dtype=np.float64)).ravel()
+    if fwhm.size == 1:
+        fwhm = np.repeat(fwhm, 3)
+    return [gaussian_kernel(f, v) for f, v in zip(fwhm, voxel_size[:3])]
+
+
+def n_frames(vol):
+    return vol.shape[3] if len(vol.shape) > 3 else 1
+
+
+def frames(vol, t):
+    """
+    :return: a batch of frames of a run, an array (x, y, z, nt) of floats
+    """
+    if len(vol.shape) > 3:
+        return np.asarray(vol.data[..., t], dtype=np.float64)
+    return np.asarray(vol.data, dtype=np.float64)[..., np.newaxis]
+
+
+def smooth_vol(vol, out, fwhm, mask=None, flag_edge=True, block_bytes=volumes.BLOCK_BYTES, n_threads=1):
+    """
+    Smooth all the frames of a run, like niak_smooth_vol
+    :param vol: a volumes.Volume
+    :param out: a volumes.OutputVolume with the shape of vol
+    :param fwhm: the full width at half maximum of the kernel in mm, one
+        value or one per axis
+    :param mask: a binary volume, the whole field of view by default
+    :param flag_edge: correct the smoothing at the edges of the mask
+    """
+    kernels = smooth_kernels(fwhm, vol.header.get_zooms())
+    shape = vol.shape[:3]
+    nt = n_frames(vol)
+    if flag_edge:
+        mask = np.ones(shape, dtype=bool) if mask is None else np.asarray(mask) > 0
+        corr = conv3_sep(mask.astype(np.float64), *kernels)
+        corr[~mask] = 1
+
+    def process(t):
+        batch = frames(vol, t)
+        if flag_edge:
+            batch[~mask] = 0
+        batch = conv3_sep(batch, *kernels)
+        if flag_edge:
+            batch /= corr[..., np.newaxis]
+            batch[~mask] = 0
+        if len(vol.shape) > 3:
+            out.data[..., t] = batch
+        else:
+            out.data[...] = batch[..., 0]
+
+    # Frames, padded copies along one axis and FFT, for each thread
+    frame_bytes = 8 * int(np.prod(shape)) * 4
+    step = max(1, int(block_bytes // max(n_threads, 1) // frame_bytes))
+    batches = [slice(t, min(t + step, nt)) for t in range(0, nt, step)]
+    pool = ThreadPool(n_threads)
+    try:
+        pool.map(process, batches)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def copy_vol(path_in, path_out, block_bytes=volumes.BLOCK_BYTES):
+    """
+    Copy a run and its _extra.mat file, like niak_cp_fmri
+    """
+    if volumes.fileparts(path_in)[2] == volumes.fileparts(path_out)[2]:
+        shutil.copyfile(path_in, path_out)
+    else:
+        with volumes.Volume(path_in) as vol, volumes.OutputVolume(path_out, vol) as out:
+            for z in volumes.slabs(vol.shape, 8 * n_frames(vol), block_bytes):
+                out.write_block(z, vol.block(z))
+    if os.path.exists(volumes.extra_path(path_in)):
+        shutil.copyfile(volumes.extra_path(path_in), volumes.extra_path(path_out))
+
+
+def copy_extra(vol, path_out):
+    extra = vol.extra()
+    if extra:
+        volumes.save_mat(volumes.extra_path(path_out), extra)
+
+
+def brick_smooth_vol(files_in, files_out, opt=None, block_bytes=volumes.BLOCK_BYTES, n_threads=1):
+    """
+    Python version of niak_brick_smooth_vol
+    :param files_in: the run, or [run, mask]
+    :param files_out: the smoothed run, <name>_s<ext> in opt folder_out if empty
+    :return: files_out
+    """
+    opt = defaults(opt, SMOOTH_DEFAULTS)
+    if isinstance(files_in, (list, tuple)):
+        files_in, file_mask = files_in
+    else:
+        file_mask = OMITTED
+    path_f, name_f, ext_f = volumes.fileparts(files_in)
+    folder_out = opt["folder_out"] or path_f or "."
+    if not files_out:
+        files_out = os.path.join(folder_out, "{0}_s{1}".format(name_f, ext_f))
+
+    fwhm = np.atleast_1d(opt["fwhm"])
+    if fwhm.min() == 0 or opt["flag_skip"]:
+        copy_vol(files_in, files_out, block_bytes)
+        return files_out
+
+    mask = None
+    if file_mask != OMITTED:
+        with volumes.Volume(file_mask) as vol_mask:
+            mask = vol_mask.read() > 0
+    if opt["flag_verbose"]:
+        log.info("Smoothing {0}, fwhm {1} mm".format(files_in, fwhm.tolist()))
+    with volumes.Volume(files_in) as vol:
+        with volumes.OutputVolume(files_out, vol) as out:
+            smooth_vol(vol, out, fwhm, mask, opt["flag_edge"], block_bytes, n_threads)
+        copy_extra(vol, files_out)
+    return files_out
+
+
+def build_dc(nt, tr, cutoff, type_fw):
+    """
+    Discrete cosines below (type_fw 'low') or above ('high') a cut-off
+    frequency, like niak_build_dc
+    :return: tseries_dc, an array nt x number of cosines, and their
+        frequencies in Hz
+    """
+    tim = np.arange(nt, dtype=np.float64)[:, np.newaxis]
+    if type_fw == "low":
+        num_dc = min(np.floor(2 * nt * tr * cutoff), nt - 1)
+        if num_dc < 0:
+            return np.zeros((nt, 0)), np.zeros(0)
+        freq_num = np.arange(int(num_dc) + 1)
+        tseries_dc = np.zeros((nt, len(freq_num)))
+        tseries_dc[:, 1:] = normalize(np.cos(np.pi * tim * freq_num[1:] / nt))
+        tseries_dc[:, 0] = math.sqrt((nt - 1.) / nt)
+    elif type_fw == "high":
+        num_dc = max(np.ceil(2 * nt * tr * cutoff), 1)
+        if num_dc > nt:
+            return np.zeros((nt, 0)), np.zeros(0)
+        freq_num = np.arange(int(num_dc), nt + 1)
+        tseries_dc = normalize(np.cos(np.pi * tim * freq_num / nt))
+    else:
+        raise ValueError("{0}: unknown type of frequency window".format(type_fw))
+    return tseries_dc, freq_num / (2. * nt * tr)
+
+
+def filter_basis(nt, tr, hp=-np.inf, lp=np.inf, flag_mean=False):
+    """
+    The cosines regressed by niak_filter_tseries
+    :return: q_low, freq_low, q_high, freq_high
+    """
+    nyquist = 1. / (2 * tr)
+    for name, cutoff in [("low-pass", lp), ("high-pass", hp)]:
+        if not np.isinf(cutoff) and (cutoff < 0 or cutoff > nyquist):
+            raise ValueError("Please specify a cut-off frequency for {0} filtering that is larger than 0 and "
+                             "smaller than the Nyquist frequency {1:.2f} Hz".format(name, nyquist))
+    q_low, freq_low = build_dc(nt, tr, hp, "low")
+    if flag_mean and q_low.shape[1] > 1:
+        q_low, freq_low = q_low[:, 1:], freq_low[1:]
+    q_high, freq_high = build_dc(nt, tr, lp, "high")
+    return q_low, freq_low, q_high, freq_high
+
+
+def projection(q):
+    """
+    :return: the least-squares estimator (q'q)^-1 q', as in niak_lse
+    """
+    return np.linalg.solve(q.T.dot(q), q.T)
+
+
+def filter_tseries(tseries, tr, hp=-np.inf, lp=np.inf, flag_mean=False):
+    """
+    Python version of niak_filter_tseries
+    :param tseries: an array time x series
+    :return: tseries_f, extras with the fields of niak_filter_tseries
+    """
+    tseries = np.asarray(tseries, dtype=np.float64)
+    q_low, freq_low, q_high, freq_high = filter_basis(tseries.shape[0], tr, hp, lp, flag_mean)
+    q = np.hstack([q_low, q_high])
+    if q.shape[1]:
+        beta = projection(q).dot(tseries)
+        tseries_f = tseries - q.dot(beta)
+    else:
+        beta = np.zeros((0, tseries.shape[1]))
+        tseries_f = tseries.copy()
+    k = q_low.shape[1]
+    extras = {"tseries_dc_low": q_low, "beta_dc_low": beta[:k], "freq_dc_low": freq_low,
+              "tseries_dc_high": q_high, "beta_dc_high": beta[k:], "freq_dc_high": freq_high}
+    return tseries_f, extras
+
+
+def otsu(hist):
+    """
+    The threshold of Otsu on a histogram, the otsu subfunction of
+    niak_mask_brain
+    :return: the (octave) index of the threshold bin, minus one
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    hist = hist / hist.sum()
+    i = np.arange(1, len(hist) + 1)
+    somme = np.sum(i * hist)
+    a = np.cumsum(i * hist)[:-1]
+    p = np.cumsum(hist)[:-1]
+    d = p * (1 - p)
+    valid = d >= 1e-10
+    if not valid.any():
+        return -1
+    s = np.where(valid, (somme * p - a) ** 2 / np.where(valid, d, 1), -1)
+    # Ties go to the last bin, as in the octave loop
+    seuil = np.flatnonzero(valid & (s == s[valid].max()))[-1] + 1
+    return seuil - 1
+
+
+def mask_brain(abs_vol_mean, nb_bins=256):
+    """
+    Brain mask of a mean absolute volume, like niak_mask_brain without
+    smoothing
+    """
+    abs_vol_mean = np.array(abs_vol_mean, dtype=np.float64)
+    mask_nan = np.isnan(abs_vol_mean)
+    abs_vol_mean[mask_nan] = 0
+    counts, edges = np.histogram(abs_vol_mean, nb_bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    ind_seuil = min(max(otsu(counts), 1), nb_bins)
+    return (abs_vol_mean > centers[ind_seuil - 1]) & ~mask_nan
+
+
+def filter_outputs(files_in, files_out, opt):
+    """
+    The outputs of niak_brick_time_filter, omitted by default, with their
+    default name if empty
+    """
+    path_f, name_f, ext_f = volumes.fileparts(files_in)
+    folder_out = opt["folder_out"] or path_f or "."
+    files_out = defaults(files_out, dict((name, OMITTED) for name in FILTER_OUTPUTS))
+    for name in FILTER_OUTPUTS:
+        if not files_out[name]:
+            if name == "filtered_data":
+                suffix = "_f" + ext_f
+            elif name.startswith("dc"):
+                suffix = "_{0}.mat".format(name)
+            else:
+                suffix = "_{0}{1}".format(name, ext_f)
+            files_out[name] = os.path.join(folder_out, name_f + suffix)
+    return files_out
+
+
+def mean_abs(vol, block_bytes=volumes.BLOCK_BYTES):
+    """
+    :return: the mean absolute value of every voxel over time, slab by slab
+    """
+    out = np.zeros(vol.shape[:3])
+    for z in volumes.slabs(vol.shape, 8 * n_frames(vol), block_bytes):
+        block = vol.block(z)
+        out[:, :, z] = np.abs(block).mean(axis=3) if block.ndim > 3 else np.abs(block)
+    return out
+
+
+def brick_time_filter(files_in, files_out, opt=None, block_bytes=volumes.BLOCK_BYTES, n_threads=1):
+    """
+    Python version of niak_brick_time_filter
+    :param files_in: a run
+    :param files_out: filtered_data, var_high, var_low, beta_high, beta_low,
+        dc_high, dc_low, as in the octave brick
+    :return: files_out
+    """
+    opt = defaults(opt, FILTER_DEFAULTS)
+    files_out = filter_outputs(files_in, files_out, opt)
+    written = dict((name, files_out[name] != OMITTED) for name in FILTER_OUTPUTS)
+
+    outs = {}
+    with volumes.Volume(files_in) as vol:
+        tr = opt["tr"]
+        if tr == -np.inf:
+            tr = vol.tr
+            if tr is None:
+                raise ValueError("please specify the TR of the fMRI data in opt.tr")
+        shape = vol.shape[:3]
+        nt = n_frames(vol)
+        q_low, freq_low, q_high, freq_high = filter_basis(nt, tr, opt["hp"], opt["lp"], opt["flag_mean"])
+        if opt["flag_verbose"]:
+            log.info("Temporal filtering of {0}: {1} low frequency and {2} high frequency cosines".format(
+                files_in, q_low.shape[1], q_high.shape[1]))
+        q = np.hstack([q_low, q_high])
+        pinv = projection(q) if q.shape[1] else None
+        k_low = q_low.shape[1]
+
+        mask = mask_brain(mean_abs(vol, block_bytes))
+        try:
+            if written["filtered_data"]:
+                outs["filtered_data"] = volumes.OutputVolume(files_out["filtered_data"], vol)
+            for name, k in [("beta_low", k_low), ("beta_high", q_high.shape[1])]:
+                if written[name] and k:
+                    outs[name] = volumes.OutputVolume(files_out[name], vol, shape=shape + (k,))
+                elif written[name]:
+                    log.warning("No {0} frequency cosines, {1} is not written".format(name[5:], files_out[name]))
+            for name in ["var_low", "var_high"]:
+                if written[name]:
+                    outs[name] = volumes.OutputVolume(files_out[name], vol, shape=shape)
+
+            def process(z):
+                block = vol.block(z)
+                nz = block.shape[2]
+                y = block.reshape(-1, nt).T
+                m = mask[:, :, z].reshape(-1)
+                ym = y[:, m]
+                beta = pinv.dot(ym) if pinv is not None else np.zeros((0, ym.shape[1]))
+                if "filtered_data" in outs:
+                    if pinv is not None:
+                        y[:, m] = ym - q.dot(beta)
+                    outs["filtered_data"].write_block(z, y.T.reshape(shape[0], shape[1], nz, nt))
+                for name, b in [("beta_low", beta[:k_low]), ("beta_high", beta[k_low:])]:
+                    if name in outs:
+                        values = np.zeros((b.shape[0], y.shape[1]))
+                        values[:, m] = b
+                        outs[name].write_block(z, values.T.reshape(shape[0], shape[1], nz, -1))
+                if "var_low" in outs or "var_high" in outs:
+                    var_vol = ym.var(axis=0, ddof=1)
+                for name, dc, b in [("var_low", q_low, beta[:k_low]), ("var_high", q_high, beta[k_low:])]:
+                    if name in outs:
+                        values = np.zeros(y.shape[1])
+                        if b.shape[0]:
+                            values[m] = np.divide(dc.dot(b).var(axis=0, ddof=1), var_vol,
+                                                  out=np.zeros(ym.shape[1]), where=var_vol != 0)
+                        outs[name].write_block(z, values.reshape(shape[0], shape[1], nz))
+
+            # Time series, residuals and coefficients, for each thread
+            n_out = 1 + len(outs)
+            z_slabs = volumes.slabs(vol.shape, 8 * (nt * 3 + q.shape[1]) * n_out, block_bytes // max(n_threads, 1))
+            pool = ThreadPool(n_threads)
+            try:
+                pool.map(process, z_slabs)
+            finally:
+                pool.close()
+                pool.join()
+            for out in outs.values():
+                out.close()
+        except BaseException:
+            for out in outs.values():
+                out.discard()
+            raise
+        if written["filtered_data"]:
+            copy_extra(vol, files_out["filtered_data"])
+
+    if written["dc_low"]:
+        volumes.save_mat(files_out["dc_low"], {"freq_dc_low": freq_low[:, np.newaxis], "tseries_dc_low": q_low})
+    if written["dc_high"]:
+        volumes.save_mat(files_out["dc_high"], {"freq_dc_high": freq_high[:, np.newaxis],
+                                                "tseries_dc_high": q_high})
+    return files_out
+
+
+def run(smooth_jobs=None, filter_jobs=None, block_bytes=volumes.BLOCK_BYTES, n_threads=1):
+    """
+    Smooth and filter many runs, one after the other, each over a thread pool
+    :param smooth_jobs: a list of (files_in, files_out, opt) for niak_brick_smooth_vol
+    :param filter_jobs: a list of (files_in, files_out, opt) for niak_brick_time_filter
+    :return: the files_out of all jobs
+    """
+    done = []
+    for files_in, files_out, opt in smooth_jobs or []:
+        done.append(brick_smooth_vol(files_in, files_out, opt, block_bytes, n_threads))
+    for files_in, files_out, opt in filter_jobs or []:
+        done.append(brick_time_filter(files_in, files_out, opt, block_bytes, n_threads))
+    return done
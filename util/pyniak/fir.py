@@ -0,0 +1,391 @@
+"""
+Finite impulse response (FIR) estimation and FIR stability, see
+niak_build_fir, niak_normalize_fir, niak_stability_fir and the bricks
+niak_brick_fir_tseries and niak_brick_stability_fir.
+
+The octave code interpolates the time series of every event one after the
+other. Here the frames that an event can touch are a window of fixed
+width starting at the last frame before the event, so the windows of all
+events are one strided view of the (padded) time series, and linear
+interpolation is a sparse weight per window sample: the responses of all
+events and all regions are a single product of the weights and the
+windows. Events that cross a gap larger than max_interpolation (e.g.
+scrubbed frames) or leave the run are excluded, like in octave.
+
+The stability replicates draw a bootstrap (or subsample) of the events
+of each region, add a null response built with circular shifts of the
+events, and cluster the distance between the average responses. Draws
+are index arrays into the responses, nothing is copied per event, and the
+replicates run over a process pool by chunks of fixed size, each seeded
+on its own, so the result does not depend on the number of workers.
+"""
+__author__ = 'poquirion'
+
+import logging
+
+import numpy as np
+
+import pyniak.volumes as volumes
+from pyniak.common import SHARED, defaults, run_pool
+from pyniak.hierarchy import consensus_clustering, hierarchical_clustering_vec, threshold_hierarchy
+from pyniak.subtype import read_model
+
+FIR_DEFAULTS = {"max_interpolation": np.inf, "time_window": 10, "time_sampling": 0.5, "interpolation": "linear"}
+TSERIES_DEFAULTS = {"name_condition": "", "name_baseline": "", "max_interpolation": None, "type_norm": "fir_shape",
+                    "time_window": 10, "time_sampling": 0.5, "nb_min_baseline": 10, "interpolation": "linear"}
+STABILITY_DEFAULTS = {"network": "atoms", "nb_min_fir": 1, "std_noise": 0, "nb_samps": 100, "nb_classes": None,
+                      "normalize": {"type": "fir_shape", "time_sampling": 0.5}, "clustering": {}, "sampling": {},
+                      "rand_seed": None}
+# The number of stability replicates in one job of the pool
+NB_SAMPS_CHUNK = 10
+
+
+def time_samples(time_window, time_sampling):
+    """
+    :return: the times of the FIR samples after an event, every
+        time_sampling from 0, up to time_window or the first sample past it
+        as in niak_build_fir
+    """
+    samples = np.arange(0, time_window + time_sampling / 2., time_sampling)
+    samples = samples[samples <= time_window]
+    if samples[-1] < time_window:
+        samples = np.append(samples, samples[-1] + time_sampling)
+    return samples
+
+
+def event_windows(tseries, time_frames, time_events, samples, max_interpolation=np.inf):
+    """
+    The frames used to interpolate the response to each event
+    :param tseries: an array (T, N)
+    :return: a mask of the valid events, the windows of the valid events (E, N, W),
+        and the linear interpolation weights (E, L, W) of the samples in the windows
+    """
+    frames = np.asarray(time_frames, dtype=np.float64).ravel()
+    events = np.asarray(time_events, dtype=np.float64).ravel()
+    nb_t = frames.size
+    ind_start = np.searchsorted(frames, events, "right") - 1
+    ind_end = np.searchsorted(frames, events + samples[-1], "left")
+    valid = (ind_start >= 0) & (ind_end < nb_t)
+    # The number of gaps larger than max_interpolation before each frame
+    gaps = np.concatenate([[0], np.cumsum(np.diff(frames) > max_interpolation + 0.001)])
+    valid[valid] = gaps[ind_end[valid]] == gaps[ind_start[valid]]
+    ind_start = ind_start[valid]
+    nb_e, nb_l = ind_start.size, samples.size
+    width = int((ind_end[valid] - ind_start).max()) + 2 if nb_e else 1
+
+    padded = np.zeros((nb_t + width, tseries.shape[1]))
+    padded[:nb_t] = tseries
+    view = np.lib.stride_tricks.as_strided(
+        padded, shape=(nb_t, tseries.shape[1], width),
+        strides=(padded.strides[0], padded.strides[1], padded.strides[0]), writeable=False)
+    windows = view[ind_start]
+
+    times = events[valid, None] + samples[None, :]
+    ind = np.clip(np.searchsorted(frames, times, "right") - 1, 0, nb_t - 1)
+    nxt = np.minimum(ind + 1, nb_t - 1)
+    step = frames[nxt] - frames[ind]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = np.where(step > 0, (times - frames[ind]) / step, 0)
+    weights = np.zeros((nb_e, nb_l, width))
+    rel = ind - ind_start[:, None]
+    grid_e, grid_l = np.meshgrid(np.arange(nb_e), np.arange(nb_l), indexing="ij")
+    np.add.at(weights, (grid_e, grid_l, rel), 1 - frac)
+    np.add.at(weights, (grid_e, grid_l, np.minimum(rel + 1, width - 1)), frac)
+    return valid, windows, weights
+
+
+def build_fir(tseries, time_frames, time_events, opt=None):
+    """
+    Like niak_build_fir, with linear interpolation
+    :param tseries: an array (T, N)
+    :param time_frames: the time of each frame, in seconds
+    :param time_events: the time of each event
+    :param opt: max_interpolation, time_window, time_sampling
+    :return: fir_mean (L, N), nb_fir, fir_all (L, N, nb_fir) and the time samples (L,)
+    """
+    opt = defaults(opt, FIR_DEFAULTS)
+    if opt["interpolation"] != "linear":
+        raise ValueError("{0}: only the linear interpolation is available".format(opt["interpolation"]))
+    tseries = np.asarray(tseries, dtype=np.float64)
+    frames = np.asarray(time_frames, dtype=np.float64).ravel()[:tseries.shape[0]]
+    samples = time_samples(opt["time_window"], opt["time_sampling"])
+    _, windows, weights = event_windows(np.nan_to_num(tseries), frames, time_events, samples,
+                                        opt["max_interpolation"])
+    fir_all = np.einsum("elw,enw->lne", weights, windows)
+
+    # Responses touching a missing value are missing, like with interp1
+    if np.isnan(tseries).any():
+        _, missing, _ = event_windows(np.isnan(tseries).astype(np.float64), frames, time_events, samples,
+                                      opt["max_interpolation"])
+        touched = np.einsum("elw,enw->lne", (weights > 0).astype(np.float64), missing) > 0
+        fir_all[touched] = np.nan
+    fir_all = fir_all[:, :, ~np.isnan(fir_all).any(axis=(0, 1))]
+    nb_fir = fir_all.shape[2]
+    fir_mean = fir_all.mean(axis=2) if nb_fir else np.zeros((samples.size, tseries.shape[1]))
+    return fir_mean, nb_fir, fir_all, samples
+
+
+def normalize_fir(fir, baseline=None, type_norm="fir_shape", time_sampling=0.5):
+    """
+    Like niak_normalize_fir
+    :param fir: a response (L, N) or responses (L, N, E)
+    :param baseline: the baseline time series (B, N), zero if None
+    :param type_norm: 'fir' (percentage of the baseline) or 'fir_shape' (unit energy)
+    """
+    if type_norm not in ["fir", "fir_shape"]:
+        raise ValueError("{0} is an unknown type of normalization".format(type_norm))
+    fir = np.asarray(fir, dtype=np.float64)
+    if baseline is None or np.size(baseline) == 0:
+        if type_norm == "fir":
+            raise ValueError("the 'fir' normalization needs a baseline")
+        fir_m = np.zeros(fir.shape[1])
+    else:
+        fir_m = np.asarray(baseline, dtype=np.float64).mean(axis=0)
+    fir_m = fir_m.reshape((1, -1) + (1,) * (fir.ndim - 2))
+    fir_c = fir - fir_m
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if type_norm == "fir_shape":
+            return fir_c / np.sqrt((fir_c ** 2).sum(axis=0) * time_sampling)
+        return 100 * fir_c / fir_m
+
+
+def fir_distance(fir, type_norm="fir_shape", time_sampling=0.5):
+    """
+    Like niak_stability_fir_distance: the euclidean distance between the
+    average responses of the regions
+    :param fir: responses (L, N, E), or their average (L, N)
+    :return: the distance matrix in vector form
+    """
+    fir_mean = fir.mean(axis=2) if fir.ndim == 3 else fir
+    if type_norm == "fir_shape":
+        fir_mean = normalize_fir(fir_mean, None, "fir_shape", time_sampling)
+    norms = (fir_mean ** 2).sum(axis=0)
+    dist = norms[:, None] + norms[None, :] - 2 * fir_mean.T.dot(fir_mean)
+    return np.sqrt(np.maximum(dist[np.triu_indices(dist.shape[0], 1)], 0))
+
+
+def fir_null(fir_all, rng):
+    """
+    Like niak_stability_fir_null: every event is shifted circularly by a random lag
+    """
+    nb_l, _, nb_e = fir_all.shape
+    shifts = np.floor(nb_l * rng.random_sample(nb_e)).astype(int)
+    lags = (np.arange(nb_l)[:, None] + shifts[None, :]) % nb_l
+    return fir_all[lags[:, None, :], np.arange(fir_all.shape[1])[None, :, None], np.arange(nb_e)[None, None, :]]
+
+
+def fir_diff_null(fir_all, rng):
+    """
+    Like niak_stability_fir_diff_null: the average response of each region
+    is replaced by the grand average, and events are drawn with replacement
+    """
+    fir_m = fir_all.mean(axis=2)
+    null = fir_all - fir_m[:, :, None] + fir_m.mean(axis=1)[:, None, None]
+    nb_e = fir_all.shape[2]
+    return null[:, :, rng.randint(nb_e, size=nb_e)]
+
+
+def _stability_chunk(job):
+    opt, seeds = job
+    fir_all, upper = SHARED["fir_all"], SHARED["upper"]
+    nb_l, nb_n, nb_e = fir_all.shape
+    type_norm = opt["normalize"]["type"]
+    regions = np.arange(nb_n)
+    nb_classes = np.atleast_1d(opt["nb_classes"]).astype(int)
+    stab = np.zeros((upper[0].size, nb_classes.size))
+    for seed in seeds:
+        rng = np.random.RandomState(seed)
+        if opt["sampling"].get("type", "bootstrap") == "subsample":
+            nb_sub = int(np.ceil(opt["sampling"].get("opt", 0.5) * nb_e))
+            draw = np.tile(rng.permutation(nb_e)[:nb_sub], (nb_n, 1))
+        else:
+            draw = rng.randint(nb_e, size=(nb_n, nb_e))
+        # The responses of the replicate are fir_all[:, regions, draw], never copied
+        fir_mean = fir_all[:, regions[:, None], draw].mean(axis=2)
+        if opt["std_noise"] > 0:
+            nb_d = draw.shape[1]
+            shifts = np.floor(nb_l * rng.random_sample(nb_d)).astype(int)
+            lags = (np.arange(nb_l)[:, None] + shifts[None, :]) % nb_l
+            null = fir_all[lags[:, None, :], regions[None, :, None], draw[None, :, :]].mean(axis=2)
+            null = null - null.mean(axis=0)
+            std_null = null.std(axis=0, ddof=1)
+            perm = rng.permutation(nb_n)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                null = null[:, perm] * (std_null / std_null[perm])[None, :]
+            fir_mean = fir_mean + opt["std_noise"] * null
+        dist = fir_distance(fir_mean, type_norm, opt["normalize"]["time_sampling"])
+        hier = hierarchical_clustering_vec(-dist, type_sim=opt["clustering"].get("type_sim", "ward"))
+        part = threshold_hierarchy(hier, list(nb_classes))
+        for num_s in range(nb_classes.size):
+            stab[:, num_s] += part[upper[0], num_s] == part[upper[1], num_s]
+    return stab
+
+
+def stability_fir(fir_all, opt, n_workers=1):
+    """
+    Like niak_stability_fir with a hierarchical clustering
+    :param fir_all: the responses (L, N, E)
+    :param opt: nb_classes, nb_samps, std_noise, normalize (type, time_sampling),
+        clustering (type_sim), sampling (type 'bootstrap' or 'subsample', opt)
+    :return: the stability matrices in vector form (N*(N-1)/2, nb scales) and
+        the distance between the average responses
+    """
+    opt = defaults(opt, STABILITY_DEFAULTS)
+    if opt["clustering"].get("type", "hierarchical") != "hierarchical":
+        raise ValueError("{0}: only the hierarchical clustering is available".format(opt["clustering"]["type"]))
+    fir_all = np.ascontiguousarray(fir_all, dtype=np.float64)
+    if fir_all.shape[1] < 2:
+        raise ValueError("at least two regions are needed to cluster, got {0}".format(fir_all.shape[1]))
+    nb_samps = int(opt["nb_samps"])
+    seeds = np.random.RandomState(opt["rand_seed"]).randint(2 ** 31 - 1, size=nb_samps)
+    jobs = [(opt, seeds[start:start + NB_SAMPS_CHUNK]) for start in range(0, nb_samps, NB_SAMPS_CHUNK)]
+    shared = {"fir_all": fir_all, "upper": np.triu_indices(fir_all.shape[1], 1)}
+    stab = sum(run_pool(_stability_chunk, jobs, n_workers, shared)) / float(nb_samps)
+    plugin = fir_distance(fir_all, opt["normalize"]["type"], opt["normalize"]["time_sampling"])
+    return stab, plugin
+
+
+def _field(struct, name):
+    """
+    :return: a field of a struct loaded by scipy.io.loadmat
+    """
+    return struct[name][0, 0] if struct.dtype.names else struct[name]
+
+
+def brick_stability_fir(files_in, files_out, opt=None, n_workers=1):
+    """
+    Python version of niak_brick_stability_fir, for a hierarchical clustering
+    :param files_in: the .mat file of niak_brick_fir_tseries
+    :param files_out: the .mat file with stab, nb_classes, part, hier, order,
+        sil, intra, inter and plugin
+    """
+    log = logging.getLogger(__file__)
+    opt = defaults(opt, STABILITY_DEFAULTS)
+    data = volumes.load_mat(files_in)[opt["network"]]
+    fir_all = np.asarray(_field(data, "fir_all"), dtype=np.float64)
+    fir_all = fir_all.reshape(fir_all.shape[:2] + (-1,))
+    norm = _field(data, "normalize")
+    opt["normalize"] = {"type": str(np.ravel(_field(norm, "type"))[0]),
+                        "time_sampling": float(np.ravel(_field(norm, "time_sampling"))[0])}
+
+    # Events where all regions are zero were rejected (not enough baseline)
+    fir_all = fir_all[:, :, np.abs(fir_all).max(axis=(0, 1)) > 0]
+    nb_classes = np.atleast_1d(opt["nb_classes"]).astype(int)
+    if fir_all.shape[2] < opt["nb_min_fir"]:
+        log.warning("Only {0} events, the stability is set to zero".format(fir_all.shape[2]))
+        nb_n = fir_all.shape[1]
+        stab = np.zeros((nb_n * (nb_n - 1) // 2, nb_classes.size))
+        plugin = np.zeros(nb_n * (nb_n - 1) // 2)
+    else:
+        stab, plugin = stability_fir(fir_all, opt, n_workers)
+
+    part, order, sil, intra, inter, hier, _ = consensus_clustering(
+        stab, type_sim=opt["clustering"].get("type_sim", "ward"))
+    hier_cell = np.empty(len(hier), dtype=object)
+    hier_cell[:] = hier
+    volumes.save_mat(files_out, {"stab": stab, "nb_classes": nb_classes.astype(float), "part": part,
+                                 "hier": hier_cell, "order": order, "sil": sil, "intra": intra,
+                                 "inter": inter, "plugin": plugin})
+    return files_out
+
+
+def region_tseries(fmri, masks):
+    """
+    Like niak_build_tseries: the average time series in each region of each mask
+    :param fmri: an open Volume (x, y, z, T)
+    :param masks: a dictionary of label volumes (x, y, z)
+    :return: a dictionary of arrays (T, nb regions), regions in increasing label order
+    """
+    nb_t = fmri.shape[3]
+    labels = dict((name, np.unique(mask[mask > 0]).astype(int)) for name, mask in masks.items())
+    sums = dict((name, np.zeros((lab.size, nb_t))) for name, lab in labels.items())
+    for z_slice in volumes.slabs(fmri.shape, nb_t * 8 * 2):
+        block = fmri.block(z_slice).reshape(-1, nb_t)
+        for name, mask in masks.items():
+            ind = np.searchsorted(labels[name], mask[:, :, z_slice].ravel())
+            inside = mask[:, :, z_slice].ravel() > 0
+            ind, values = ind[inside], block[inside]
+            if not ind.size:
+                continue
+            sort = np.argsort(ind, kind="stable")
+            ind = ind[sort]
+            starts = np.flatnonzero(np.r_[True, ind[1:] != ind[:-1]])
+            sums[name][ind[starts]] += np.add.reduceat(values[sort], starts, axis=0)
+    out = {}
+    for name, mask in masks.items():
+        size = np.bincount(np.searchsorted(labels[name], mask[mask > 0].astype(int)), minlength=labels[name].size)
+        out[name] = (sums[name] / size[:, None]).T
+    return out
+
+
+def brick_fir_tseries(files_in, files_out, opt=None):
+    """
+    Python version of niak_brick_fir_tseries
+    :param files_in: {"fmri": [runs], "mask": {network: label volume}, "timing": [csv per run]}
+    :param files_out: the .mat file with one struct per network (nb_fir_tot, time_samples,
+        normalize, fir_mean, fir_all)
+    """
+    log = logging.getLogger(__file__)
+    opt = defaults(opt, TSERIES_DEFAULTS)
+    fmri_files = np.atleast_1d(files_in["fmri"]).tolist()
+    timing_files = np.atleast_1d(files_in["timing"]).tolist()
+    if len(timing_files) == 1:
+        timing_files = timing_files * len(fmri_files)
+    masks = {}
+    for name, path in files_in["mask"].items():
+        with volumes.Volume(path) as vol:
+            masks[name] = np.round(vol.read()).astype(int)
+
+    samples = time_samples(opt["time_window"], opt["time_sampling"])
+    fir_tot = dict((name, 0) for name in masks)
+    fir_all_tot = dict((name, []) for name in masks)
+    nb_fir_tot = dict((name, 0) for name in masks)
+    for fmri_file, timing_file in zip(fmri_files, timing_files):
+        log.info("Estimating the FIR of {0}".format(fmri_file))
+        with volumes.Volume(fmri_file) as vol:
+            tseries = region_tseries(vol, masks)
+            extra = vol.extra()
+            nb_t = vol.shape[3]
+            time_frames = np.ravel(extra["time_frames"]) if "time_frames" in extra else np.arange(nb_t) * vol.tr
+            scrub = np.ravel(extra["mask_scrubbing"]).astype(bool) if "mask_scrubbing" in extra \
+                else np.zeros(nb_t, dtype=bool)
+            max_interp = vol.tr if opt["max_interpolation"] is None else opt["max_interpolation"]
+
+        timing, conditions, _ = read_model(timing_file)
+        name_condition = opt["name_condition"] or conditions[0]
+        name_baseline = opt["name_baseline"] or conditions[0]
+        events = np.array([timing[i, 0] for i, c in enumerate(conditions) if c == name_condition])
+        in_baseline = np.zeros(time_frames.size, dtype=bool)
+        for i in [i for i, c in enumerate(conditions) if c == name_baseline]:
+            in_baseline |= (time_frames >= timing[i, 0]) & (time_frames <= timing[i, 0] + timing[i, 1])
+        time_frames, in_baseline = time_frames[~scrub], in_baseline[~scrub]
+
+        opt_fir = {"time_window": opt["time_window"], "time_sampling": opt["time_sampling"],
+                   "max_interpolation": max_interp, "interpolation": opt["interpolation"]}
+        for name in masks:
+            tseries_run = tseries[name][~scrub]
+            fir_mean, nb_fir, fir_all, _ = build_fir(tseries_run, time_frames, events, opt_fir)
+            baseline = tseries_run[in_baseline]
+            if baseline.shape[0] < opt["nb_min_baseline"]:
+                log.warning("{0}: {1} time points in the baseline, the FIR is set to zero".format(
+                    fmri_file, baseline.shape[0]))
+                fir_mean, nb_fir = np.zeros_like(fir_mean), 0
+                fir_all = np.zeros(fir_all.shape[:2] + (0,))
+            else:
+                fir_mean = normalize_fir(fir_mean, baseline, "fir", opt["time_sampling"])
+                fir_all = normalize_fir(fir_all, baseline, "fir", opt["time_sampling"])
+            # The weight of a run is its own number of events for this network
+            fir_tot[name] += nb_fir * fir_mean
+            nb_fir_tot[name] += nb_fir
+            fir_all_tot[name].append(fir_all)
+
+    results = {}
+    for name in masks:
+        fir_mean = fir_tot[name] / nb_fir_tot[name] if nb_fir_tot[name] else fir_tot[name]
+        if opt["type_norm"] == "fir_shape" and nb_fir_tot[name]:
+            fir_mean = normalize_fir(fir_mean, None, "fir_shape", opt["time_sampling"])
+        results[name] = {"nb_fir_tot": float(nb_fir_tot[name]), "time_samples": samples,
+                         "normalize": {"time_sampling": float(opt["time_sampling"]), "type": opt["type_norm"]},
+                         "fir_mean": fir_mean, "fir_all": np.concatenate(fir_all_tot[name], axis=2)}
+    volumes.save_mat(files_out, results)
+    return files_out
@@ -0,0 +1,434 @@
+"""
+Hierarchical clustering on similarity matrices, in the format of
+niak_hierarchical_clustering.
+
+A hierarchy is an array (N-1, 4), one row per merge: the similarity of
+the merge, the two entities merged and the new entity. Entities are
+numbered from 1 like in octave: 1 to N for the objects, N+1, N+2, ... for
+the clusters in the order they are formed.
+
+hierarchical_clustering follows the octave code on a square matrix.
+hierarchical_clustering_vec works on the vector form of the matrix (see
+mat2vec), N*(N-1)/2 values, and is quadratic in N: single linkage is a
+maximum spanning tree (Prim), complete, average and Ward linkage use the
+nearest-neighbour chain, which is exact for these reducible linkages. The
+merges are then sorted by decreasing similarity and numbered like the
+octave ones, so the two functions give the same hierarchy up to ties.
+"""
+__author__ = 'poquirion'
+
+import logging
+
+import numpy as np
+
+LINKAGES = ["single", "complete", "average", "ward"]
+
+
+def hierarchical_clustering(sim, p=None, type_sim="ward", nb_classes=1):
+    """
+    Agglomerative clustering like niak_hierarchical_clustering: the pair of
+    clusters with the largest similarity is merged, and the similarity of
+    the new cluster with the others follows the Lance-Williams formula of
+    type_sim. The nearest neighbour of every cluster is kept up to date, so
+    that each merge costs a pass over one row of the matrix plus the
+    clusters whose neighbour was merged.
+
+    :param sim: a symmetric (N, N) similarity matrix, overwritten
+    :param p: the size of each object, ones by default
+    :param type_sim: 'single', 'complete', 'average' or 'ward'
+    :param nb_classes: stop when that many clusters are left
+    :return: the hierarchy, an array (N - nb_classes, 4)
+    """
+    if type_sim not in LINKAGES:
+        raise ValueError("{0} is an unknown type of cluster-level similarity".format(type_sim))
+    sim = np.asarray(sim, dtype=np.float64)
+    n = sim.shape[0]
+    p = np.ones(n) if p is None else np.array(p, dtype=np.float64).ravel()
+    np.fill_diagonal(sim, -np.inf)
+    nn = np.argmax(sim, axis=0)
+    max_sim = sim[nn, np.arange(n)]
+    objects = np.arange(1, n + 1)
+    alive = np.ones(n, dtype=bool)
+    next_object = n + 1
+
+    nb_iter = max(n - nb_classes, 0)
+    hier = np.zeros((nb_iter, 4))
+    log = logging.getLogger(__file__)
+    for num_i in range(nb_iter):
+        if num_i and num_i % max(1, nb_iter // 20) == 0:
+            log.debug("Hierarchical clustering: {0:.0f}% done".format(100. * num_i / nb_iter))
+        i = int(np.argmax(max_sim))
+        j = int(nn[i])
+        cx, cy = min(i, j), max(i, j)
+        s_xy = sim[cx, cy]
+        hier[num_i] = [s_xy, objects[cx], objects[cy], next_object]
+
+        if type_sim == "complete":
+            row = np.minimum(sim[cx], sim[cy])
+        elif type_sim == "single":
+            row = np.maximum(sim[cx], sim[cy])
+        elif type_sim == "average":
+            row = (p[cx] * sim[cx] + p[cy] * sim[cy]) / (p[cx] + p[cy])
+        else:
+            row = ((p + p[cx]) * sim[cx] + (p + p[cy]) * sim[cy] - p * s_xy) / (p + p[cx] + p[cy])
+        row[~alive] = -np.inf
+        row[[cx, cy]] = -np.inf
+        sim[cx] = row
+        sim[:, cx] = row
+        sim[cy] = -np.inf
+        sim[:, cy] = -np.inf
+        alive[cy] = False
+        max_sim[cy] = -np.inf
+
+        # Clusters whose nearest neighbour was merged look for a new one
+        stale = np.flatnonzero(alive & ((nn == cx) | (nn == cy)))
+        if stale.size:
+            nn[stale] = np.argmax(sim[:, stale], axis=0)
+            max_sim[stale] = sim[nn[stale], stale]
+        closer = row > max_sim
+        nn[closer] = cx
+        max_sim[closer] = row[closer]
+        nn[cx] = np.argmax(row)
+        max_sim[cx] = row[nn[cx]]
+
+        p[cx] += p[cy]
+        objects[cx] = next_object
+        next_object += 1
+    return hier
+
+
+def vec_index(n, i, others):
+    """
+    :return: the position in a vector (see mat2vec) of the entries (i, others)
+        of an (n, n) matrix
+    """
+    a = np.minimum(i, others)
+    b = np.maximum(i, others)
+    return n * a - a * (a + 1) // 2 + b - a - 1
+
+
+def _sort_merges(merges, n, chain=True):
+    """
+    Number the merges of a spanning tree or of a nearest-neighbour chain
+    like the octave hierarchy
+    :param merges: a list of (similarity, x, y), x and y are objects (from 0)
+        standing for the clusters they belong to when the merge happens
+    :param chain: the merges come from _nn_chain, x and y are where the
+        clusters are stored
+    """
+    level = np.array([m[0] for m in merges], dtype=np.float64)
+    if chain:
+        # A merge can not be listed before the ones it depends on, even when
+        # rounding makes its similarity a little larger
+        slot_merge = -np.ones(n, dtype=int)
+        for num_m, (s_xy, x, y) in enumerate(merges):
+            level[num_m] = min([s_xy] + [level[slot_merge[c]] for c in (x, y) if slot_merge[c] >= 0])
+            slot_merge[x] = slot_merge[y] = num_m
+    parent = np.arange(n)
+    label = np.arange(1, n + 1)
+
+    def root(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    hier = np.zeros((len(merges), 4))
+    for num_m, ind in enumerate(np.argsort(-level, kind="stable")):
+        s_xy, x, y = merges[ind]
+        rx, ry = root(x), root(y)
+        # Like in octave, the first entity is the cluster with the lowest object
+        if ry < rx:
+            rx, ry = ry, rx
+        hier[num_m] = [s_xy, label[rx], label[ry], n + 1 + num_m]
+        parent[ry] = rx
+        label[rx] = n + 1 + num_m
+    return hier
+
+
+def hierarchical_clustering_vec(sim, p=None, type_sim="ward"):
+    """
+    Agglomerative clustering on a similarity matrix in vector form, in
+    O(N^2) time and without the square matrix, see the module docstring
+    :param sim: the similarity matrix in vector form (N*(N-1)/2,), overwritten
+        for complete, average and Ward linkage
+    :param p: the size of each object, ones by default
+    :param type_sim: 'single', 'complete', 'average' or 'ward'
+    :return: the hierarchy, an array (N-1, 4)
+    """
+    if type_sim not in LINKAGES:
+        raise ValueError("{0} is an unknown type of cluster-level similarity".format(type_sim))
+    sim = np.asarray(sim, dtype=np.float64).ravel()
+    n = int(round((1 + np.sqrt(1 + 8 * sim.size)) / 2))
+    if n * (n - 1) // 2 != sim.size:
+        raise ValueError("{0} values do not make a similarity matrix in vector form".format(sim.size))
+    if type_sim == "single":
+        return _sort_merges(_max_spanning_tree(sim, n), n, chain=False)
+    return _sort_merges(_nn_chain(sim, n, p, type_sim), n)
+
+
+def _max_spanning_tree(sim, n):
+    """
+    Prim's algorithm, the edges of the tree are the single linkage merges
+    """
+    merges = []
+    outside = np.ones(n, dtype=bool)
+    outside[0] = False
+    best = np.full(n, -np.inf)
+    best_from = np.zeros(n, dtype=int)
+    last = 0
+    for _ in range(n - 1):
+        others = np.flatnonzero(outside)
+        values = sim[vec_index(n, last, others)]
+        closer = values > best[others]
+        best[others[closer]] = values[closer]
+        best_from[others[closer]] = last
+        nxt = others[np.argmax(best[others])]
+        merges.append((best[nxt], best_from[nxt], nxt))
+        outside[nxt] = False
+        last = nxt
+    return merges
+
+
+def _nn_chain(sim, n, p, type_sim):
+    """
+    The nearest-neighbour chain: follow nearest neighbours until two
+    clusters are each other's, and merge them. A cluster is stored at the
+    position of its lowest object.
+    """
+    p = np.ones(n) if p is None else np.array(p, dtype=np.float64).ravel()
+    alive = np.ones(n, dtype=bool)
+    merges = []
+    chain = []
+    log = logging.getLogger(__file__)
+    while len(merges) < n - 1:
+        if not chain:
+            chain.append(int(np.argmax(alive)))
+        x = chain[-1]
+        others = np.flatnonzero(alive)
+        others = others[others != x]
+        values = sim[vec_index(n, x, others)]
+        y = int(others[np.argmax(values)])
+        # On ties, the previous cluster of the chain wins so the chain ends
+        if len(chain) > 1 and sim[vec_index(n, x, chain[-2])] >= values.max():
+            y = chain[-2]
+        if len(chain) < 2 or y != chain[-2]:
+            chain.append(y)
+            continue
+
+        chain = chain[:-2]
+        cx, cy = min(x, y), max(x, y)
+        s_xy = sim[vec_index(n, cx, cy)]
+        merges.append((s_xy, cx, cy))
+        alive[cy] = False
+        others = np.flatnonzero(alive)
+        others = others[others != cx]
+        ind_x, ind_y = vec_index(n, cx, others), vec_index(n, cy, others)
+        if type_sim == "complete":
+            row = np.minimum(sim[ind_x], sim[ind_y])
+        elif type_sim == "average":
+            row = (p[cx] * sim[ind_x] + p[cy] * sim[ind_y]) / (p[cx] + p[cy])
+        else:
+            po = p[others]
+            row = ((po + p[cx]) * sim[ind_x] + (po + p[cy]) * sim[ind_y] - po * s_xy) / (po + p[cx] + p[cy])
+        sim[ind_x] = row
+        p[cx] += p[cy]
+        if len(merges) % max(1, (n - 1) // 20) == 0:
+            log.debug("Hierarchical clustering: {0:.0f}% done".format(100. * len(merges) / (n - 1)))
+    return merges
+
+
+def threshold_hierarchy(hier, nb_classes):
+    """
+    Like niak_threshold_hierarchy with the 'nb_classes' type
+    :param nb_classes: the number of clusters, or a list of numbers
+    :return: the partition, clusters numbered from 1. An array (N,) for one
+        number of clusters, (N, len(nb_classes)) for a list
+    """
+    hier = np.asarray(hier)
+    n = int(hier[0, 3]) - 1
+    thresh = np.minimum(np.sort(np.atleast_1d(nb_classes)), n)
+    parent = np.arange(2 * n + 1)
+    parts = {}
+    nb_merges = n - int(thresh[0])
+    for num_m in range(nb_merges + 1):
+        if n - num_m in thresh:
+            labels = parent[np.arange(1, n + 1)]
+            while True:
+                up = parent[labels]
+                if np.array_equal(up, labels):
+                    break
+                labels = up
+            parts[n - num_m] = np.unique(labels, return_inverse=True)[1].ravel() + 1
+        if num_m < nb_merges:
+            x, y, z = [int(v) for v in hier[num_m, 1:4]]
+            parent[x] = z
+            parent[y] = z
+    if np.isscalar(nb_classes):
+        return parts[min(int(nb_classes), n)]
+    return np.column_stack([parts[min(int(t), n)] for t in np.atleast_1d(nb_classes)])
+
+
+def hier2order(hier):
+    """
+    Like niak_hier2order
+    :return: the objects (from 1) in the order of the leaves of the dendrogram
+    """
+    hier = np.asarray(hier)
+    children = dict((int(h[3]), (int(h[1]), int(h[2]))) for h in hier)
+    order = []
+    stack = [int(hier[-1, 3])]
+    while stack:
+        node = stack.pop()
+        if node in children:
+            stack.extend(reversed(children[node]))
+        else:
+            order.append(node)
+    return np.array(order)
+
+
+def mat2vec(mat):
+    """
+    Like niak_mat2vec
+    :return: the entries below the diagonal of a symmetric matrix
+    """
+    return mat[np.triu_indices(mat.shape[0], 1)]
+
+
+def vec2mat(vec, val_diag=1.):
+    """
+    Like niak_vec2mat, for one vector
+    """
+    n = int(round((1 + np.sqrt(1 + 8 * len(vec))) / 2))
+    mat = np.zeros((n, n))
+    upper = np.triu_indices(n, 1)
+    mat[upper] = vec
+    mat[upper[::-1]] = vec
+    np.fill_diagonal(mat, val_diag)
+    return mat
+
+
+def avg_silhouette(mat, hier):
+    """
+    Like niak_build_avg_silhouette
+    :return: the average silhouette, within- and between-cluster similarity
+        for every number of clusters (index k - 1 for k clusters)
+    """
+    n = mat.shape[0]
+    within = np.zeros(n)
+    between = np.array(mat, dtype=np.float64)
+    np.fill_diagonal(between, -np.inf)
+    list_nn = np.argmax(between, axis=1)
+    score_nn = between[np.arange(n), list_nn]
+    sil, intra, inter = np.zeros(n), np.zeros(n), np.zeros(n)
+    inter[n - 1] = score_nn.mean()
+    sil[n - 1] = -inter[n - 1]
+    part = np.arange(1, n + 1)
+    siz = np.ones(n)
+    labels = np.arange(1, n + 1, dtype=np.float64)
+    mask_clust = np.ones(n, dtype=bool)
+    for num_i in range(1, n - 1):
+        num_c = n - num_i
+        cx, cy, cz = hier[num_i - 1, 1:4]
+        mask_x = part == cx
+        mask_y = part == cy
+        indx = np.flatnonzero(labels == cx)[0]
+        indy = np.flatnonzero(labels == cy)[0]
+        part[mask_x | mask_y] = cz
+        labels[indx] = cz
+        labels[indy] = np.nan
+        nx, ny = siz[indx], siz[indy]
+        siz[indx] = nx + ny
+        siz[indy] = np.nan
+        mask_clust[indy] = False
+        within[indx] += within[indy] + mat[np.ix_(mask_x, mask_y)].sum()
+        between[:, indx] = (nx * between[:, indx] + ny * between[:, indy]) / (nx + ny)
+        between[:, indy] = -np.inf
+        mask_up = (list_nn == indx) | (list_nn == indy)
+        list_clust = np.flatnonzero(mask_clust)
+        sub = between[np.ix_(mask_up, mask_clust)]
+        list_nn[mask_up] = list_clust[np.argmax(sub, axis=1)]
+        score_nn[mask_up] = sub.max(axis=1)
+        weig = siz[mask_clust]
+        weig = np.where(weig > 1, 1. / np.maximum(weig - 1, 1), 0)
+        intra[num_c - 1] = 2 * np.sum(weig * within[mask_clust]) / n
+        inter[num_c - 1] = score_nn.sum() / n
+        sil[num_c - 1] = intra[num_c - 1] - inter[num_c - 1]
+    return sil, intra, inter
+
+
+def part2order(part, sim):
+    """
+    Like niak_part2order: clusters are ordered so that the most similar are
+    next to each other, and the objects of a cluster by their similarity with
+    the neighbouring clusters
+    :return: the order of the objects (from 1), and the partition with the
+        clusters renumbered in that order
+    """
+    part = np.asarray(part).ravel().astype(int)
+    if part.max() == 1:
+        return np.arange(1, part.size + 1), part
+    labels = np.unique(part[part > 0])
+    if labels.size != labels.max():
+        relabel = np.zeros(part.max() + 1, dtype=int)
+        relabel[labels] = np.arange(1, labels.size + 1)
+        part = relabel[part]
+    nb_classes = part.max()
+    sim_c = np.full((nb_classes, nb_classes), -np.inf)
+    for num_c1 in range(nb_classes):
+        for num_c2 in range(num_c1):
+            sim_c[num_c1, num_c2] = sim_c[num_c2, num_c1] = sim[np.ix_(part == num_c1 + 1, part == num_c2 + 1)].mean()
+
+    part_order = np.zeros(part.size, dtype=int)
+    order_c = np.zeros(nb_classes, dtype=int)
+    for num_c in range(1, nb_classes):
+        if num_c == 1:
+            val = -np.sort(-sim_c, axis=0)
+            ind1 = int(np.argmax(val[0] - val[1]))
+            order_c[0] = ind1
+            part_order[part == ind1 + 1] = 1
+        else:
+            ind1 = order_c[num_c - 1]
+        ind2 = int(np.argmax(sim_c[ind1]))
+        order_c[num_c] = ind2
+        part_order[part == ind2 + 1] = num_c + 1
+        sim_c[ind1, :] = -np.inf
+        sim_c[:, ind1] = -np.inf
+
+    order = []
+    for num_c, label_c in enumerate(order_c):
+        ind_c = np.flatnonzero(part == label_c + 1)
+        same = sim[np.ix_(ind_c, ind_c)].mean(axis=1)
+        x = same - sim[np.ix_(ind_c, np.flatnonzero(part == order_c[num_c - 1] + 1))].mean(axis=1) \
+            if num_c > 0 else 0
+        y = same - sim[np.ix_(ind_c, np.flatnonzero(part == order_c[num_c + 1] + 1))].mean(axis=1) \
+            if num_c < nb_classes - 1 else 0
+        order.append(ind_c[np.argsort(x - y, kind="stable")] + 1)
+    return np.concatenate(order), part_order
+
+
+def consensus_clustering(stab, nb_classes=None, type_sim="ward"):
+    """
+    Like niak_consensus_clustering with a hierarchical clustering
+    :param stab: stability matrices in vector form, (N*(N-1)/2, nb_s)
+    :param nb_classes: the number of clusters for each matrix, picked at the
+        maximum of the average silhouette if None
+    :return: part, order, sil, intra, inter (arrays (N, nb_s)), the list of
+        hierarchies and the number of clusters
+    """
+    stab = np.asarray(stab).reshape(len(stab), -1)
+    nb_s = stab.shape[1]
+    n = int(round((1 + np.sqrt(1 + 8 * stab.shape[0])) / 2))
+    part, order, sil, intra, inter = [np.zeros((n, nb_s)) for _ in range(5)]
+    hier = []
+    nb_final = np.zeros(nb_s, dtype=int)
+    for num_s in range(nb_s):
+        mat = vec2mat(stab[:, num_s])
+        hier.append(hierarchical_clustering_vec(stab[:, num_s].copy(), type_sim=type_sim))
+        if nb_classes is None:
+            sil[:, num_s], intra[:, num_s], inter[:, num_s] = avg_silhouette(mat, hier[-1])
+            nb_final[num_s] = np.argmax(sil[:, num_s]) + 1
+        else:
+            nb_final[num_s] = np.atleast_1d(nb_classes)[num_s]
+        order[:, num_s], part[:, num_s] = part2order(threshold_hierarchy(hier[-1], int(nb_final[num_s])), mat)
+    return part, order, sil, intra, inter, hier, nb_final
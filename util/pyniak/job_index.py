@@ -0,0 +1,342 @@
+"""
+An index of the jobs of a PSOM pipeline, kept in a SQLite file of the logs
+folder.
+
+Knowing the state of a job otherwise means loading PIPE_status.mat, which
+has one variable per job, and listing the tag files of the logs folder
+(<job>.running, .failed, .finished). With opt.granularity = 'max' on a
+large cohort that is tens of thousands of jobs for every question.
+
+JobIndex.update only looks at what changed since the previous update: a tag
+or log file whose modification time differs from the one recorded, a file
+that was removed, PIPE_status.mat or PIPE_jobs.mat if they were saved
+again. Only the jobs touched by these changes are recomputed, so the index
+can be refreshed every few seconds while the pipeline runs (see
+pyniak.metrics.ProgressMonitor). The state of a job is its latest tag, or
+the PSOM status when there is no tag. The stage and the subject of a job are
+parsed from its name, with the JOB_STAGES table of the pipeline classes for
+the jobs NIAK does not name after their stage (sica_*, smooth_*, ...), and
+the brick from its command in PIPE_jobs.mat.
+For a failed job the end of its log is kept as exit information.
+
+Queries are plain SQL on indexed columns, e.g. the subjects that failed in
+corsica:
+
+    SELECT DISTINCT subject FROM jobs WHERE stage = 'corsica' AND status = 'failed'
+"""
+__author__ = 'poquirion'
+
+import collections
+import logging
+import os
+import re
+import sqlite3
+import time
+
+import pyniak.load_pipeline
+
+INDEX_FILE = "niak_jobs.sqlite"
+PIPE_STATUS = "PIPE_status.mat"
+PIPE_JOBS = "PIPE_jobs.mat"
+TAGS = {".running": "running", ".failed": "failed", ".finished": "finished"}
+LOG = ".log"
+# Characters of the end of the log kept for failed jobs
+LOG_TAIL = 2000
+STATUSES = ["none", "submitted", "running", "failed", "finished"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (name TEXT PRIMARY KEY, stage TEXT, subject TEXT, brick TEXT,
+                                 status TEXT, psom_status TEXT, started REAL, ended REAL,
+                                 updated REAL, exit_info TEXT);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, job TEXT, kind TEXT, mtime REAL);
+CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime REAL);
+CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage, status);
+CREATE INDEX IF NOT EXISTS jobs_subject ON jobs (subject, status);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+
+def job_stages():
+    """
+    :return: [(job name prefix, stage)] for all the supported pipelines,
+        longest prefix first. A stage is the prefix of its own jobs unless
+        JOB_STAGES says otherwise.
+    """
+    table = {}
+    for cls in pyniak.load_pipeline.PIPELINE_CLASSES.values():
+        table.update((stage, stage) for stage in cls.STAGES)
+    for cls in pyniak.load_pipeline.PIPELINE_CLASSES.values():
+        table.update(cls.JOB_STAGES)
+    return sorted(table.items(), key=lambda item: len(item[0]), reverse=True)
+
+
+def split_job_name(name, stages=None):
+    """
+    NIAK names its jobs <prefix>_<subject>[_<session>_<run>], for example
+    component_sel_ventricle_subject1_session1_rest. The stage is the one of
+    the longest known prefix the name starts with, the subject is the first
+    part of the name after it that holds a digit. The first parts of an
+    unknown name are used as its stage.
+    :param stages: [(job name prefix, stage)], see job_stages
+    :return: stage, subject (None if there is no such part)
+    """
+    stages = job_stages() if stages is None else stages
+    prefix, stage = next(((p, s) for p, s in stages if name == p or name.startswith(p + "_")), (None, None))
+    parts = name[len(prefix) + 1:].split("_") if prefix else name.split("_")
+    num_subject = next((i for i, p in enumerate(parts) if re.search(r"\d", p)), None)
+    if stage is None:
+        stage = "_".join(parts[:num_subject]) if num_subject else name
+    subject = parts[num_subject] if num_subject is not None else None
+    return stage, subject
+
+
+def read_tail(path, size=LOG_TAIL):
+    """
+    :return: the end of a text file
+    """
+    try:
+        with open(path, "rb") as fp:
+            fp.seek(0, os.SEEK_END)
+            fp.seek(max(0, fp.tell() - size))
+            return fp.read().decode("utf-8", "replace").strip()
+    except (IOError, OSError):
+        return None
+
+
+def reset_jobs(path_logs, names):
+    """
+    Set the PSOM status of jobs back to "none" and remove their tags, so that
+    the next run of the pipeline runs these jobs again, and only them.
+    opt.psom.restart is not used for this: PSOM matches its entries as
+    substrings of the job names (corsica_subject1 restarts
+    corsica_subject10 as well) and restarts all their children.
+    :return: the names of the jobs that were reset
+    """
+    # Imported here, scipy is only needed to rewrite PIPE_status.mat
+    import pyniak.volumes
+
+    names = set(names)
+    reset = set()
+    path = os.path.join(path_logs, PIPE_STATUS)
+    if os.path.exists(path):
+        status = pyniak.volumes.load_mat(path)
+        reset = names & set(status)
+        if reset:
+            for job in reset:
+                status[job] = "none"
+            pyniak.volumes.save_mat(path, status)
+    for dirpath, dirnames, filenames in os.walk(path_logs):
+        for f in filenames:
+            job, ext = os.path.splitext(f)
+            if ext in TAGS and job in names:
+                os.remove(os.path.join(dirpath, f))
+                reset.add(job)
+    return sorted(reset)
+
+
+class JobIndex(object):
+    """
+    The SQLite index of the jobs of a pipeline
+
+    :param path_logs: the PSOM logs folder of the pipeline
+    :param path_db: the index file, path_logs/niak_jobs.sqlite by default
+    """
+
+    def __init__(self, path_logs, path_db=None):
+        self.log = logging.getLogger(__file__)
+        self.path_logs = path_logs
+        self.path_db = path_db or os.path.join(path_logs, INDEX_FILE)
+        self.stages = job_stages()
+        # The names of the jobs in the index, read at the first update
+        self._names = None
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            # Jobs indexed with another table of stages
+            rows = []
+            for name, stage, subject in db.execute("SELECT name, stage, subject FROM jobs").fetchall():
+                parsed = split_job_name(name, self.stages)
+                if parsed != (stage, subject):
+                    rows.append(parsed + (name,))
+            db.executemany("UPDATE jobs SET stage = ?, subject = ? WHERE name = ?", rows)
+
+    def _connect(self):
+        # One connection per call, updates run in the thread of the monitor
+        db = sqlite3.connect(self.path_db, timeout=60)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.DatabaseError:
+            pass
+        return db
+
+    def scan(self):
+        """
+        :return: {path: (job, kind, mtime)} for the tag and log files of the logs folder
+        """
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(self.path_logs):
+            for f in filenames:
+                job, ext = os.path.splitext(f)
+                if ext not in TAGS and (ext != LOG or job.startswith("PIPE")):
+                    continue
+                path = os.path.join(dirpath, f)
+                try:
+                    found[path] = (job, TAGS.get(ext, "log"), os.path.getmtime(path))
+                except OSError:
+                    continue
+        return found
+
+    def _source(self, db, name):
+        """
+        :return: the path of a PSOM file if it changed since the last update, else None
+        """
+        path = os.path.join(self.path_logs, name)
+        if not os.path.exists(path):
+            return None
+        mtime = os.path.getmtime(path)
+        row = db.execute("SELECT mtime FROM sources WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == mtime:
+            return None
+        db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (path, mtime))
+        return path
+
+    def _read_psom(self, db, changed):
+        """
+        Reload PIPE_status.mat and PIPE_jobs.mat if they were saved since the last update
+        """
+        # Imported here, scipy is only needed when PSOM saved its files again
+        import numpy as np
+        import pyniak.volumes
+
+        path = self._source(db, PIPE_STATUS)
+        if path is not None:
+            status = dict((job, str(np.ravel(value)[0]) if np.size(value) else "none")
+                          for job, value in pyniak.volumes.load_mat(path).items())
+            previous = dict(db.execute("SELECT name, psom_status FROM jobs"))
+            self._add_jobs(db, status)
+            update = [(s, job) for job, s in status.items() if previous.get(job) != s]
+            db.executemany("UPDATE jobs SET psom_status = ? WHERE name = ?", update)
+            changed.update(job for _, job in update)
+
+        path = self._source(db, PIPE_JOBS)
+        if path is not None:
+            bricks = {}
+            for job, value in pyniak.volumes.load_mat(path).items():
+                try:
+                    command = str(np.ravel(value["command"][0, 0])[0])
+                except (KeyError, IndexError, ValueError, TypeError):
+                    continue
+                match = re.match(r"\s*(\w+)\s*\(", command)
+                bricks[job] = match.group(1) if match else None
+            self._add_jobs(db, bricks)
+            db.executemany("UPDATE jobs SET brick = ? WHERE name = ?", [(b, j) for j, b in bricks.items()])
+
+    def _add_jobs(self, db, names):
+        """
+        Add the jobs that are not in the index yet
+        """
+        if self._names is None:
+            self._names = set(row[0] for row in db.execute("SELECT name FROM jobs"))
+        rows = []
+        for name in set(names) - self._names:
+            stage, subject = split_job_name(name, self.stages)
+            rows.append((name, stage, subject, "none"))
+        self._names.update(name for name, _, _, _ in rows)
+        db.executemany("INSERT OR IGNORE INTO jobs (name, stage, subject, status) VALUES (?, ?, ?, ?)", rows)
+
+    def update(self):
+        """
+        Bring the index up to date with the logs folder
+        :return: the number of jobs whose state was recomputed
+        """
+        now = time.time()
+        found = self.scan()
+        with self._connect() as db:
+            known = dict((path, (job, mtime)) for path, job, mtime in db.execute("SELECT path, job, mtime FROM files"))
+            new = [(path, job, kind, mtime) for path, (job, kind, mtime) in found.items()
+                   if known.get(path, (None, None))[1] != mtime]
+            removed = [(path, known[path][0]) for path in set(known) - set(found)]
+            db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", new)
+            db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path, _ in removed])
+            changed = set(job for _, job, _, _ in new) | set(job for _, job in removed)
+            self._read_psom(db, changed)
+            self._add_jobs(db, changed)
+            if not changed:
+                return 0
+
+            files = collections.defaultdict(dict)
+            for path, (job, kind, mtime) in found.items():
+                if job in changed:
+                    files[job][kind] = (mtime, path)
+            rows = []
+            for job in changed:
+                psom_status, started, ended, exit_info = db.execute(
+                    "SELECT psom_status, started, ended, exit_info FROM jobs WHERE name = ?", (job,)).fetchone()
+                tags = dict((k, v) for k, v in files[job].items() if k in TAGS.values())
+                if tags:
+                    status = max(tags, key=lambda k: (tags[k][0], STATUSES.index(k)))
+                else:
+                    status = psom_status or "none"
+                # The running tag is removed when the job ends, its time is kept
+                if "running" in tags:
+                    started = tags["running"][0]
+                if status in ["failed", "finished"]:
+                    ended = tags[status][0] if status in tags else ended
+                else:
+                    ended = None
+                if status == "failed" and "log" in files[job]:
+                    exit_info = read_tail(files[job]["log"][1])
+                elif status != "failed":
+                    exit_info = None
+                rows.append((status, started, ended, now, exit_info, job))
+            db.executemany("UPDATE jobs SET status = ?, started = ?, ended = ?, updated = ?, exit_info = ? "
+                           "WHERE name = ?", rows)
+        self.log.debug("Job index: {0} jobs updated".format(len(rows)))
+        return len(rows)
+
+    def _where(self, status=None, stage=None, subject=None):
+        clauses, values = [], []
+        for column, value in [("status", status), ("stage", stage), ("subject", subject)]:
+            if value is not None:
+                clauses.append("{0} = ?".format(column))
+                values.append(value)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), values
+
+    def jobs(self, status=None, stage=None, subject=None):
+        """
+        :return: the jobs matching all the criteria that are set, a list of dictionaries
+        """
+        where, values = self._where(status, stage, subject)
+        columns = ["name", "stage", "subject", "brick", "status", "started", "ended", "exit_info"]
+        with self._connect() as db:
+            rows = db.execute("SELECT {0} FROM jobs{1} ORDER BY name".format(", ".join(columns), where), values)
+            return [dict(zip(columns, row)) for row in rows]
+
+    def subjects(self, status=None, stage=None):
+        """
+        :return: the subjects that have at least one job matching the criteria
+        """
+        where, values = self._where(status, stage)
+        where += " AND subject IS NOT NULL" if where else " WHERE subject IS NOT NULL"
+        with self._connect() as db:
+            return [row[0] for row in
+                    db.execute("SELECT DISTINCT subject FROM jobs{0} ORDER BY subject".format(where), values)]
+
+    def summary(self, by="stage"):
+        """
+        :param by: 'stage' or 'subject'
+        :return: {group: {status: number of jobs}}
+        """
+        if by not in ["stage", "subject"]:
+            raise ValueError("{0}: jobs are grouped by stage or subject".format(by))
+        counts = collections.OrderedDict()
+        with self._connect() as db:
+            for group, status, count in db.execute(
+                    "SELECT {0}, status, COUNT(*) FROM jobs GROUP BY {0}, status ORDER BY {0}".format(by)):
+                counts.setdefault(group, {})[status] = count
+        return counts
+
+    def failed_jobs(self, stage=None):
+        """
+        :return: the names of the failed jobs, to restart only them
+        """
+        return [job["name"] for job in self.jobs(status="failed", stage=stage)]
@@ -0,0 +1,492 @@
+"""
+K-means backend of the stability bricks, see niak_kmeans_clustering,
+niak_kmeans_cores, niak_stability_tseries and the surfstab bricks.
+
+The objects to cluster are the columns of a (T, N) array, like in octave.
+A bootstrap, jacknife or subsampling replicate of the rows is not copied:
+it is a weight per row (the number of times the row is drawn), and a
+Kernel computes the squared distances, centroids and correlations of the
+weighted (and normalized) columns from the original array. The squared
+norm of the columns is computed once per replicate, and every distance is
+a matrix product with the centroids, by chunks of columns. All replicates
+and all starts share the same array.
+
+Starts are seeded with (greedy) k-means++. With a batch_size, the centroids are
+updated on random batches of columns (mini-batch k-means) and the
+partition is the assignment of all columns to the final centroids, which
+is what makes vertex or voxel level data practical. Otherwise Lloyd
+iterations run until the proportion of objects changing cluster falls
+below convergence_rate. Of several starts, the one with the lowest
+within-cluster inertia is kept, the same as the largest inter-cluster
+inertia used by niak_kmeans_clustering. Starts, and replicates in the
+stability functions, run over a process pool.
+
+Clusters that lose all their objects keep their previous centroid
+(type_death 'none' in octave resets it to zero).
+"""
+__author__ = 'poquirion'
+
+import logging
+
+import numpy as np
+
+import pyniak.volumes as volumes
+from pyniak.common import SHARED, defaults, run_pool
+from pyniak.common import normalize as normalize_tseries
+from pyniak.hierarchy import hierarchical_clustering_vec, threshold_hierarchy
+
+KMEANS_DEFAULTS = {"nb_classes": None, "nb_iter": 1, "nb_iter_max": 50, "convergence_rate": 0.01,
+                   "type_init": "kmeans++", "batch_size": None, "p": None}
+STABILITY_DEFAULTS = {"nb_classes": None, "nb_samps": 100, "normalize": {}, "clustering": {}, "sampling": {},
+                      "rand_seed": None}
+SURF_DEFAULTS = {"scale_rep": [], "scale_tar": [], "nb_samps": 100, "clustering": {}, "sampling": {},
+                 "name_data": "data", "name_part": "part", "rand_seed": None}
+# Memory used by a chunk of columns when distances are computed
+CHUNK_BYTES = 64 * 1024 ** 2
+
+
+class Kernel(object):
+    """
+    The columns of data (T, N), with a weight for each row and normalized
+    like niak_normalize_tseries ('none', 'mean' or 'mean_var', weighted
+    mean and std). A column z_v is seen as the vector sqrt(w) * z_v.
+    """
+
+    def __init__(self, data, weights=None, normalize="none"):
+        self.data = data
+        nb_t, self.n = data.shape
+        self.w = np.ones(nb_t) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.sum_w = self.w.sum()
+        self.step = max(1, int(CHUNK_BYTES // (8 * nb_t)))
+        sum_x = np.zeros(self.n)
+        sum_x2 = np.zeros(self.n)
+        for cols in self.chunks():
+            x = np.asarray(data[:, cols], dtype=np.float64)
+            sum_x[cols] = self.w.dot(x)
+            sum_x2[cols] = self.w.dot(x ** 2)
+        mean = sum_x / self.sum_w
+        var = np.maximum(sum_x2 - self.sum_w * mean ** 2, 0)
+        self.m = mean if normalize in ["mean", "mean_var"] else np.zeros(self.n)
+        self.s_inv = np.ones(self.n)
+        if normalize == "mean_var":
+            std = np.sqrt(var / max(self.sum_w - 1, 1))
+            self.s_inv[std > 0] = 1. / std[std > 0]
+        elif normalize not in ["none", "mean"]:
+            raise ValueError("{0}: unknown type of normalization".format(normalize))
+        self.norm2 = self.s_inv ** 2 * (sum_x2 - 2 * self.m * sum_x + self.sum_w * self.m ** 2)
+        # Weighted sum of squares of the centred normalized columns, for correlations
+        self.var_z = self.s_inv ** 2 * var
+
+    def chunks(self, cols=None):
+        n = self.n if cols is None else len(cols)
+        for start in range(0, n, self.step):
+            stop = min(start + self.step, n)
+            yield slice(start, stop) if cols is None else cols[start:stop]
+
+    def columns(self, cols):
+        """
+        :return: the normalized columns, an array (T, len(cols))
+        """
+        return (np.asarray(self.data[:, cols], dtype=np.float64) - self.m[cols]) * self.s_inv[cols]
+
+    def cross(self, centers, cols=None):
+        """
+        :param centers: an array (T, K)
+        :return: the weighted products of the columns with the centers, (n_cols, K)
+        """
+        wc = self.w[:, None] * centers
+        cols = np.arange(self.n) if cols is None else np.asarray(cols)
+        out = np.empty((cols.size, centers.shape[1]))
+        pos = 0
+        for chunk in self.chunks(cols):
+            x = np.asarray(self.data[:, chunk], dtype=np.float64)
+            out[pos:pos + len(chunk)] = (x.T.dot(wc) - np.outer(self.m[chunk], wc.sum(axis=0))) \
+                * self.s_inv[chunk, None]
+            pos += len(chunk)
+        return out
+
+    def dist(self, centers, cols=None):
+        """
+        :return: the squared distances of the columns to the centers, (n_cols, K)
+        """
+        norm2 = self.norm2 if cols is None else self.norm2[cols]
+        d = norm2[:, None] - 2 * self.cross(centers, cols) + self.w.dot(centers ** 2)[None, :]
+        return np.maximum(d, 0)
+
+    def centroids(self, part, nb_classes, p, centers=None):
+        """
+        :param part: the cluster of each column, from 0, -1 to leave it out
+        :return: the weighted (p) average of the normalized columns of each
+            cluster, (T, K). Empty clusters keep their previous center
+        """
+        size = np.bincount(part[part >= 0], weights=p[part >= 0], minlength=nb_classes)
+        out = np.zeros((self.data.shape[0], nb_classes))
+        for chunk in self.chunks():
+            a = np.zeros((chunk.stop - chunk.start, nb_classes))
+            keep = part[chunk] >= 0
+            a[np.flatnonzero(keep), part[chunk][keep]] = p[chunk][keep]
+            a *= self.s_inv[chunk, None]
+            out += np.asarray(self.data[:, chunk], dtype=np.float64).dot(a) - self.m[chunk].dot(a)[None, :]
+        empty = size == 0
+        out[:, ~empty] /= size[~empty]
+        if centers is not None:
+            out[:, empty] = centers[:, empty]
+        return out
+
+    def correlation(self, seed):
+        """
+        :param seed: a time series (T,)
+        :return: the weighted correlation of the seed with every column
+        """
+        seed = seed - self.w.dot(seed) / self.sum_w
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.cross(seed[:, None])[:, 0] / np.sqrt(self.var_z * self.w.dot(seed ** 2))
+
+    def sq_distances(self):
+        """
+        :return: the squared distances between all columns, (N, N)
+        """
+        gram = self.cross(self.columns(slice(None)))
+        return np.maximum(self.norm2[:, None] + self.norm2[None, :] - 2 * gram, 0)
+
+    def sq_distances_vec(self):
+        """
+        :return: the squared distances between all columns in the order of
+            niak_mat2vec, (N * (N - 1) / 2,). Rows of the (N, N) matrix are
+            computed by chunks of CHUNK_BYTES, the matrix itself is never built
+        """
+        out = np.empty(self.n * (self.n - 1) // 2)
+        step = max(1, int(CHUNK_BYTES // (8 * self.n)))
+        pos = 0
+        for start in range(0, self.n - 1, step):
+            stop = min(start + step, self.n - 1)
+            others = np.arange(start, self.n)
+            gram = self.cross(self.columns(slice(start, stop)), others)
+            dist = np.maximum(self.norm2[others, None] + self.norm2[None, start:stop] - 2 * gram, 0)
+            for num_i in range(stop - start):
+                nb_after = self.n - start - num_i - 1
+                out[pos:pos + nb_after] = dist[num_i + 1:, num_i]
+                pos += nb_after
+        return out
+
+
+def kmeans_pp(kernel, nb_classes, p, rng):
+    """
+    Greedy k-means++ seeding: candidates for the next center are columns
+    drawn with a probability proportional to p times their squared distance
+    to the closest center, and the candidate that most reduces the inertia
+    is kept
+    :return: the centers, (T, K)
+    """
+    nb_trials = 2 + int(np.log(nb_classes))
+    first = rng.choice(kernel.n, p=p / p.sum())
+    centers = np.zeros((kernel.data.shape[0], nb_classes))
+    centers[:, 0] = kernel.columns([first])[:, 0]
+    d_min = kernel.dist(centers[:, :1])[:, 0]
+    for num_k in range(1, nb_classes):
+        prob = p * d_min
+        if prob.sum() > 0:
+            candidates = rng.choice(kernel.n, nb_trials, p=prob / prob.sum())
+        else:
+            candidates = rng.randint(kernel.n, size=nb_trials)
+        z = kernel.columns(candidates)
+        d_new = np.minimum(d_min[:, None], kernel.dist(z))
+        best = int(np.argmin(p.dot(d_new)))
+        centers[:, num_k] = z[:, best]
+        d_min = d_new[:, best]
+    return centers
+
+
+def assign(kernel, centers, p):
+    """
+    :return: the closest center of each column (from 0), and the inertia
+    """
+    d = kernel.dist(centers)
+    part = np.argmin(d, axis=1)
+    return part, p.dot(d[np.arange(kernel.n), part])
+
+
+def lloyd(kernel, centers, p, opt):
+    nb_classes = centers.shape[1]
+    part, inertia = assign(kernel, centers, p)
+    for num_i in range(1, opt["nb_iter_max"]):
+        centers = kernel.centroids(part, nb_classes, p, centers)
+        new_part, inertia = assign(kernel, centers, p)
+        moved = p[new_part != part].sum() / p.sum()
+        part = new_part
+        if moved <= opt["convergence_rate"]:
+            break
+    return part, centers, inertia
+
+
+def mini_batch(kernel, centers, p, opt, rng):
+    """
+    Mini-batch k-means (Sculley, 2010): each batch moves the centers towards
+    its columns with a per-center learning rate of one over the weight of
+    the columns the center has seen. Stops when the batch moves the centers
+    by less than convergence_rate, relative to their norm
+    """
+    batch_size = min(int(opt["batch_size"]), kernel.n)
+    nb_classes = centers.shape[1]
+    seen = np.zeros(nb_classes)
+    for num_i in range(opt["nb_iter_max"]):
+        batch = np.sort(rng.choice(kernel.n, batch_size, replace=False))
+        part = np.argmin(kernel.dist(centers, batch), axis=1)
+        z = kernel.columns(batch)
+        a = np.zeros((batch_size, nb_classes))
+        a[np.arange(batch_size), part] = p[batch]
+        size = a.sum(axis=0)
+        seen += size
+        touched = size > 0
+        old = centers.copy()
+        # Same as moving towards each column in turn with rate 1/seen
+        centers[:, touched] += (z.dot(a[:, touched]) - centers[:, touched] * size[touched]) / seen[touched]
+        shift = kernel.w.dot((centers - old) ** 2).sum()
+        if shift <= opt["convergence_rate"] ** 2 * kernel.w.dot(old ** 2).sum():
+            break
+    part, inertia = assign(kernel, centers, p)
+    return part, centers, inertia
+
+
+def kmeans_start(kernel, opt, rng):
+    """
+    One start of k-means
+    :return: the partition (from 0), the centers (T, K) and the inertia
+    """
+    nb_classes = int(opt["nb_classes"])
+    p = np.ones(kernel.n) if opt["p"] is None else np.asarray(opt["p"], dtype=np.float64).ravel()
+    if opt["type_init"] == "kmeans++":
+        centers = kmeans_pp(kernel, nb_classes, p, rng)
+    elif opt["type_init"] == "random_partition":
+        centers = kernel.centroids(rng.randint(nb_classes, size=kernel.n), nb_classes, p)
+    else:
+        raise ValueError("{0} is an unknown type of initialisation".format(opt["type_init"]))
+    if opt["batch_size"]:
+        return mini_batch(kernel, centers, p, opt, rng)
+    return lloyd(kernel, centers, p, opt)
+
+
+def _kmeans_start(job):
+    opt, weights, normalize, seed = job
+    kernel = Kernel(SHARED["data"], weights, normalize)
+    return kmeans_start(kernel, opt, np.random.RandomState(seed))
+
+
+def kmeans_clustering(data, opt, n_workers=1, weights=None, normalize="none", rand_seed=None):
+    """
+    Like niak_kmeans_clustering, with k-means++ starts run in parallel
+    :param data: an array (T, N), the N columns are clustered
+    :param opt: nb_classes, nb_iter (the number of starts), nb_iter_max,
+        convergence_rate, type_init ('kmeans++' or 'random_partition'),
+        batch_size (mini-batch k-means if set), p (the weight of the columns)
+    :param weights: the weight of each row, e.g. a bootstrap sample
+    :return: the partition (N,) with clusters numbered from 1, the centers
+        (T, K) and the inertia
+    """
+    opt = defaults(opt, KMEANS_DEFAULTS)
+    if opt["nb_classes"] is None:
+        raise ValueError("Please specify OPT.NB_CLASSES")
+    seeds = np.random.RandomState(rand_seed).randint(2 ** 31 - 1, size=int(opt["nb_iter"]))
+    starts = run_pool(_kmeans_start, [(opt, weights, normalize, seed) for seed in seeds],
+                      min(n_workers, len(seeds)), {"data": data})
+    part, centers, inertia = min(starts, key=lambda s: s[2])
+    return part + 1, centers, inertia
+
+
+def kmeans_cores(kernel, target, target_scale, rng):
+    """
+    Like niak_kmeans_cores: the average of each target cluster is a seed,
+    the columns best correlated with the seed (a k-means in 3 classes of the
+    correlation map) give a core, and each column goes to the core with which
+    it is the most correlated
+    :param target: the target partition, from 1
+    :return: the partition (N,), from 1
+    """
+    target = np.asarray(target).ravel().astype(int)
+    p = np.ones(kernel.n)
+    seeds = kernel.centroids(target - 1, target_scale, p)
+    store = np.zeros((target_scale, kernel.n))
+    core_opt = defaults({"nb_classes": 3, "type_init": "random_partition"}, KMEANS_DEFAULTS)
+    for num_c in range(target_scale):
+        if not np.any(target == num_c + 1):
+            continue
+        corr_map = np.nan_to_num(kernel.correlation(seeds[:, num_c]))
+        k_ind = kmeans_start(Kernel(corr_map[None, :]), core_opt, rng)[0]
+        k_mean = np.array([corr_map[k_ind == k].mean() if np.any(k_ind == k) else np.nan for k in range(3)])
+        core = np.where(k_ind == np.nanargmax(k_mean), 0, -1)
+        store[num_c] = kernel.correlation(kernel.centroids(core, 1, p)[:, 0])
+    return np.argmax(store, axis=0) + 1
+
+
+def sample_weights(nb_t, sampling, rng, num_s=0, nb_samps=1):
+    """
+    The rows drawn by a sampling scheme of niak_stability_tseries
+    :param sampling: {"type": 'bootstrap', 'jacknife' or 'subsampling', "opt": ...}
+    :return: the number of times each row is drawn, (T,)
+    """
+    kind, opt = sampling.get("type", "bootstrap"), sampling.get("opt", {})
+    if kind == "bootstrap":
+        # Circular block bootstrap, like niak_bootstrap_tseries
+        opt = defaults(opt, {"dgp": "CBB", "block_length": None, "t_boot": None})
+        if opt["dgp"] != "CBB":
+            raise ValueError("{0}: only the CBB bootstrap is available".format(opt["dgp"]))
+        block_length = opt["block_length"]
+        if block_length is None:
+            block_length = [2 * int(np.ceil(np.sqrt(nb_t))), 3 * int(np.ceil(np.sqrt(nb_t)))]
+        block_length = np.atleast_1d(block_length)
+        block_length = int(block_length[int(np.ceil(block_length.size * rng.rand())) - 1])
+        t_boot = opt["t_boot"] or nb_t
+        starts = np.floor(rng.rand(int(np.ceil(float(t_boot) / block_length))) * nb_t).astype(int)
+        rows = np.mod(starts[None, :] + np.arange(block_length)[:, None], nb_t).ravel(order="F")[:t_boot]
+    elif kind == "jacknife":
+        perc = defaults(opt, {"perc": 60})["perc"]
+        rows = rng.permutation(nb_t)[:max(min(int(np.floor(perc * nb_t / 100.)), nb_t), 1)]
+    elif kind == "subsampling":
+        length = max(int(np.floor(nb_t * opt)), 1)
+        delta = float(nb_t - length) / (nb_samps - 1) if nb_samps > 1 else 0
+        start = int(np.floor(num_s * delta))
+        rows = np.arange(start, start + length)
+    else:
+        raise ValueError("{0} is not a suppported sampling scheme".format(kind))
+    return np.bincount(rows, minlength=nb_t).astype(np.float64)
+
+
+def _replicate(job):
+    """
+    The co-occurrence matrices of one replicate of niak_stability_tseries,
+    in the order of niak_mat2vec
+    """
+    opt, num_s, nb_samps, seed = job
+    data = SHARED["data"]
+    rng = np.random.RandomState(seed)
+    weights = sample_weights(data.shape[0], opt["sampling"], rng, num_s, nb_samps)
+    kernel = Kernel(data, weights, opt["normalize"].get("type", "mean_var"))
+    kind = opt["clustering"].get("type", "hierarchical")
+    clust_opt = opt["clustering"].get("opt", {})
+    nb_classes = np.atleast_1d(opt["nb_classes"]).astype(int)
+    if kind == "hierarchical":
+        hier = hierarchical_clustering_vec(-kernel.sq_distances_vec(), type_sim=clust_opt.get("type_sim", "ward"))
+        parts = threshold_hierarchy(hier, list(nb_classes))
+    elif kind == "kmeans":
+        parts = np.column_stack([kmeans_start(kernel, defaults(dict(clust_opt, nb_classes=k), KMEANS_DEFAULTS),
+                                              rng)[0] for k in nb_classes])
+    elif kind == "kcores":
+        target = np.asarray(clust_opt["target_part"]).reshape(data.shape[1], -1)
+        scales = np.atleast_1d(clust_opt.get("target_scale", target.max(axis=0))).astype(int)
+        parts = np.column_stack([kmeans_cores(kernel, target[:, num_sc], scales[num_sc], rng)
+                                 for num_sc in range(nb_classes.size)])
+    else:
+        raise ValueError("{0}: unknown type of clustering".format(kind))
+    upper = SHARED["upper"]
+    return np.column_stack([part[upper[0]] == part[upper[1]] for part in parts.T])
+
+
+def stability_tseries(tseries, opt, n_workers=1):
+    """
+    Like niak_stability_tseries, with the replicates run over a process pool
+    :param tseries: an array (T, N)
+    :param opt: nb_classes, nb_samps, normalize {"type"}, clustering {"type":
+        'hierarchical', 'kmeans' or 'kcores', "opt"}, sampling {"type", "opt"},
+        rand_seed
+    :return: the stability matrices, (N*(N-1)/2, len(nb_classes))
+    """
+    log = logging.getLogger(__file__)
+    opt = defaults(opt, STABILITY_DEFAULTS)
+    if opt["nb_classes"] is None:
+        raise ValueError("Please specify OPT.NB_CLASSES")
+    nb_samps = int(opt["nb_samps"])
+    if opt["sampling"].get("type") == "subsampling":
+        length = max(int(np.floor(tseries.shape[0] * opt["sampling"]["opt"])), 1)
+        nb_samps = min(nb_samps, tseries.shape[0] - length + 1)
+    seeds = np.random.RandomState(opt["rand_seed"]).randint(2 ** 31 - 1, size=nb_samps)
+    n = tseries.shape[1]
+    shared = {"data": tseries, "upper": np.triu_indices(n, 1)}
+    log.info("Estimate the stability matrix on {0} samples".format(nb_samps))
+    stab = np.zeros((n * (n - 1) // 2, np.atleast_1d(opt["nb_classes"]).size))
+    for co_occurrence in run_pool(_replicate, [(opt, num_s, nb_samps, seed) for num_s, seed in enumerate(seeds)],
+                                  n_workers, shared):
+        stab += co_occurrence
+    return stab / nb_samps
+
+
+def brick_stability_surf_tseries(files_in, files_out, opt=None, n_workers=1):
+    """
+    Python version of niak_brick_stability_surf_tseries
+    :param files_in: a .mat file with the time series (T, N)
+    :param files_out: the .mat file with stab and nb_classes
+    """
+    opt = defaults(opt, dict(STABILITY_DEFAULTS, name_data="data"))
+    data = volumes.load_mat(files_in)[opt["name_data"]]
+    normalize = opt["normalize"].get("type", "mean_var")
+    tseries = data if normalize == "none" else normalize_tseries(np.asarray(data, dtype=np.float64), normalize)
+    stab = stability_tseries(tseries, opt, n_workers)
+    volumes.save_mat(files_out, {"stab": stab, "nb_classes": np.atleast_1d(opt["nb_classes"]).astype(float)})
+    return files_out
+
+
+def _surf_replicate(job):
+    opt, scales, seed = job
+    data, part = SHARED["data"], SHARED["part"]
+    rng = np.random.RandomState(seed)
+    nb_t = data.shape[0]
+    if opt["sampling"].get("type", "jacknife") == "bootstrap":
+        weights = np.bincount(rng.randint(nb_t, size=nb_t), minlength=nb_t).astype(np.float64)
+    else:
+        weights = sample_weights(nb_t, {"type": "jacknife", "opt": opt["sampling"].get("opt", {})}, rng)
+    kernel = Kernel(data, weights)
+    maps = []
+    for scale_id, (scale_rep, scale_tar) in enumerate(scales):
+        part_t = part[:, scale_id].astype(int)
+        part_s = kmeans_cores(kernel, part_t, scale_tar, rng)
+        # The share of each target cluster that falls in each cluster of the replication
+        size_t = np.bincount(part_t, minlength=scale_tar + 1)[1:].astype(np.float64)
+        inter = np.zeros((scale_tar, max(scale_rep, part_s.max())))
+        np.add.at(inter, (part_t[part_t > 0] - 1, part_s[part_t > 0] - 1), 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inter = np.where(size_t[:, None] > 0, inter / size_t[:, None], 0)
+        maps.append(inter[:, part_s - 1])
+    return maps
+
+
+def brick_stability_surf(files_in, files_out, opt=None, n_workers=1):
+    """
+    Python version of niak_brick_stability_surf for the 'kcores' clustering,
+    the replicates are run over a process pool
+    :param files_in: {"data": .mat file (N, V), "part": .mat file with the target partitions (V, scales)}
+    :param files_out: the .mat file with scale_rep, scale_tar, scale_name and one stability map
+        sc<scale_tar> (scale_tar, V) per scale
+    """
+    log = logging.getLogger(__file__)
+    opt = defaults(opt, SURF_DEFAULTS)
+    kind = opt["clustering"].get("type", "hierarchical")
+    if kind != "kcores":
+        raise ValueError("{0}: only the kcores clustering is available in python, the hierarchical "
+                         "clustering needs the surface region growing of niak_brick_stability_surf".format(kind))
+    data = np.asarray(volumes.load_mat(files_in["data"])[opt["name_data"]], dtype=np.float64)
+    part_file = volumes.load_mat(files_in["part"])
+    part = np.asarray(part_file[opt["name_part"]]).reshape(data.shape[1], -1)
+    if opt["scale_tar"] is not None and len(opt["scale_tar"]):
+        scale_tar = np.atleast_1d(opt["scale_tar"]).astype(int)
+    elif "scale_tar" in part_file:
+        scale_tar = np.ravel(part_file["scale_tar"]).astype(int)
+    else:
+        scale_tar = part.max(axis=0).astype(int)
+    scale_rep = np.atleast_1d(opt["scale_rep"]).astype(int) if len(opt["scale_rep"]) else scale_tar
+    if scale_rep.size != scale_tar.size:
+        raise ValueError("We have a different number of target ({0}) and replication ({1}) scales"
+                         .format(scale_tar.size, scale_rep.size))
+
+    seeds = np.random.RandomState(opt["rand_seed"]).randint(2 ** 31 - 1, size=int(opt["nb_samps"]))
+    scales = list(zip(scale_rep, scale_tar))
+    log.info("Stability of {0} scales on {1} samples".format(len(scales), len(seeds)))
+    maps = [np.zeros((t, data.shape[1])) for t in scale_tar]
+    for rep_maps in run_pool(_surf_replicate, [(opt, scales, seed) for seed in seeds],
+                             n_workers, {"data": data, "part": part}):
+        for scale_id, m in enumerate(rep_maps):
+            maps[scale_id] += m
+    out = {"scale_rep": scale_rep.astype(float), "scale_tar": scale_tar.astype(float),
+           "scale_name": np.array(["sc{0}".format(t) for t in scale_tar], dtype=object)}
+    for t, m in zip(scale_tar, maps):
+        out["sc{0}".format(t)] = m / len(seeds)
+    volumes.save_mat(files_out, out)
+    return files_out
@@ -4,12 +4,21 @@ import shutil
 import json
 import os
 import re
+import signal
+import sqlite3
 import subprocess
-import tempfile
+import sys
 import logging
 
+import pyniak.job_index
+import pyniak.metrics
+import pyniak.octave_path
+import pyniak.scratch
+
 LOCAL_CONFIG_PATH = '/local_config'
 PSOM_GB_LOCAL = "{}/../lib/psom_gb_vars_local.cbrain".format(os.path.dirname(os.path.realpath(__file__)))
+# Seconds to wait for the processes of a killed run to be gone
+KILL_TIMEOUT = 30
 
 try:
     import psutil
@@ -18,6 +27,10 @@ except ImportError:
     psutil_loaded = False
 
 
+def sigterm_handler(signum, frame):
+    raise SystemExit(128 + signum)
+
+
 def num(s):
     try:
         return int(s)
@@ -49,8 +62,21 @@ class BasePipeline(object):
     BOUTIQUE_TYPE_CAST = {"Number": num, "String": string, "File": string, "Flag": string}
     BOUTIQUE_TYPE = "type"
     BOUTIQUE_LIST = "list"
+    BOUTIQUE_DEFAULT = "default-value"
+
+    # Pipeline stages, in the order they are run by niak. Options that
+    # are not tied to one of these stages are considered global.
+    STAGES = []
 
-    def __init__(self, pipeline_name, folder_in=None, folder_out=None, options=None, **kwargs):
+    # The stage of the PSOM jobs whose name does not start with it, from the
+    # start of their name, see pyniak.job_index.split_job_name
+    JOB_STAGES = {}
+
+    # Descriptors are read once per class, see boutique_descriptor()
+    _boutique_cache = {}
+
+    def __init__(self, pipeline_name, folder_in=None, folder_out=None, options=None, metrics_port=None,
+                 restart=None, **kwargs):
 
         self.log = logging.getLogger(__file__)
         # literal file name in niak
@@ -68,6 +94,34 @@ class BasePipeline(object):
         self.octave_options = options
 
         self.psom_gb_local_path = None
+        self._octave_script = None
+        # Serve live metrics on localhost, see pyniak.metrics
+        self.metrics_port = metrics_port
+        # Jobs to run again, e.g. the failed ones from pyniak.job_index, their
+        # PSOM status is reset before the run
+        self.restart = restart
+
+    @classmethod
+    def boutique_descriptor(cls):
+        """
+        Load the boutique descriptor of the class, the json file is only
+        read the first time
+        :return: the descriptor as a dictionary
+        """
+        if cls.__name__ not in cls._boutique_cache:
+            with open("{0}/{1}.json".format(cls.BOUTIQUE_PATH, cls.__name__)) as fp:
+                cls._boutique_cache[cls.__name__] = json.load(fp)
+        return cls._boutique_cache[cls.__name__]
+
+    @classmethod
+    def casting_dico(cls):
+        """
+        :return: A dictionary {opt.some.option: [boutique type, is a list]}
+        """
+        return {elem.get(cls.BOUTIQUE_CMD_LINE, "")
+                .replace("--opt", "opt").replace("-", "."): [elem.get(cls.BOUTIQUE_TYPE),
+                                                             elem.get(cls.BOUTIQUE_LIST)]
+                for elem in cls.boutique_descriptor()[cls.BOUTIQUE_INPUTS]}
 
     def psom_gb_vars_local_setup(self):
         """
@@ -77,36 +131,116 @@ class BasePipeline(object):
         self.psom_gb_local_path = "{0}/psom_gb_vars_local.m".format(LOCAL_CONFIG_PATH)
         shutil.copyfile(PSOM_GB_LOCAL, self.psom_gb_local_path)
 
-    def run(self):
-        self.log.debug("Run: {}".format(" ".join(self.octave_cmd)))
-        p = None
+    def octave_path_setup(self):
+        """
+        Make sure the flat niak path file loaded by octave at startup is up
+        to date, octave falls back on genpath if it can not be written.
+        :return:
+        """
+        path_file = "{0}/{1}".format(LOCAL_CONFIG_PATH, pyniak.octave_path.PATH_FILE)
+        try:
+            pyniak.octave_path.setup(path_file)
+        except (IOError, OSError) as e:
+            self.log.warning("Could not write {0}: {1}".format(path_file, e))
 
-        self.psom_gb_vars_local_setup()
+    def octave_env(self):
+        """
+        :return: environment variables given to octave, and to the PSOM jobs it starts
+        """
+        return {}
 
-        try:
-            logging.info("{}".format(" ".join(self.octave_cmd)))
-            logging.info(("{0};\n{1}(files_in, opt);".format(";\n".join(self.octave_options), self.pipeline_name)))
-            p = subprocess.Popen(self.octave_cmd)
-            p.wait()
-        except BaseException as e:
-            if p and psutil_loaded:
+    def kill(self, p):
+        """
+        Kill octave and all the processes it started, and wait for them to
+        be gone
+        """
+        if psutil_loaded:
+            try:
                 parent = psutil.Process(p.pid)
                 try:
                     children = parent.children(recursive=True)
                 except AttributeError:
                     children = parent.get_children(recursive=True)
                 for child in children:
-                    child.kill()
+                    try:
+                        child.kill()
+                    except psutil.NoSuchProcess:
+                        pass
                 parent.kill()
+                psutil.wait_procs(children, timeout=KILL_TIMEOUT)
+            except psutil.NoSuchProcess:
+                pass
+        elif p.poll() is None:
+            p.kill()
+        p.wait()
+
+    def run(self):
+        self.log.debug("Run: {}".format(" ".join(self.octave_cmd)))
+        p = None
+
+        self.octave_path_setup()
+        self.psom_gb_vars_local_setup()
+
+        path_logs = "{0}/logs".format(os.path.abspath(self.folder_out))
+        if self.restart:
+            reset = pyniak.job_index.reset_jobs(path_logs, self.restart)
+            logging.info("Reset the status of {0} jobs: {1}".format(len(reset), ", ".join(reset)))
+        try:
+            # PSOM is fine with a logs folder that already exists
+            if not os.path.isdir(path_logs):
+                os.makedirs(path_logs)
+            index = pyniak.job_index.JobIndex(path_logs)
+        except (OSError, sqlite3.Error) as e:
+            self.log.warning("No job index: {0}".format(e))
+            index = None
+        monitor = pyniak.metrics.ProgressMonitor(path_logs, self.pipeline_name, port=self.metrics_port, index=index)
+
+        # A kill from the scheduler goes through the same clean up as a crash
+        try:
+            previous_handler = signal.signal(signal.SIGTERM, sigterm_handler)
+        except ValueError:  # Not in the main thread
+            previous_handler = None
+
+        try:
+            with pyniak.scratch.ScratchManager() as scratch:
+                # Octave and its PSOM workers are gone before the scratch is removed
+                try:
+                    logging.info("{}".format(" ".join(self.octave_cmd)))
+                    logging.info(self.octave_script)
+                    env = scratch.env()
+                    env.update(self.octave_env())
+                    p = subprocess.Popen(self.octave_cmd, env=env, stdout=subprocess.PIPE)
+                    scratch.watch(stop=lambda: self.kill(p))
+                    monitor.start(p.stdout)
+                    returncode = p.wait()
+                    if scratch.exceeded:
+                        logging.error("Run stopped, scratch quota exceeded")
+                    return returncode
+                except BaseException:
+                    if p:
+                        self.kill(p)
+                    raise
+        except BaseException as e:
             logging.error("Could no process octave command")
             raise e
+        finally:
+            monitor.stop()
+            if previous_handler is not None:
+                signal.signal(signal.SIGTERM, previous_handler)
+
+    @property
+    def octave_script(self):
+        """
+        The octave code of the run, the inputs are only grabbed once
+        """
+        if self._octave_script is None:
+            self._octave_script = "{0};\n{1}(files_in, opt);".format(";\n".join(self.octave_options),
+                                                                      self.pipeline_name)
+        return self._octave_script
 
     @property
     def octave_cmd(self):
-        tmp_oct = tempfile.NamedTemporaryFile('w', prefix='niak_script_', suffix='.m', dir='/tmp', delete=False)
-        tmp_oct.write(("{0};\n{1}(files_in, opt);".format(";\n".join(self.octave_options), self.pipeline_name)))
-        tmp_oct.close()
-        return ["/usr/bin/env", "octave", "--no-gui", "{}".format(tmp_oct.name)]
+        return ["/usr/bin/env", "octave", "--no-gui", "--eval", self.octave_script]
 
     @property
     def octave_options(self):
@@ -126,13 +260,7 @@ class BasePipeline(object):
         if options is not None:
             # Sort options between grabber (the input file reader) and typecast
             # them with the help of the boutique descriptor
-            with open("{0}/{1}.json".format(self.BOUTIQUE_PATH, self.__class__.__name__)) as fp:
-                boutique_descriptor = json.load(fp)
-
-            casting_dico = {elem.get(self.BOUTIQUE_CMD_LINE, "")
-                            .replace("--opt", "opt").replace("-", "."): [elem.get(self.BOUTIQUE_TYPE),
-                                                                         elem.get(self.BOUTIQUE_LIST)]
-                            for elem in boutique_descriptor[self.BOUTIQUE_INPUTS]}
+            casting_dico = self.casting_dico()
 
             for optk, optv in options.items():
 
@@ -159,6 +287,34 @@ class BasePipeline(object):
 
 class FmriPreprocess(BasePipeline):
 
+    STAGES = ["t1_preprocess", "slice_timing", "motion_correction", "resample_vol", "time_filter",
+              "build_confounds", "regress_confounds", "corsica", "smooth_vol"]
+
+    JOB_STAGES = {"pve": "t1_preprocess",
+                  "clean_slice_timing": "slice_timing",
+                  "motion_target": "motion_correction",
+                  "motion_Wrun": "motion_correction",
+                  "motion_Wsession": "motion_correction",
+                  "motion_Bsession": "motion_correction",
+                  "motion_parameters": "motion_correction",
+                  "qc_motion": "motion_correction",
+                  "qc_group_motion_estimation": "motion_correction",
+                  "mask_anat2func": "resample_vol",
+                  "anat2func": "resample_vol",
+                  "concat_transf_nl": "resample_vol",
+                  "resample": "resample_vol",
+                  "clean_time_filter": "time_filter",
+                  "clean_confounds": "regress_confounds",
+                  "qc_group_scrubbing": "regress_confounds",
+                  "mask_confounds": "corsica",
+                  "corsica_mask_brain": "corsica",
+                  "sica": "corsica",
+                  "component_sel": "corsica",
+                  "component_supp": "corsica",
+                  "qc_corsica": "corsica",
+                  "clean_corsica_intermediate": "corsica",
+                  "smooth": "smooth_vol"}
+
     def __init__(self, subjects=None, func_hint="", anat_hint="", *args,  **kwargs):
         super(FmriPreprocess, self).__init__("niak_pipeline_fmri_preprocess", *args, **kwargs)
 
@@ -232,9 +388,45 @@ class BASC(BasePipeline):
     at least for now.
     """
 
-    def __init__(self, *args, **kwargs):
+    STAGES = ["region_growing", "stability_tseries", "stability_group", "stability_maps", "stability_figure"]
+
+    JOB_STAGES = {"mask_areas": "region_growing",
+                  "neighbourhood_areas": "region_growing",
+                  "merge_part": "region_growing",
+                  "tseries_atoms": "region_growing",
+                  "stability_ind": "stability_tseries",
+                  "msteps_ind": "stability_tseries",
+                  "summary_stability_avg_ind": "stability_tseries",
+                  "msteps_group": "stability_group",
+                  "summary_stability_group": "stability_group",
+                  "tseries_ind": "stability_maps",
+                  "tseries_group": "stability_maps",
+                  "tseries_mixed": "stability_maps",
+                  "figure_stability": "stability_figure"}
+
+    HIERARCHY_BACKENDS = ["octave", "python"]
+
+    def __init__(self, subjects=None, hierarchy_backend="octave", *args, **kwargs):
         super(BASC, self).__init__("niak_pipeline_stability_rest", *args, **kwargs)
 
+        if subjects is not None:
+            self.subjects = unroll_numbers(subjects)
+        else:
+            self.subjects = None
+        if hierarchy_backend not in self.HIERARCHY_BACKENDS:
+            raise ValueError("{0} is not a hierarchy backend, must be one of {1}"
+                             .format(hierarchy_backend, self.HIERARCHY_BACKENDS))
+        # With "python", niak_hierarchical_clustering runs niak_cmd.py hierarchy,
+        # see pyniak.hierarchy.hierarchical_clustering_vec
+        self.hierarchy_backend = hierarchy_backend
+
+    def octave_env(self):
+        if self.hierarchy_backend != "python":
+            return {}
+        niak_cmd = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "bin", "niak_cmd.py")
+        return {"NIAK_HIERARCHY_BACKEND": "python",
+                "NIAK_CMD": "{0} {1}".format(sys.executable, os.path.realpath(niak_cmd))}
+
     def grabber_construction(self):
         """
         :return:
@@ -258,6 +450,11 @@ SUPPORTED_PIPELINES = {"Niak_fmri_preprocess",
                        "Niak_basc",
                        "Niak_stability_rest"}
 
+# Class used to run each supported pipeline
+PIPELINE_CLASSES = {"Niak_fmri_preprocess": FmriPreprocess,
+                    "Niak_basc": BASC,
+                    "Niak_stability_rest": BASC}
+
 
 def suported(pipeline_name):
 
@@ -0,0 +1,450 @@
+"""
+Run many option sets of the same pipeline from a single manifest file.
+
+A manifest is a json file of the form
+
+{
+    "pipeline": "Niak_fmri_preprocess",
+    "file_in": "/data/bids",
+    "folder_out": "sweep",
+    "subjects": "1-20",
+    "max_queued": 48,
+    "options": {"--opt-time_filter-hp": 0.01},
+    "variants": [
+        {"name": "fd_02", "options": {"--opt-regress_confounds-thre_fd": 0.2}},
+        {"name": "fd_05", "options": {"--opt-regress_confounds-thre_fd": 0.5}},
+        {"name": "fwhm_8", "options": {"--opt-smooth_vol-fwhm": 8}}
+    ]
+}
+
+Every variant is validated against the boutique descriptor of the pipeline
+before anything runs. Variants are then placed in a prefix tree of their
+stages: a node holds the options of one stage, and the variants below it
+share all the stages from the root down to it. The variants that share at
+least the first stage of the pipeline form a chain, they run one after the
+other in the same work folder, in the depth first order of the tree. PSOM
+only restarts the jobs whose options changed since the previous run, so
+each shared prefix is computed once, and the outputs of a variant are
+copied to its own folder before the next branch runs. PSOM jobs hold
+absolute paths, a copy of a work folder in another place would be computed
+again from scratch: a shared prefix is never split, only chains that share
+no stage run concurrently, and they share the "max_queued" PSOM budget.
+
+A manifest can be run again after a failure: the variants whose folder
+holds a DONE_FILE with the same options are skipped, the work folder of an
+unfinished chain is reused, and PSOM picks up where it stopped.
+"""
+__author__ = 'poquirion'
+
+import json
+import logging
+import os
+import shutil
+from multiprocessing.pool import ThreadPool
+
+import pyniak.load_pipeline
+
+PSOM_STAGE = "psom"
+GLOBAL_STAGE = "global"
+MAX_QUEUED = "opt.psom.max_queued"
+# Written in the folder of a variant once it is complete
+DONE_FILE = ".niak_manifest_done"
+
+
+def flag2key(flag):
+    """
+    :param flag: a boutique command line flag, like --opt-smooth_vol-fwhm
+    :return: the matching octave option, like opt.smooth_vol.fwhm
+    """
+    return flag.replace("--opt", "opt").replace("-", ".")
+
+
+def value2string(value):
+    """
+    Options are given to the pipeline classes as strings, the way build_opt
+    in niak_cmd.py would produce them
+    """
+    if value is None or value is True:
+        return "true"
+    if value is False:
+        return "false"
+    return "{0}".format(value)
+
+
+class Variant(object):
+    """
+    One option set of the manifest
+    """
+
+    def __init__(self, name, options, pipeline_class):
+
+        self.name = name
+        # {opt.some.option: string value}, ready for the pipeline class
+        self.options = options
+        self.pipeline_class = pipeline_class
+        self.aliases = []
+        self.signature = self._signature()
+
+    def stage(self, key):
+        """
+        :param key: an octave option, like opt.smooth_vol.fwhm
+        :return: the stage the option belongs to
+        """
+        parts = key.split(".")
+        if len(parts) > 1 and parts[0] == "opt" and (parts[1] in self.pipeline_class.STAGES
+                                                     or parts[1] == PSOM_STAGE):
+            return parts[1]
+        return GLOBAL_STAGE
+
+    def _signature(self):
+        """
+        The effective options of each stage, in the order the stages are run.
+        Omitted options take their default value from the descriptor, and
+        psom options are left out since they do not change the outputs.
+        :return: a tuple with one sorted tuple of (option, value) per stage
+        """
+        casting_dico = self.pipeline_class.casting_dico()
+        effective = {}
+        for elem in self.pipeline_class.boutique_descriptor()[self.pipeline_class.BOUTIQUE_INPUTS]:
+            flag = elem.get(self.pipeline_class.BOUTIQUE_CMD_LINE, "")
+            default = elem.get(self.pipeline_class.BOUTIQUE_DEFAULT)
+            if flag.startswith("--opt") and default is not None:
+                effective[flag2key(flag)] = value2string(default)
+        effective.update(self.options)
+
+        stages = {}
+        for key, value in effective.items():
+            cast = self.pipeline_class.BOUTIQUE_TYPE_CAST[casting_dico[key][0]](value)
+            stages.setdefault(self.stage(key), []).append((key, cast))
+
+        return tuple(tuple(sorted(stages.get(stage, [])))
+                     for stage in [GLOBAL_STAGE] + self.pipeline_class.STAGES)
+
+    def shared_stages(self, other):
+        """
+        :return: The number of leading stages with identical options
+        """
+        n = 0
+        for mine, theirs in zip(self.signature, other.signature):
+            if mine != theirs:
+                break
+            n += 1
+        return n
+
+
+class StageNode(object):
+    """
+    A node of the prefix tree of the variants, the variants below a node at
+    depth d have the same options for their first d stages
+    """
+
+    def __init__(self, depth=0, options=None):
+
+        self.depth = depth
+        # The options of the stage of the node, None for the root
+        self.options = options
+        # {options of the next stage: node}
+        self.children = {}
+        # Variants with no stage left, the first one is run, the others are its aliases
+        self.variants = []
+
+    def add(self, variant):
+        if self.depth == len(variant.signature):
+            self.variants.append(variant)
+            return
+        options = variant.signature[self.depth]
+        if options not in self.children:
+            self.children[options] = StageNode(self.depth + 1, options)
+        self.children[options].add(variant)
+
+    def nodes(self, depth):
+        """
+        :return: The nodes of the subtree at the given depth, depth first
+        """
+        if self.depth == depth:
+            return [self]
+        return [node for key in sorted(self.children) for node in self.children[key].nodes(depth)]
+
+    def leaves(self):
+        """
+        :return: The variants of the subtree, depth first, so that two
+            consecutive variants share the longest possible prefix
+        """
+        return self.variants + [v for key in sorted(self.children) for v in self.children[key].leaves()]
+
+
+class Manifest(object):
+    """
+    Load, validate, plan and run a manifest
+    """
+
+    def __init__(self, path):
+
+        self.log = logging.getLogger(__file__)
+        self.path = path
+        with open(path) as fp:
+            self.manifest = json.load(fp)
+
+        self.pipeline_name = self.manifest.get("pipeline")
+        self.folder_in = self.manifest.get("file_in")
+        self.folder_out = os.path.abspath(self.manifest.get("folder_out", "."))
+        self.variants = []
+        self.tree = None
+        self.chains = []
+
+        self.validate()
+
+        self.max_queued = int(self.manifest.get("max_queued", self.default_max_queued()))
+        self.max_parallel = int(self.manifest.get("max_parallel", self.max_queued))
+
+    @property
+    def pipeline_class(self):
+        return pyniak.load_pipeline.PIPELINE_CLASSES[self.pipeline_name]
+
+    def default_max_queued(self):
+        for elem in self.pipeline_class.boutique_descriptor()[self.pipeline_class.BOUTIQUE_INPUTS]:
+            if flag2key(elem.get(self.pipeline_class.BOUTIQUE_CMD_LINE, "")) == MAX_QUEUED:
+                return elem.get(self.pipeline_class.BOUTIQUE_DEFAULT, 1)
+        return 1
+
+    def check_option(self, flag, value):
+        """
+        Check one option against the boutique descriptor
+        :return: A list of error messages, empty if the option is valid
+        """
+        inputs = {elem.get(self.pipeline_class.BOUTIQUE_CMD_LINE): elem
+                  for elem in self.pipeline_class.boutique_descriptor()[self.pipeline_class.BOUTIQUE_INPUTS]}
+
+        if not flag.startswith("--opt"):
+            return ["{0} is not a pipeline option, set it at the top of the manifest".format(flag)]
+        if flag not in inputs:
+            return ["{0} is not an option of {1}".format(flag, self.pipeline_name)]
+
+        elem = inputs[flag]
+        boutique_type = elem.get(self.pipeline_class.BOUTIQUE_TYPE)
+        errors = []
+        if boutique_type == "Number":
+            try:
+                number = pyniak.load_pipeline.num(value2string(value))
+            except ValueError:
+                return ["{0}: {1} is not a number".format(flag, value)]
+            if elem.get("integer") and not isinstance(number, int):
+                errors.append("{0}: {1} is not an integer".format(flag, value))
+            if "minimum" in elem and number < elem["minimum"]:
+                errors.append("{0}: {1} is lower than {2}".format(flag, value, elem["minimum"]))
+            if "maximum" in elem and number > elem["maximum"]:
+                errors.append("{0}: {1} is larger than {2}".format(flag, value, elem["maximum"]))
+        elif boutique_type == "Flag":
+            if value2string(value) not in ["true", "false"]:
+                errors.append("{0}: a flag is true or false, not {1}".format(flag, value))
+        if "value-choices" in elem and value2string(value) not in elem["value-choices"]:
+            errors.append("{0}: {1} is not one of {2}".format(flag, value, elem["value-choices"]))
+        return errors
+
+    def validate(self):
+        """
+        Check the whole manifest before running anything, all the problems
+        are reported at once.
+        """
+        if not pyniak.load_pipeline.suported(self.pipeline_name):
+            raise IOError("Pipeline {} not supported".format(self.pipeline_name))
+
+        errors = []
+        if self.folder_in is None or not os.path.exists(self.folder_in):
+            errors.append("file_in {0} does not exist".format(self.folder_in))
+
+        common = self.manifest.get("options", {})
+        for flag, value in common.items():
+            errors += self.check_option(flag, value)
+
+        names = set()
+        for i, entry in enumerate(self.manifest.get("variants", [])):
+            name = entry.get("name", "variant_{0}".format(i))
+            if name in names:
+                errors.append("variant name {0} is used more than once".format(name))
+            names.add(name)
+
+            var_errors = []
+            for flag, value in entry.get("options", {}).items():
+                var_errors += ["{0}: {1}".format(name, e) for e in self.check_option(flag, value)]
+            errors += var_errors
+            if var_errors:
+                continue
+
+            options = {flag2key(f): value2string(v) for f, v in common.items()}
+            options.update({flag2key(f): value2string(v) for f, v in entry.get("options", {}).items()})
+            if MAX_QUEUED in options:
+                self.log.warning("{0}: psom max_queued is set by the manifest budget".format(name))
+            self.variants.append(Variant(name, options, self.pipeline_class))
+
+        if not names:
+            errors.append("The manifest has no variants")
+
+        if errors:
+            raise ValueError("Invalid manifest {0}:\n{1}".format(self.path, "\n".join(errors)))
+
+    def plan(self):
+        """
+        Remove duplicated variants, build the prefix tree of their stages and
+        cut it in chains that share no stage
+        :return: the chains, a list of lists of Variant
+        """
+        self.tree = StageNode()
+        self.chains = []
+        if not self.variants:
+            return self.chains
+        for variant in self.variants:
+            self.tree.add(variant)
+
+        depth = len(self.variants[0].signature)
+        for leaf in self.tree.nodes(depth):
+            leaf.variants[0].aliases = [v.name for v in leaf.variants[1:]]
+            del leaf.variants[1:]
+
+        # Below the global options and the first stage of the pipeline, the
+        # subtrees share nothing that is computed
+        self.chains = [node.leaves() for node in self.tree.nodes(min(2, depth))]
+        return self.chains
+
+    def computed_stages(self, chain):
+        """
+        :return: for each variant of the chain, the stages PSOM computes when
+            it runs after the previous one in the work folder
+        """
+        stages = [GLOBAL_STAGE] + self.pipeline_class.STAGES
+        out = []
+        previous = None
+        for variant in chain:
+            start = 0 if previous is None else variant.shared_stages(previous)
+            out.append((variant, stages[start:]))
+            previous = variant
+        return out
+
+    def describe(self):
+        """
+        :return: A human readable description of the plan
+        """
+        lines = []
+        for n, chain in enumerate(self.chains):
+            lines.append("chain {0}:".format(n))
+            for variant, computed in self.computed_stages(chain):
+                lines.append("    {0} ({1})".format(variant.name, ", ".join(computed) or "nothing"))
+                if variant.aliases:
+                    lines.append("        identical to: {0}".format(", ".join(variant.aliases)))
+        return "\n".join(lines)
+
+    def is_done(self, variant):
+        """
+        :return: True if the variant was completed by a previous run of the
+            manifest with the same options
+        """
+        path = os.path.join(self.folder_out, variant.name, DONE_FILE)
+        try:
+            with open(path) as fp:
+                return json.load(fp) == variant.options
+        except (IOError, OSError, ValueError):
+            return False
+
+    def mark_done(self, variant):
+        with open(os.path.join(self.folder_out, variant.name, DONE_FILE), "w") as fp:
+            json.dump(variant.options, fp, sort_keys=True)
+
+    def link_alias(self, variant, alias):
+        path = os.path.join(self.folder_out, alias)
+        if os.path.islink(path):
+            os.remove(path)
+        elif os.path.exists(path):
+            self.log.warning("{0} exists and is not a link to {1}, left as is".format(path, variant.name))
+            return
+        os.symlink(variant.name, path)
+
+    def run_chain(self, chain, max_queued):
+        """
+        Run the variants of a chain one after the other in the same folder.
+        Variants completed by a previous run of the manifest are skipped, the
+        work folder of the chain is reused as is.
+        :return: the names of the variants that failed
+        """
+        if len(chain) == 1:
+            work_folder = os.path.join(self.folder_out, chain[0].name)
+        else:
+            work_folder = os.path.join(self.folder_out, ".chain_{0}".format(chain[0].name))
+
+        for i, variant in enumerate(chain):
+            try:
+                if self.is_done(variant):
+                    self.log.info("{0} is already done, skipped".format(variant.name))
+                else:
+                    if self.run_variant(variant, work_folder, max_queued):
+                        failed = [v.name for v in chain[i:]]
+                        self.log.error("{0} failed, skipping {1}".format(variant.name, ", ".join(failed[1:])))
+                        return failed
+                    self.store(variant, work_folder, last=i == len(chain) - 1)
+                for alias in variant.aliases:
+                    self.link_alias(variant, alias)
+            except (IOError, OSError) as e:
+                failed = [v.name for v in chain[i:]]
+                self.log.error("{0}: {1}, skipping {2}".format(variant.name, e, ", ".join(failed[1:])))
+                return failed
+
+        return []
+
+    def run_variant(self, variant, work_folder, max_queued):
+        """
+        :return: the exit code of the pipeline
+        """
+        options = dict(variant.options)
+        options[MAX_QUEUED] = "{0}".format(max_queued)
+
+        pipeline = self.pipeline_class(folder_in=self.folder_in,
+                                       folder_out=work_folder,
+                                       options=options,
+                                       subjects=self.manifest.get("subjects"),
+                                       **{k: self.manifest[k] for k in ["func_hint", "anat_hint"]
+                                          if k in self.manifest})
+        self.log.info("Running {0} in {1}".format(variant.name, work_folder))
+        return pipeline.run()
+
+    def store(self, variant, work_folder, last):
+        """
+        Give the outputs of a variant their final folder, a copy of the work
+        folder of the chain, or the work folder itself for the last variant.
+        What a previous, interrupted run left there is replaced.
+        """
+        dest = os.path.join(self.folder_out, variant.name)
+        if dest != work_folder:
+            if os.path.islink(dest):
+                os.remove(dest)
+            elif os.path.exists(dest):
+                self.log.warning("Replacing the incomplete outputs of {0} in {1}".format(variant.name, dest))
+                shutil.rmtree(dest)
+            if last:
+                os.rename(work_folder, dest)
+            else:
+                shutil.copytree(work_folder, dest, symlinks=True)
+        self.mark_done(variant)
+
+    def run(self, dry_run=False):
+        """
+        Run all the chains, at most max_parallel at a time
+        :return: the names of the variants that failed
+        """
+        self.plan()
+        logging.info("Manifest plan:\n{0}".format(self.describe()))
+        if dry_run:
+            return []
+
+        n_parallel = max(1, min(len(self.chains), self.max_parallel, self.max_queued))
+        max_queued = max(1, self.max_queued // n_parallel)
+
+        if not os.path.isdir(self.folder_out):
+            os.makedirs(self.folder_out)
+
+        pool = ThreadPool(n_parallel)
+        try:
+            failed = pool.map(lambda c: self.run_chain(c, max_queued), self.chains)
+        finally:
+            pool.close()
+            pool.join()
+
+        return [name for names in failed for name in names]
@@ -0,0 +1,316 @@
+"""
+Live progress metrics of a running pipeline.
+
+The octave output goes through ProgressMonitor, which echoes it and picks
+up the PSOM manager messages, for example
+
+    2017-03-15 15:04:12 slice_timing_subject1_session1_rest submitted (1 run | 0 fail | 0 done | 10 left)
+
+The tag files PSOM leaves in the logs folder (<job>.running, .failed,
+.finished) are scanned as well, since they are there even when the octave
+output is buffered. The metrics are written in the Prometheus text format
+to a file, for the node_exporter textfile collector for example, and can
+also be served on localhost.
+
+NIAK_METRICS_PORT is only read by niak_cmd.py for a single pipeline run,
+the pipelines of a manifest run in the same process and cannot share a port.
+They cannot share a file either: with NIAK_METRICS_FILE, every pipeline
+writes its own file next to it, named after its output folder (see
+run_file), and every metric has the output folder as a label, so that a
+collector reading all of them sees distinct series.
+"""
+__author__ = 'poquirion'
+
+import collections
+import hashlib
+import logging
+import os
+import re
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+METRICS_FILE = "niak_metrics.prom"
+# Completion rate is computed over that many seconds
+RATE_WINDOW = 600
+# Seconds to wait for the end of the octave output once octave exited, a
+# process started by PSOM may have inherited the pipe and keep it open
+FOLLOW_TIMEOUT = 5
+
+COUNTS_RE = re.compile(r"\((\d+)\s+run\s*[|/,]\s*(\d+)\s+fail\s*[|/,]\s*(\d+)\s+done\s*[|/,]\s*(\d+)\s+left\)")
+EVENT_RE = re.compile(r"\d{1,2}:\d{2}:\d{2}\]?\s+(\S+)\s+(submitted|finished|failed)\b")
+TAGS = {".running": "running", ".failed": "failed", ".finished": "finished"}
+
+
+def env_port():
+    """
+    :return: the port in NIAK_METRICS_PORT, None if it is not set
+    """
+    port = os.getenv("NIAK_METRICS_PORT")
+    return int(port) if port else None
+
+
+def run_file(path, path_logs):
+    """
+    :param path: a metrics file shared by all the runs, like NIAK_METRICS_FILE
+    :param path_logs: the PSOM logs folder of one run
+    :return: the metrics file of the run, e.g. /metrics/niak.prom gives
+        /metrics/niak.fd_02-1f3a9c0b.prom for a run in /sweep/fd_02
+    """
+    folder_out = os.path.dirname(os.path.abspath(path_logs).rstrip(os.sep))
+    digest = hashlib.sha1(folder_out.encode("utf-8")).hexdigest()[:8]
+    stem, ext = os.path.splitext(path)
+    return "{0}.{1}-{2}{3}".format(stem, os.path.basename(folder_out).lstrip("."), digest, ext)
+
+
+class ProgressMonitor(object):
+    """
+    Follow the jobs of a PSOM pipeline and publish metrics about them
+
+    :param path_logs: the PSOM logs folder of the pipeline
+    :param pipeline_name: used as a label of every metric
+    :param metrics_file: where to write the metrics, the file of the run
+        next to NIAK_METRICS_FILE (see run_file) or
+        path_logs/niak_metrics.prom by default
+    :param port: serve the metrics on http://localhost:port/metrics, no
+        server if None
+    :param interval: seconds between two updates of the metrics file
+    :param index: a pyniak.job_index.JobIndex updated at the same time
+    """
+
+    def __init__(self, path_logs, pipeline_name, metrics_file=None, port=None, interval=10, index=None):
+
+        self.log = logging.getLogger(__file__)
+        self.path_logs = path_logs
+        self.pipeline_name = pipeline_name
+        if metrics_file is None and os.getenv("NIAK_METRICS_FILE"):
+            metrics_file = run_file(os.getenv("NIAK_METRICS_FILE"), path_logs)
+        self.metrics_file = metrics_file or os.path.join(path_logs, METRICS_FILE)
+        self.folder_out = os.path.dirname(os.path.abspath(path_logs).rstrip(os.sep))
+        self.port = port
+        self.interval = interval
+        self.index = index
+
+        self.start_time = time.time()
+        self.last_progress = self.start_time
+        self.jobs = {}
+        # Counts printed by the PSOM manager, they win over the tags
+        self.counts = None
+        self.completed_times = collections.deque()
+        self.lines = 0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._server = None
+
+    def set_state(self, job, state, when=None):
+        with self._lock:
+            previous = self.jobs.get(job)
+            # PSOM resubmits failed jobs, never finished ones
+            if previous == "finished" or previous == state:
+                return
+            self.jobs[job] = state
+            if state in ["finished", "failed"]:
+                when = when or time.time()
+                self.completed_times.append(when)
+                self.last_progress = max(self.last_progress, when)
+
+    def feed(self, line):
+        """
+        Parse one line of the octave output
+        """
+        self.lines += 1
+        counts = COUNTS_RE.search(line)
+        if counts:
+            with self._lock:
+                self.counts = dict(zip(["running", "failed", "finished", "left"],
+                                       [int(c) for c in counts.groups()]))
+        event = EVENT_RE.search(COUNTS_RE.sub("", line))
+        if event:
+            job, what = event.groups()
+            self.set_state(job, "running" if what == "submitted" else what)
+
+    def scan_tags(self):
+        """
+        Update the jobs with the tag files of the logs folder
+        """
+        for dirpath, dirnames, filenames in os.walk(self.path_logs):
+            for f in filenames:
+                job, ext = os.path.splitext(f)
+                if ext in TAGS:
+                    try:
+                        when = os.path.getmtime(os.path.join(dirpath, f))
+                    except OSError:
+                        continue
+                    self.set_state(job, TAGS[ext], when if TAGS[ext] != "running" else None)
+
+    def snapshot(self):
+        """
+        :return: A dictionary with the current value of the metrics
+        """
+        now = time.time()
+        with self._lock:
+            while self.completed_times and self.completed_times[0] < now - RATE_WINDOW:
+                self.completed_times.popleft()
+            states = collections.Counter(self.jobs.values())
+            counts = {k: states.get(k, 0) for k in ["running", "failed", "finished"]}
+            left = None
+            if self.counts is not None:
+                counts = dict((k, max(self.counts[k], counts[k])) for k in counts)
+                left = self.counts["left"]
+            window = min(RATE_WINDOW, now - self.start_time)
+            rate = len(self.completed_times) / window if window > 0 else 0.
+            snapshot = {"jobs": counts,
+                        "left": left,
+                        "rate": rate,
+                        "eta": left / rate if left is not None and rate > 0 else None,
+                        "start": self.start_time,
+                        "last_progress": self.last_progress,
+                        "lines": self.lines}
+        return snapshot
+
+    def render(self):
+        """
+        :return: The metrics in the Prometheus text exposition format
+        """
+        snap = self.snapshot()
+        label = 'pipeline="{0}",folder_out="{1}"'.format(self.pipeline_name,
+                                                         self.folder_out.replace("\\", "\\\\").replace('"', '\\"'))
+        out = ["# HELP niak_jobs Number of PSOM jobs in each state.",
+               "# TYPE niak_jobs gauge"]
+        for state in ["running", "failed", "finished"]:
+            out.append('niak_jobs{{{0},state="{1}"}} {2}'.format(label, state, snap["jobs"][state]))
+        if snap["left"] is not None:
+            out.append('niak_jobs{{{0},state="left"}} {1}'.format(label, snap["left"]))
+        out += ["# HELP niak_job_completion_rate Jobs finished or failed per second over the last {0} s."
+                .format(RATE_WINDOW),
+                "# TYPE niak_job_completion_rate gauge",
+                "niak_job_completion_rate{{{0}}} {1:.6g}".format(label, snap["rate"]),
+                "# HELP niak_pipeline_eta_seconds Projected time before all jobs are done.",
+                "# TYPE niak_pipeline_eta_seconds gauge",
+                "niak_pipeline_eta_seconds{{{0}}} {1}".format(
+                    label, "NaN" if snap["eta"] is None else "{0:.0f}".format(snap["eta"])),
+                "# HELP niak_pipeline_start_time_seconds Start of the run, unix time.",
+                "# TYPE niak_pipeline_start_time_seconds gauge",
+                "niak_pipeline_start_time_seconds{{{0}}} {1:.0f}".format(label, snap["start"]),
+                "# HELP niak_pipeline_last_progress_seconds Last time a job finished or failed, unix time.",
+                "# TYPE niak_pipeline_last_progress_seconds gauge",
+                "niak_pipeline_last_progress_seconds{{{0}}} {1:.0f}".format(label, snap["last_progress"]),
+                "# HELP niak_output_lines_total Lines printed by octave.",
+                "# TYPE niak_output_lines_total counter",
+                "niak_output_lines_total{{{0}}} {1}".format(label, snap["lines"])]
+        return "\n".join(out) + "\n"
+
+    def write(self):
+        """
+        Write the metrics file atomically, so a collector never reads half of it
+        """
+        folder = os.path.dirname(os.path.abspath(self.metrics_file))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        fd, tmp_path = tempfile.mkstemp(prefix=".niak_metrics_", dir=folder)
+        with os.fdopen(fd, "w") as fp:
+            fp.write(self.render())
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, self.metrics_file)
+
+    def _follow(self, stream):
+        for line in iter(stream.readline, b""):
+            if not isinstance(line, str):
+                line = line.decode("utf-8", "replace")
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            self.feed(line)
+
+    def update(self):
+        """
+        Scan the tags, write the metrics and update the job index
+        """
+        try:
+            self.scan_tags()
+            self.write()
+        except (IOError, OSError) as e:
+            self.log.warning("Could not update metrics: {0}".format(e))
+        if self.index is not None:
+            try:
+                self.index.update()
+            except (IOError, OSError, sqlite3.Error) as e:
+                self.log.warning("Could not update the job index: {0}".format(e))
+
+    def _update(self):
+        while True:
+            self.update()
+            if self._stop.wait(self.interval):
+                return
+
+    def serve(self):
+        monitor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ["", "/metrics"]:
+                    self.send_error(404)
+                    return
+                body = monitor.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            self._server = HTTPServer(("127.0.0.1", self.port), Handler)
+        except (socket.error, OSError) as e:
+            self.log.warning("Metrics not served on port {0}: {1}".format(self.port, e))
+            return
+        thread = threading.Thread(target=self._server.serve_forever, name="niak_metrics_server")
+        thread.daemon = True
+        thread.start()
+        self.log.info("Metrics served on http://127.0.0.1:{0}/metrics".format(self.port))
+
+    def start(self, stream=None):
+        """
+        Start following the pipeline
+        :param stream: the octave stdout, echoed to our stdout
+        """
+        targets = [self._update]
+        if stream is not None:
+            targets.append(lambda: self._follow(stream))
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        if self.port:
+            self.serve()
+
+    def stop(self):
+        """
+        Write the final metrics and stop the threads, the octave stream
+        must be closed by then
+        """
+        self._stop.set()
+        for thread in self._threads:
+            # The thread following the octave output ends at the end of the
+            # stream only, they are daemon threads
+            thread.join(FOLLOW_TIMEOUT)
+            if thread.is_alive():
+                self.log.debug("The octave output is still open, not followed anymore")
+        self._threads = []
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.update()
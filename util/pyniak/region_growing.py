@@ -0,0 +1,668 @@
+"""
+Python backend of niak_pipeline_region_growing, the first stage of BASC.
+
+niak_region_growing keeps, for every region, a row of neighbours padded
+with zeros and the matching row of similarities, and recomputes a good
+part of them at every merging step. Here the spatial neighbourhood is a
+sparse list of edges between voxels, built once per mask and cached on
+disk, so BASC runs sharing a mask do not rebuild it. Regions carry the
+size-weighted average of their time series, and after a round of merges
+only the edges touching a merged region get a new similarity; the nearest
+neighbour of a region is looked up again only if one of its edges changed.
+Areas (the AAL regions for example) are grown independently over a process
+pool.
+
+Merging follows niak_region_growing: mutual nearest neighbours are merged
+until no pair is left (or the region size, similarity and number of
+regions thresholds stop it), then regions smaller than the size threshold
+are merged into their most similar large neighbour. When a region has
+several nearest neighbours with the same similarity, the one with the
+lowest label wins, octave picks the first in its neighbour row.
+
+Outputs follow niak_pipeline_region_growing: areas/brain_areas,
+areas/part_areas_<area>.mat, rois/brain_rois and, with flag_tseries,
+rois/tseries_rois_<label>.mat. The neighbourhood and the time series of
+the areas are not written, they live in the cache and the run scratch.
+"""
+__author__ = 'poquirion'
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool
+
+import numpy as np
+
+import pyniak.volumes as volumes
+from pyniak.common import defaults
+from pyniak.common import normalize as normalize_tseries
+
+CACHE_DIR = os.getenv("NIAK_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "niak"))
+
+# Areas of niak's template_aal, the ones niak_pipeline_region_growing uses
+# when the areas file is template_aal
+AAL_ROIS = [2001, 2002, 2101, 2102, 2111, 2112, 2201, 2202, 2211, 2212, 2301, 2302, 2311, 2312, 2321, 2322,
+            2331, 2332, 2401, 2402, 2501, 2502, 2601, 2602, 2611, 2612, 2701, 2702, 3001, 3002, 4001, 4002,
+            4011, 4012, 4021, 4022, 4101, 4102, 4111, 4112, 4201, 4202, 5001, 5002, 5011, 5012, 5021, 5022,
+            5101, 5102, 5201, 5202, 5301, 5302, 5401, 5402, 6001, 6002, 6101, 6102, 6201, 6202, 6211, 6212,
+            6221, 6222, 6301, 6302, 6401, 6402, 7001, 7002, 7011, 7012, 7021, 7022, 7101, 7102, 8101, 8102,
+            8111, 8112, 8121, 8122, 8201, 8202, 8211, 8212, 8301, 8302, 9001, 9002, 9011, 9012, 9021, 9022,
+            9031, 9032, 9041, 9042, 9051, 9052, 9061, 9062, 9071, 9072, 9081, 9082, 9100, 9110, 9120, 9130,
+            9140, 9150, 9160, 9170]
+
+GROWING_DEFAULTS = {"thre_size": np.inf, "thre_sim": np.nan, "thre_nb_rois": 0, "sim_measure": "afc",
+                    "flag_size": True, "flag_sieve": False}
+PIPELINE_DEFAULTS = {"flag_tseries": True, "labels": [], "ind_rois": [], "thre_size": 1000, "thre_sim": np.nan,
+                     "thre_nb_rois": 0, "sim_measure": "afc", "correction_ind": {"type": "mean"},
+                     "correction_group": {"type": "mean_var"}, "correction_average": {"type": "mean"},
+                     "flag_size": True, "type_neig": 26, "folder_out": None}
+BRICK_DEFAULTS = {"correction_ind": {"type": "mean"}, "correction_group": {"type": "mean_var"},
+                  "var_tseries": "tseries", "var_neig": "neig", "thre_size": 1000, "thre_sim": np.nan,
+                  "thre_nb_rois": 0, "sim_measure": "afc", "flag_size": True, "flag_sieve": False}
+MEASURES = ["afc", "afc_penalized", "square_diff", "square_diff_penalized"]
+# Memory used by the time series of a chunk of edges when similarities are computed
+CHUNK_BYTES = 64 * 1024 ** 2
+# niak_region_growing gives up merging small regions after that many passes
+NB_ITER_SIZE = 100
+
+
+def neighbour_offsets(type_neig=26):
+    """
+    Like niak_build_neighbour_mat
+    :param type_neig: 4, 6, 8, 18, 26 or 30, or an array (k, 3) of offsets
+    :return: an array (k, 3) of offsets
+    """
+    if not np.isscalar(type_neig):
+        return np.asarray(type_neig, dtype=int).reshape(-1, 3)
+    if type_neig == 26:
+        dec = [0, 1, -1]
+        return np.array([[i, j, k] for i in dec for j in dec for k in dec][1:])
+    if type_neig in [4, 6, 8]:
+        offsets = [[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0]]
+        if type_neig == 6:
+            offsets += [[0, 0, 1], [0, 0, -1]]
+        if type_neig == 8:
+            offsets += [[1, 1, 0], [-1, 1, 0], [1, -1, 0], [-1, -1, 0]]
+        return np.array(offsets)
+    if type_neig in [18, 30]:
+        dec = [-3, -2, -1, 1, 2, 3] if type_neig == 18 else [-10, -4, -3, -2, -1, 1, 2, 3, 4, 10]
+        return np.array([[d, 0, 0] for d in dec] + [[0, d, 0] for d in dec] + [[0, 0, d] for d in dec])
+    raise ValueError("{0} : unsupported parameter for a connex neighbourhood".format(type_neig))
+
+
+class NeighbourGraph(object):
+    """
+    The spatial neighbourhood of the voxels of a label volume, as a sparse
+    list of edges. Voxels are numbered in the order of find(mask(:)) in
+    octave, only voxels with the same label are neighbours.
+
+    :param ind: linear indices (column major, 0-based) of the voxels with a label
+    :param labels: the label of each voxel
+    :param lo: first voxel of each edge
+    :param hi: second voxel of each edge, lo < hi
+    """
+
+    def __init__(self, shape, ind, labels, lo, hi):
+        self.shape = tuple(int(s) for s in shape)
+        self.ind = ind
+        self.labels = labels
+        self.lo = lo
+        self.hi = hi
+
+    @classmethod
+    def build(cls, label_vol, type_neig=26):
+        """
+        Like niak_build_neighbour on every label of label_vol
+        """
+        label_vol = np.asarray(label_vol)
+        shape = label_vol.shape[:3]
+        flat = label_vol.ravel(order="F")
+        ind = np.flatnonzero(flat)
+        labels = flat[ind].astype(np.int64)
+        position = np.full(flat.size, -1, dtype=np.int64)
+        position[ind] = np.arange(ind.size)
+        coord = np.array(np.unravel_index(ind, shape, order="F"))
+
+        lo, hi = [], []
+        for offset in neighbour_offsets(type_neig):
+            neig = coord + offset[:, None]
+            inside = np.all((neig >= 0) & (neig < np.array(shape)[:, None]), axis=0)
+            src = np.flatnonzero(inside)
+            dst = position[np.ravel_multi_index(neig[:, inside], shape, order="F")]
+            keep = (dst >= 0) & (dst != src) & (labels[np.maximum(dst, 0)] == labels[src])
+            lo.append(np.minimum(src[keep], dst[keep]))
+            hi.append(np.maximum(src[keep], dst[keep]))
+        lo, hi = unique_edges(np.concatenate(lo), np.concatenate(hi), ind.size)
+        return cls(shape, ind, labels, lo, hi)
+
+    @classmethod
+    def from_neig(cls, neig):
+        """
+        :param neig: the neighbour array of niak_build_neighbour, 1-based
+            positions padded with zeros
+        """
+        neig = np.asarray(neig, dtype=np.int64)
+        n = neig.shape[0]
+        src = np.repeat(np.arange(n), neig.shape[1])
+        dst = neig.ravel() - 1
+        keep = dst >= 0
+        src, dst = src[keep], dst[keep]
+        lo, hi = unique_edges(np.minimum(src, dst), np.maximum(src, dst), n)
+        return cls((n, 1, 1), np.arange(n), np.ones(n, dtype=np.int64), lo, hi)
+
+    @classmethod
+    def cached(cls, label_vol, type_neig=26, cache_dir=None):
+        """
+        The graph of label_vol, read from the cache when it was built before
+        """
+        label_vol = np.asarray(label_vol)
+        cache_dir = cache_dir or CACHE_DIR
+        md5 = hashlib.md5()
+        md5.update("{0} {1}\n".format(label_vol.shape, neighbour_offsets(type_neig).tolist()).encode("utf-8"))
+        md5.update(np.ascontiguousarray(label_vol, dtype=np.int64).tobytes())
+        path = os.path.join(cache_dir, "neighbours_{0}.npz".format(md5.hexdigest()))
+        if os.path.exists(path):
+            try:
+                return cls.load(path)
+            except (IOError, OSError, ValueError, KeyError) as e:
+                logging.warning("Could not read the cached neighbourhood {0}: {1}".format(path, e))
+        graph = cls.build(label_vol, type_neig)
+        try:
+            graph.save(path)
+        except (IOError, OSError) as e:
+            logging.warning("Could not cache the neighbourhood in {0}: {1}".format(path, e))
+        return graph
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["shape"], data["ind"], data["labels"], data["lo"], data["hi"])
+
+    def save(self, path):
+        """
+        Save atomically, other workers may be reading the cache
+        """
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        fd, tmp_path = tempfile.mkstemp(prefix=".niak_neig_", suffix=".npz", dir=folder)
+        with os.fdopen(fd, "wb") as fp:
+            np.savez(fp, shape=np.array(self.shape), ind=self.ind, labels=self.labels, lo=self.lo, hi=self.hi)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+
+    def areas(self):
+        """
+        Split the graph by label
+        :return: a dictionary label: (voxels, lo, hi), voxels are positions
+            in the graph, lo and hi are positions in voxels
+        """
+        order = np.argsort(self.labels, kind="mergesort")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.size)
+        sorted_labels = self.labels[order]
+        starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+        stops = np.r_[starts[1:], order.size]
+
+        edge_label = self.labels[self.lo]
+        edge_order = np.argsort(edge_label, kind="mergesort")
+        edge_bounds = np.searchsorted(edge_label[edge_order], sorted_labels[starts])
+        edge_bounds = np.r_[edge_bounds, edge_order.size]
+
+        areas = {}
+        for k, (start, stop) in enumerate(zip(starts, stops)):
+            edges = edge_order[edge_bounds[k]:edge_bounds[k + 1]]
+            areas[int(sorted_labels[start])] = (order[start:stop], rank[self.lo[edges]] - start,
+                                                rank[self.hi[edges]] - start)
+        return areas
+
+
+def unique_edges(lo, hi, n):
+    """
+    :return: the edges without duplicates, sorted
+    """
+    key = np.unique(lo.astype(np.int64) * n + hi)
+    return key // n, key % n
+
+
+def resolve(parent):
+    """
+    Follow the chains of merged regions to their current label
+    """
+    labels = parent
+    while True:
+        up = labels[labels]
+        if np.array_equal(up, labels):
+            return labels
+        labels = up
+
+
+class RegionGrowing(object):
+    """
+    Competitive region growing, like niak_region_growing
+
+    :param tseries: an array (time, voxels)
+    :param lo: first voxel of each edge of the neighbourhood graph
+    :param hi: second voxel of each edge
+    :param thre_size: maximal size of a region, in voxels
+    :param thre_sim: minimal similarity (maximal distance) for two regions
+        to merge, no test if NaN
+    :param thre_nb_rois: minimal number of regions
+    :param sim_measure: 'afc', 'afc_penalized', 'square_diff' or 'square_diff_penalized'
+    :param flag_size: merge the regions smaller than thre_size in their
+        closest neighbour once growing is over
+    :param flag_sieve: drop the regions smaller than thre_size from the partition
+    """
+
+    def __init__(self, tseries, lo, hi, thre_size=np.inf, thre_sim=np.nan, thre_nb_rois=0, sim_measure="afc",
+                 flag_size=True, flag_sieve=False):
+
+        if sim_measure not in MEASURES:
+            raise ValueError("{0} is an unkown similarity measure".format(sim_measure))
+        self.tseries = np.asarray(tseries, dtype=np.float64)
+        self.nt, self.n = self.tseries.shape
+        self.lo0 = np.asarray(lo, dtype=np.int64)
+        self.hi0 = np.asarray(hi, dtype=np.int64)
+        self.thre_size = thre_size
+        self.thre_sim = np.nan if thre_sim is None else thre_sim
+        self.thre_nb_rois = thre_nb_rois
+        self.sim_measure = sim_measure
+        self.flag_size = flag_size
+        self.flag_sieve = flag_sieve
+        self.flag_sim = sim_measure.startswith("afc")
+        self.nogo = -np.inf if self.flag_sim else np.inf
+        self.chunk = max(1, int(CHUNK_BYTES // (16 * max(self.nt, 1))))
+
+    def similarity(self, a, b, penalized=True):
+        """
+        :return: the similarity between the regions a and b, for each pair
+        """
+        sim = np.empty(a.size)
+        for start in range(0, a.size, self.chunk):
+            ca, cb = a[start:start + self.chunk], b[start:start + self.chunk]
+            x, y = self.means[ca], self.means[cb]
+            if self.flag_sim:
+                sim[start:start + ca.size] = np.einsum("ij,ij->i", x, y) / (self.nt - 1)
+            else:
+                sim[start:start + ca.size] = np.sqrt(np.einsum("ij,ij->i", x - y, x - y))
+        if penalized and self.sim_measure.endswith("_penalized"):
+            size_a, size_b = self.sizes[a], self.sizes[b]
+            penalty = np.abs(size_a - size_b) / np.maximum(size_a, size_b)
+            sim += penalty if self.flag_sim else -penalty
+        return sim
+
+    def best_pairs(self, src, dst, sim):
+        """
+        :return: for each region of src, its best neighbour in dst and the
+            similarity with it
+        """
+        order = np.lexsort((dst, -sim if self.flag_sim else sim, src))
+        src, dst, sim = src[order], dst[order], sim[order]
+        first = np.r_[True, src[1:] != src[:-1]]
+        return src[first], dst[first], sim[first]
+
+    def update_best(self, touched):
+        """
+        Look for the nearest neighbour of the touched regions
+        """
+        sel_lo, sel_hi = touched[self.lo], touched[self.hi]
+        src = np.concatenate([self.lo[sel_lo], self.hi[sel_hi]])
+        dst = np.concatenate([self.hi[sel_lo], self.lo[sel_hi]])
+        sim = np.concatenate([self.sim[sel_lo], self.sim[sel_hi]])
+        self.best[touched] = -1
+        self.best_sim[touched] = self.nogo
+        if src.size:
+            src, dst, sim = self.best_pairs(src, dst, sim)
+            self.best[src] = dst
+            self.best_sim[src] = sim
+
+    def mutual_neighbours(self):
+        """
+        :return: the regions i whose nearest neighbour j is such that i is
+            the nearest neighbour of j, with i < j, and that pass thre_sim
+        """
+        cand = np.flatnonzero(self.best >= 0)
+        mutual = (self.best[self.best[cand]] == cand) & (cand < self.best[cand])
+        if not np.isnan(self.thre_sim):
+            if self.flag_sim:
+                mutual &= self.best_sim[cand] > self.thre_sim
+            else:
+                mutual &= self.best_sim[cand] < self.thre_sim
+        return cand[mutual]
+
+    def merge(self, src, dst, flag_means=True):
+        """
+        Merge the regions src into the regions dst, several regions can merge
+        into the same one
+        :param flag_means: update the average time series of dst
+        """
+        targets, inv = np.unique(dst, return_inverse=True)
+        sizes = self.sizes[targets] + np.bincount(inv, weights=self.sizes[src], minlength=targets.size)
+        if flag_means:
+            acc = self.means[targets] * self.sizes[targets][:, None]
+            np.add.at(acc, inv, self.means[src] * self.sizes[src][:, None])
+            self.means[targets] = acc / sizes[:, None]
+        self.sizes[targets] = sizes
+        self.sizes[src] = 0
+        self.parent[src] = dst
+
+    def grow(self):
+        """
+        Merge mutual nearest neighbours until none is left
+        """
+        n = self.n
+        self.lo, self.hi = self.lo0, self.hi0
+        self.sim = self.similarity(self.lo, self.hi)
+        self.best = np.full(n, -1, dtype=np.int64)
+        self.best_sim = np.full(n, self.nogo)
+        self.update_best(np.ones(n, dtype=bool))
+        adult = np.zeros(n, dtype=bool)
+        nb_rois = n
+
+        while nb_rois > self.thre_nb_rois:
+            reg1 = self.mutual_neighbours()
+            reg2 = self.best[reg1]
+            if reg1.size == 0 or nb_rois - reg1.size < self.thre_nb_rois:
+                break
+            nb_rois -= reg1.size
+
+            # Edges between a merged region and the rest of the graph
+            involved = np.zeros(n, dtype=bool)
+            involved[reg1] = True
+            involved[reg2] = True
+            changed = involved[self.lo] | involved[self.hi]
+            touched = np.zeros(n, dtype=bool)
+            touched[self.lo[changed]] = True
+            touched[self.hi[changed]] = True
+
+            self.merge(reg2, reg1)
+            adult[reg1[self.sizes[reg1] > self.thre_size]] = True
+
+            # Regions that grew past thre_size do not have neighbours anymore
+            a, b = self.parent[self.lo[changed]], self.parent[self.hi[changed]]
+            keep = (a != b) & ~adult[a] & ~adult[b]
+            a, b = unique_edges(np.minimum(a[keep], b[keep]), np.maximum(a[keep], b[keep]), n)
+            same = ~changed
+            self.lo = np.concatenate([self.lo[same], a])
+            self.hi = np.concatenate([self.hi[same], b])
+            self.sim = np.concatenate([self.sim[same], self.similarity(a, b)])
+            self.update_best(touched)
+
+    def merge_small(self):
+        """
+        Merge the regions smaller than thre_size in their closest neighbour
+        larger than thre_size
+        """
+        alive = np.ones(self.n, dtype=bool)
+        for _ in range(NB_ITER_SIZE):
+            labels = resolve(self.parent)
+            alive[:] = False
+            alive[labels] = True
+            small = alive & (self.sizes <= self.thre_size)
+            if not small.any():
+                return
+            a, b = labels[self.lo0], labels[self.hi0]
+            src, dst = np.concatenate([a, b]), np.concatenate([b, a])
+            sel = small[src] & ~small[dst]
+            if not sel.any():
+                return
+            src, dst = unique_edges(src[sel], dst[sel], self.n)
+            src, dst, sim = self.best_pairs(src, dst, self.similarity(src, dst, penalized=False))
+            # niak_region_growing keeps the time series of the large region
+            # as they were, only its size grows
+            self.merge(src, dst, flag_means=False)
+
+    def run(self):
+        """
+        :return: the partition, regions numbered from 1, 0 for voxels in a
+            sieved region
+        """
+        n = self.n
+        thre_size, thre_sim, thre_nb_rois = self.thre_size, self.thre_sim, self.thre_nb_rois
+        # For some values of the parameters, there is simply nothing to do
+        if thre_size <= 0 or thre_sim == self.nogo or thre_nb_rois >= n:
+            return np.arange(1, n + 1)
+        if thre_size >= n and thre_sim == -self.nogo and thre_nb_rois <= 1:
+            return np.ones(n, dtype=np.int64)
+
+        tseries = self.tseries
+        if self.flag_sim:
+            tseries = normalize(tseries, {"type": "mean_var"})
+        if self.sim_measure.endswith("_penalized"):
+            tseries = tseries / (tseries.max() * self.nt)
+        self.means = np.ascontiguousarray(tseries.T)
+        self.sizes = np.ones(n)
+        self.parent = np.arange(n)
+
+        self.grow()
+        if self.flag_size:
+            self.merge_small()
+
+        part = resolve(self.parent)
+        if self.flag_sieve:
+            part = np.where(self.sizes[part] < thre_size, -1, part)
+        labels, part = np.unique(part, return_inverse=True)
+        return part.ravel() + (0 if labels[0] == -1 else 1)
+
+
+def region_growing(tseries, lo, hi, opt=None):
+    """
+    :param opt: the options of niak_region_growing, thre_size is in voxels
+    :return: the partition of the voxels, see RegionGrowing
+    """
+    opt = defaults(opt, GROWING_DEFAULTS)
+    return RegionGrowing(tseries, lo, hi, **{k: opt[k] for k in GROWING_DEFAULTS}).run()
+
+
+def normalize(tseries, correction):
+    """
+    niak_normalize_tseries, for the 'none', 'mean' and 'mean_var' corrections
+    """
+    type_norm = correction.get("type", "mean_var") if isinstance(correction, dict) else correction
+    if type_norm == "none":
+        return np.asarray(tseries, dtype=np.float64)
+    if type_norm not in ["mean", "mean_var", "mean_var2"]:
+        raise ValueError("{0}: correction not supported by the python backend".format(type_norm))
+    return normalize_tseries(tseries, "mean" if type_norm == "mean" else "mean_var")
+
+
+def group_tseries(runs, opt):
+    """
+    Normalize each run with correction_ind, concatenate them and normalize
+    again with correction_group, like niak_brick_region_growing
+    :param runs: a list of arrays (time, voxels)
+    """
+    tseries = np.concatenate([normalize(r, opt["correction_ind"]) for r in runs], axis=0)
+    return normalize(tseries, opt["correction_group"])
+
+
+def brick_region_growing(files_in, files_out, opt=None):
+    """
+    Python version of niak_brick_region_growing, with the same inputs
+    """
+    opt = defaults(opt, BRICK_DEFAULTS)
+    runs = []
+    for path in files_in["tseries"]:
+        data = volumes.load_mat(path)
+        if opt["var_tseries"] not in data:
+            logging.warning("I could not find the time series {0} from the file {1}, I am going to assume that ROI "
+                            "is not in the field of view and produce an empty partition"
+                            .format(opt["var_tseries"], path))
+            volumes.save_mat(files_out, {"part": np.zeros((0, 0))})
+            return
+        runs.append(data[opt["var_tseries"]])
+    if len(set(r.shape[1] for r in runs)) > 1:
+        raise ValueError("All time series arrays should have the same spatial dimension")
+
+    data = volumes.load_mat(files_in["neig"])
+    graph = NeighbourGraph.from_neig(data[opt["var_neig"]])
+    opt_grow = dict((k, opt[k]) for k in GROWING_DEFAULTS)
+    opt_grow["thre_size"] = opt["thre_size"] / float(np.asarray(data["size_vox"]).ravel()[0])
+    part = region_growing(group_tseries(runs, opt), graph.lo, graph.hi, opt_grow)
+    volumes.save_mat(files_out, {"part": part.astype(np.float64).reshape(-1, 1)})
+
+
+def fmri2cell(fmri):
+    """
+    Like niak_fmri2cell
+    :param fmri: a list of files, or a dictionary subject: session: run: file
+    :return: the list of files and their labels, None if fmri is a list
+    """
+    if isinstance(fmri, (list, tuple)):
+        return list(fmri), None
+    files, labels = [], []
+    for subject in sorted(fmri):
+        for session in sorted(fmri[subject]):
+            for run in sorted(fmri[subject][session]):
+                files.append(fmri[subject][session][run])
+                labels.append("{0}_{1}_{2}".format(subject, session, run))
+    return files, labels
+
+
+def extract_tseries(path, ind, order, out_path, block_bytes=volumes.BLOCK_BYTES):
+    """
+    Read the voxels of a run into an array (voxels, time) on disk
+    :param ind: linear indices (column major) of the voxels to read
+    :param order: the row of each voxel of ind in the output
+    """
+    with volumes.Volume(path) as vol:
+        nx, ny = vol.shape[:2]
+        nt = vol.shape[3]
+        out = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float32, shape=(ind.size, nt))
+        for z in volumes.slabs(vol.shape, 8 * nt, block_bytes):
+            lo, hi = np.searchsorted(ind, [z.start * nx * ny, z.stop * nx * ny])
+            if lo == hi:
+                continue
+            block = vol.block(z).reshape(-1, nt, order="F")
+            out[order[lo:hi]] = block[ind[lo:hi] - z.start * nx * ny]
+        out.flush()
+        del out
+    return nt
+
+
+def _grow_area(job):
+    area, files, start, stop, lo, hi, opt = job
+    runs = [np.load(f, mmap_mode="r")[start:stop].T for f in files]
+    part = region_growing(group_tseries(runs, opt), lo, hi, opt["grow"])
+    return area, part
+
+
+def run(files_in, opt, n_workers=1, cache_dir=None):
+    """
+    Python version of niak_pipeline_region_growing, run in this process and
+    a pool of n_workers processes instead of PSOM jobs
+    :param files_in: {"fmri": ..., "areas": ..., "mask": ...}, as for the pipeline
+    :param opt: the options of the pipeline, the psom options are ignored
+    :return: the file of the regions (rois/brain_rois)
+    """
+    log = logging.getLogger(__file__)
+    opt = defaults(opt, PIPELINE_DEFAULTS)
+    if not opt["folder_out"]:
+        raise ValueError("Please specify OPT.FOLDER_OUT")
+    folder_out = opt["folder_out"]
+    fmri, labels = fmri2cell(files_in["fmri"])
+    labels = opt["labels"] or labels or ["file{0}".format(i + 1) for i in range(len(fmri))]
+    if not files_in.get("areas"):
+        raise ValueError("The python backend needs FILES_IN.AREAS, the default template is a MINC volume")
+    mask_file = files_in.get("mask") or files_in["areas"]
+    ext = volumes.fileparts(fmri[0])[2]
+    for folder in ["areas", "rois"]:
+        if not os.path.isdir(os.path.join(folder_out, folder)):
+            os.makedirs(os.path.join(folder_out, folder))
+
+    # Mask the areas
+    with volumes.Volume(files_in["areas"]) as vol_areas, volumes.Volume(mask_file) as vol_mask:
+        areas = np.round(vol_areas.read()).astype(np.int64)
+        brain_areas = np.where(vol_mask.read() > 0, areas, 0)
+        if volumes.fileparts(files_in["areas"])[1] == "template_aal":
+            list_roi = AAL_ROIS
+        else:
+            list_roi = [int(r) for r in np.unique(areas) if r != 0]
+        if opt["ind_rois"]:
+            brain_areas[~np.isin(brain_areas, opt["ind_rois"])] = 0
+        volumes.write_vol(os.path.join(folder_out, "areas", "brain_areas" + ext), vol_areas, brain_areas)
+
+        graph = NeighbourGraph.cached(brain_areas, opt["type_neig"], cache_dir)
+        size_vox = float(np.prod(vol_areas.header.get_zooms()[:3]))
+        area_graphs = graph.areas()
+
+    # Voxels are stored area after area, in the order of the graph within an area
+    order = np.empty(graph.ind.size, dtype=np.int64)
+    bounds = {}
+    start = 0
+    for area in sorted(area_graphs):
+        voxels = area_graphs[area][0]
+        order[voxels] = np.arange(start, start + voxels.size)
+        bounds[area] = (start, start + voxels.size)
+        start += voxels.size
+
+    opt_grow = dict((k, opt[k]) for k in GROWING_DEFAULTS if k in opt)
+    opt_grow["thre_size"] = opt["thre_size"] / size_vox
+    opt_job = {"correction_ind": opt["correction_ind"], "correction_group": opt["correction_group"],
+               "grow": opt_grow}
+
+    tmp_dir = tempfile.mkdtemp(prefix="niak_region_growing_", dir=volumes.scratch_dir())
+    pool = Pool(n_workers)
+    try:
+        files_tseries = [os.path.join(tmp_dir, "tseries_{0}.npy".format(i)) for i in range(len(fmri))]
+        for path, out_path in zip(fmri, files_tseries):
+            log.info("Read the time series of {0}".format(path))
+            extract_tseries(path, graph.ind, order, out_path)
+
+        # The largest areas first, so that workers end at about the same time
+        jobs = [(area, files_tseries) + bounds[area] + area_graphs[area][1:] + (opt_job,)
+                for area in sorted(area_graphs, key=lambda a: -area_graphs[a][0].size) if area in list_roi]
+        parts = {}
+        for area, part in pool.imap_unordered(_grow_area, jobs):
+            log.info("Area {0}: {1} regions".format(area, part.max() if part.size else 0))
+            parts[area] = part
+        for area in list_roi:
+            part = parts.get(area, np.zeros(0))
+            volumes.save_mat(os.path.join(folder_out, "areas", "part_areas_{0}.mat".format(area)),
+                             {"part": part.astype(np.float64).reshape(-1, 1) if part.size else np.zeros((0, 0))})
+
+        return merge_part(graph, area_graphs, bounds, parts, list_roi, files_tseries, labels, opt, ext)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def merge_part(graph, area_graphs, bounds, parts, list_roi, files_tseries, labels, opt, ext):
+    """
+    Number the regions of all areas, like niak_brick_merge_part
+    """
+    folder_out = opt["folder_out"]
+    rois = np.zeros(graph.ind.size, dtype=np.int64)
+    offsets = {}
+    nb_rois = 0
+    for area in list_roi:
+        part = parts.get(area)
+        if part is None or not part.size:
+            continue
+        rois[area_graphs[area][0]] = np.where(part > 0, part + nb_rois, 0)
+        offsets[area] = nb_rois
+        nb_rois += int(part.max())
+
+    space = np.zeros(int(np.prod(graph.shape)))
+    space[graph.ind] = rois
+    space = space.reshape(graph.shape, order="F")
+    file_rois = os.path.join(folder_out, "rois", "brain_rois" + ext)
+    with volumes.Volume(os.path.join(folder_out, "areas", "brain_areas" + ext)) as like:
+        volumes.write_vol(file_rois, like, space)
+
+    if opt["flag_tseries"]:
+        for path, label in zip(files_tseries, labels):
+            data = np.load(path, mmap_mode="r")
+            tseries = np.zeros((data.shape[1], nb_rois))
+            for area, offset in offsets.items():
+                start, stop = bounds[area]
+                voxels = normalize(np.asarray(data[start:stop], dtype=np.float64).T, opt["correction_average"])
+                part = parts[area]
+                for r in range(1, int(part.max()) + 1):
+                    tseries[:, offset + r - 1] = voxels[:, part == r].mean(axis=1)
+            volumes.save_mat(os.path.join(folder_out, "rois", "tseries_rois_{0}.mat".format(label)),
+                             {"tseries": tseries})
+    return file_rois
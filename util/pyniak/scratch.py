@@ -0,0 +1,231 @@
+"""
+Scratch space for NIAK runs.
+
+Each run gets its own scratch directory, on tmpfs when there is room, and
+PSOM jobs create their temporary folders in it (niak_path_tmp names them
+after the job). The run directory is exposed to octave through the
+NIAK_SCRATCH environment variable, a symbolic link that
+psom_gb_vars_local resolves when a job starts. When the tmpfs quota is
+reached the link is switched to node-local disk: running jobs keep their
+folder, new jobs spill over to disk. Passing the disk quota stops the run.
+
+Scratch is removed when the run ends, whatever the outcome. Directories
+left behind by a killed run are removed by the next run on the same node.
+"""
+__author__ = 'poquirion'
+
+import atexit
+import errno
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+SCRATCH_ENV = "NIAK_SCRATCH"
+TMPFS_ROOT = "/dev/shm"
+RUN_PREFIX = "niak_run_"
+# Quotas are given in MB
+MB = 1024 ** 2
+
+
+def disk_root():
+    """
+    :return: The node-local disk used for scratch, the first set of
+        NIAK_SCRATCH_ROOT, SLURM_TMPDIR, /localscratch/PBS_JOBID, TMPDIR, /tmp
+    """
+    pbs_jobid = os.getenv("PBS_JOBID")
+    candidates = [os.getenv("NIAK_SCRATCH_ROOT"),
+                  os.getenv("SLURM_TMPDIR"),
+                  "/localscratch/{0}".format(pbs_jobid) if pbs_jobid else None,
+                  tempfile.gettempdir()]
+    for root in candidates:
+        if root and os.path.isdir(root) and os.access(root, os.W_OK):
+            return root
+    return "/tmp"
+
+
+def free_space(path):
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def usage(path):
+    """
+    :return: The space used on disk by everything under path, in bytes
+    """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, f)).st_blocks * 512
+            except OSError:
+                # Jobs remove their temporary files while we walk
+                pass
+    return total
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def env_quota(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return float(value) * MB
+
+
+class ScratchManager(object):
+    """
+    Create, watch and remove the scratch directories of a run. Used as a
+    context manager:
+
+        with ScratchManager() as scratch:
+            p = subprocess.Popen(cmd, env=scratch.env())
+            scratch.watch(stop=p.kill)
+            p.wait()
+
+    :param tmpfs_quota: bytes allowed on tmpfs before spilling to disk,
+        NIAK_SCRATCH_TMPFS_QUOTA (MB) or half the free tmpfs space by default
+    :param disk_quota: bytes allowed on tmpfs and disk together,
+        NIAK_SCRATCH_QUOTA (MB) or no limit by default
+    :param interval: seconds between two usage checks
+    """
+
+    # Live managers, removed at exit if the interpreter did not get to
+    # their own clean up
+    _live = set()
+
+    def __init__(self, tmpfs_quota=None, disk_quota=None, tmpfs_root=TMPFS_ROOT, interval=10):
+
+        self.log = logging.getLogger(__file__)
+        self.tmpfs_root = tmpfs_root if os.path.isdir(tmpfs_root) and os.access(tmpfs_root, os.W_OK) else None
+        self.disk_root = disk_root()
+
+        if tmpfs_quota is None:
+            tmpfs_quota = env_quota("NIAK_SCRATCH_TMPFS_QUOTA",
+                                    free_space(self.tmpfs_root) // 2 if self.tmpfs_root else 0)
+        self.tmpfs_quota = tmpfs_quota
+        self.disk_quota = disk_quota if disk_quota is not None else env_quota("NIAK_SCRATCH_QUOTA", None)
+        self.interval = interval
+
+        self.tmpfs_dir = None
+        self.disk_dir = None
+        self.link = None
+        self.exceeded = False
+        self._stop = threading.Event()
+        self._watcher = None
+
+    @property
+    def prefix(self):
+        return "{0}{1}_{2}_".format(RUN_PREFIX, socket.gethostname(), os.getpid())
+
+    def reap(self):
+        """
+        Remove the scratch of runs on this node whose process is gone
+        """
+        host_prefix = "{0}{1}_".format(RUN_PREFIX, socket.gethostname())
+        for root in {self.tmpfs_root, self.disk_root} - {None}:
+            for name in os.listdir(root):
+                if not name.startswith(host_prefix):
+                    continue
+                try:
+                    pid = int(name[len(host_prefix):].split("_")[0])
+                except ValueError:
+                    continue
+                if not pid_alive(pid):
+                    self.log.info("Removing stale scratch {0}/{1}".format(root, name))
+                    self._remove("{0}/{1}".format(root, name))
+
+    def __enter__(self):
+        self.reap()
+        self.disk_dir = tempfile.mkdtemp(prefix=self.prefix, dir=self.disk_root)
+        if self.tmpfs_root and self.tmpfs_quota > 0:
+            self.tmpfs_dir = tempfile.mkdtemp(prefix=self.prefix, dir=self.tmpfs_root)
+        self.link = "{0}/current".format(self.disk_dir)
+        self._point_to(self.tmpfs_dir or self.disk_dir)
+        ScratchManager._live.add(self)
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+        return False
+
+    def env(self):
+        """
+        :return: A copy of the environment with the run scratch set
+        """
+        env = dict(os.environ)
+        env[SCRATCH_ENV] = self.link
+        return env
+
+    @property
+    def spilled(self):
+        return os.path.realpath(self.link) == os.path.realpath(self.disk_dir)
+
+    def _point_to(self, folder):
+        # Replace the link atomically, jobs may be resolving it
+        tmp_link = "{0}.{1}".format(self.link, os.getpid())
+        os.symlink(folder, tmp_link)
+        os.rename(tmp_link, self.link)
+
+    def check(self):
+        """
+        Spill new jobs to disk once tmpfs is full, flag the run when the
+        total quota is passed
+        :return: False if the run has to be stopped
+        """
+        tmpfs_used = usage(self.tmpfs_dir) if self.tmpfs_dir else 0
+        if self.tmpfs_dir and not self.spilled and tmpfs_used >= self.tmpfs_quota:
+            self.log.warning("Scratch uses {0:.0f} MB of tmpfs, new jobs will use {1}"
+                             .format(tmpfs_used / MB, self.disk_dir))
+            self._point_to(self.disk_dir)
+        if self.disk_quota is not None:
+            total = tmpfs_used + usage(self.disk_dir)
+            if total > self.disk_quota:
+                self.log.error("Scratch uses {0:.0f} MB, over the {1:.0f} MB quota"
+                               .format(total / MB, self.disk_quota / MB))
+                self.exceeded = True
+                return False
+        return True
+
+    def watch(self, stop=None):
+        """
+        Check usage every interval seconds in a background thread
+        :param stop: called once if the quota is exceeded
+        """
+        def loop():
+            while not self._stop.wait(self.interval):
+                if not self.check():
+                    if stop is not None:
+                        stop()
+                    return
+
+        self._watcher = threading.Thread(target=loop, name="niak_scratch_watcher")
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def _remove(self, folder):
+        shutil.rmtree(folder, ignore_errors=True)
+
+    def cleanup(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+        for folder in [self.tmpfs_dir, self.disk_dir]:
+            if folder is not None:
+                self._remove(folder)
+        ScratchManager._live.discard(self)
+
+
+@atexit.register
+def _cleanup_live():
+    for manager in list(ScratchManager._live):
+        manager.cleanup()
@@ -0,0 +1,471 @@
+"""
+Python backend of the subtype extension, see niak_brick_network_stack,
+niak_brick_subtyping and niak_brick_subtype_weight.
+
+The network stack (subjects x voxels) is written on disk as a .npy array
+and opened as a memory map, it is never loaded as a whole. Statistics are
+computed by blocks over a process pool:
+
+- the subject by subject correlation is computed by tiles, two blocks of
+  subjects at a time, each tile written in a memory mapped matrix;
+- subtype maps, t-tests and grand mean/std are sums over blocks of
+  subjects;
+- subtype weights are correlations of blocks of subjects with the
+  subtype maps.
+
+Only the similarity matrix (subjects x subjects) is held in memory, for
+the hierarchical clustering.
+
+The .mat file of a stack holds the provenance as in octave, and the name
+of the .npy file next to it which holds the stack itself. Stacks are
+stored in single precision.
+"""
+__author__ = 'poquirion'
+
+import csv
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import pyniak.volumes as volumes
+from pyniak.common import OMITTED, defaults, run_pool
+from pyniak.hierarchy import hier2order, hierarchical_clustering_vec, mat2vec, threshold_hierarchy
+
+STACK_DEFAULTS = {"folder_out": "", "network": 1, "regress_conf": []}
+SUBTYPE_DEFAULTS = {"folder_out": "", "nb_subtype": None, "sub_map_type": "mean", "type_sim": "ward"}
+WEIGHT_DEFAULTS = {"scales": None, "folder_out": ""}
+STACK_DTYPE = np.float32
+
+
+def read_model(path):
+    """
+    Like niak_read_csv
+    :return: the values (float, NaN if not a number), the labels of the
+        rows and the labels of the columns
+    """
+    with open(path) as fp:
+        sample = fp.readline()
+        fp.seek(0)
+        separator = next((s for s in [",", ";", "\t"] if s in sample), ",")
+        rows = [[c.strip().strip("'\"").strip() for c in row] for row in csv.reader(fp, delimiter=separator) if row]
+    labels_y = rows[0]
+    if len(labels_y) == len(rows[1]):
+        labels_y = labels_y[1:]
+    labels_x = [row[0] for row in rows[1:]]
+
+    def number(v):
+        try:
+            return float(v)
+        except ValueError:
+            return np.nan
+
+    values = np.array([[number(v) for v in row[1:]] for row in rows[1:]])
+    return values.reshape(len(labels_x), len(labels_y)), labels_x, labels_y
+
+
+def stack_file(path):
+    """
+    :return: the .npy file holding the stack described by the .mat file path
+    """
+    folder, name, ext = volumes.fileparts(path)
+    return os.path.join(folder, name + ".npy")
+
+
+def read_mask(path):
+    """
+    :return: the mask Volume and the linear indices (column major) of its voxels
+    """
+    vol = volumes.Volume(path)
+    mask = vol.read() > 0
+    return vol, np.flatnonzero(mask.ravel(order="F")), mask
+
+
+def row_blocks(n_rows, n_cols, block_bytes, itemsize=8):
+    """
+    :return: slices of rows holding about block_bytes each
+    """
+    step = max(1, int(block_bytes // max(n_cols * itemsize, 1)))
+    return [slice(r, min(r + step, n_rows)) for r in range(0, n_rows, step)]
+
+
+def _read_subject(job):
+    path, row, ind, network, out_path = job
+    with volumes.Volume(path) as vol:
+        data = vol.data[..., network - 1] if len(vol.shape) > 3 else vol.data
+        values = np.asarray(data).ravel(order="F")[ind]
+    stack = np.load(out_path, mmap_mode="r+")
+    stack[row] = values
+    stack.flush()
+
+
+def _regress_block(job):
+    out_path, cols, x, pinv_x = job
+    stack = np.load(out_path, mmap_mode="r+")
+    y = np.asarray(stack[:, cols], dtype=np.float64)
+    stack[:, cols] = y - x.dot(pinv_x.dot(y))
+    stack.flush()
+
+
+def network_stack(files_in, files_out, opt=None, n_workers=1, block_bytes=volumes.BLOCK_BYTES):
+    """
+    Python version of niak_brick_network_stack, for one network
+    :param files_in: {"data": {subject: file}, "mask": file, "model": csv file}
+    :param files_out: the .mat file of the provenance, the stack is written
+        next to it with a .npy extension
+    """
+    log = logging.getLogger(__file__)
+    opt = defaults(opt, STACK_DEFAULTS)
+    if not files_out:
+        if not opt["folder_out"]:
+            raise ValueError("Neither FILES_OUT nor OPT.FOLDER_OUT are specified. Won't generate any outputs")
+        files_out = os.path.join(opt["folder_out"], "network_stack.mat")
+    network = int(np.atleast_1d(opt["network"])[0])
+    list_data = list(files_in["data"])
+
+    model = files_in.get("model") or OMITTED
+    if model != OMITTED:
+        conf_model, list_subject, cat_names = read_model(model)
+        missing = [c for c in opt["regress_conf"] if c not in cat_names]
+        if missing:
+            raise ValueError("Some confounds could not be found in the model: {0}".format(", ".join(missing)))
+        conf_model = conf_model[:, [cat_names.index(c) for c in opt["regress_conf"]]]
+        keep = ~np.any(np.isnan(conf_model), axis=1)
+        if not keep.all():
+            log.warning("I had to remove {0} subjects who had missing values in their confounds: {1}"
+                        .format((~keep).sum(), ", ".join(s for s, k in zip(list_subject, keep) if not k)))
+        has_data = np.array([s in files_in["data"] for s in list_subject])
+        if not (has_data | ~keep).all():
+            log.warning("I had to remove {0} subjects who had missing imaging data: {1}"
+                        .format((keep & ~has_data).sum(),
+                                ", ".join(s for s, k, d in zip(list_subject, keep, has_data) if k and not d)))
+        keep &= has_data
+        conf_model = conf_model[keep]
+        list_subject = [s for s, k in zip(list_subject, keep) if k]
+    else:
+        list_subject = list_data
+
+    mask_vol, ind, mask = read_mask(files_in["mask"])
+    mask_vol.close()
+    with volumes.Volume(files_in["data"][list_subject[0]]) as vol:
+        scale = vol.shape[3] if len(vol.shape) > 3 else 1
+    if network > scale:
+        raise ValueError("You requested network #{0} to be investigated but the specified input only has {1} "
+                         "networks".format(network, scale))
+
+    folder = os.path.dirname(os.path.abspath(files_out))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    out_path = stack_file(files_out)
+    stack = np.lib.format.open_memmap(out_path, mode="w+", dtype=STACK_DTYPE, shape=(len(list_subject), ind.size))
+    del stack
+    log.info("Stacking {0} subjects x {1} voxels in {2}".format(len(list_subject), ind.size, out_path))
+    run_pool(_read_subject, [(files_in["data"][s], row, ind, network, out_path)
+                             for row, s in enumerate(list_subject)], n_workers)
+
+    provenance = {"subjects": np.array([[s, ""] for s in list_subject], dtype=object),
+                  "volume": {"network": float(network), "scale": float(scale), "mask": mask}}
+    if model != OMITTED:
+        x = np.column_stack([np.ones(len(list_subject)), conf_model])
+        provenance["model"] = {"matrix": x, "confounds": np.array(opt["regress_conf"], dtype=object)}
+        if opt["regress_conf"]:
+            pinv_x = np.linalg.pinv(x)
+            blocks = row_blocks(ind.size, len(list_subject), block_bytes)
+            run_pool(_regress_block, [(out_path, cols, x, pinv_x) for cols in blocks], n_workers)
+
+    volumes.save_mat(files_out, {"provenance": provenance, "stack_file": os.path.basename(out_path)})
+    return files_out
+
+
+class Stack(object):
+    """
+    A network stack written by network_stack
+    """
+
+    def __init__(self, path):
+        self.path = path
+        data = volumes.load_mat(path)
+        provenance = data["provenance"]
+        self.list_subject = [str(np.ravel(s)[0]) if np.size(s) else "" for s in provenance["subjects"][0, 0][:, 0]]
+        self.mask = np.asarray(provenance["volume"][0, 0]["mask"][0, 0], dtype=bool)
+        self.provenance = provenance
+        self.data_path = stack_file(path)
+        self.shape = np.load(self.data_path, mmap_mode="r").shape
+
+
+def _row_stats(job):
+    data_path, rows = job
+    x = np.asarray(np.load(data_path, mmap_mode="r")[rows], dtype=np.float64)
+    mean = x.mean(axis=1)
+    std = np.sqrt(((x - mean[:, None]) ** 2).sum(axis=1) / (x.shape[1] - 1))
+    return mean, std
+
+
+def _standard(data_path, rows, mean, std):
+    x = np.asarray(np.load(data_path, mmap_mode="r")[rows], dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (x - mean[rows, None]) / std[rows, None]
+
+
+def _sim_tile(job):
+    data_path, sim_path, rows_i, rows_j, mean, std = job
+    zi = _standard(data_path, rows_i, mean, std)
+    zj = zi if rows_i == rows_j else _standard(data_path, rows_j, mean, std)
+    tile = zi.dot(zj.T) / (zi.shape[1] - 1)
+    sim = np.load(sim_path, mmap_mode="r+")
+    sim[rows_i, rows_j] = tile
+    sim[rows_j, rows_i] = tile.T
+    sim.flush()
+
+
+def similarity_matrix(data_path, n_workers=1, block_bytes=volumes.BLOCK_BYTES):
+    """
+    The correlation between the rows of a stack, like niak_build_correlation
+    on its transpose, computed by tiles of two blocks of rows
+    :return: an array (subjects, subjects)
+    """
+    n_rows, n_cols = np.load(data_path, mmap_mode="r").shape
+    blocks = row_blocks(n_rows, n_cols, block_bytes // 2)
+    stats = run_pool(_row_stats, [(data_path, rows) for rows in blocks], n_workers)
+    mean = np.concatenate([s[0] for s in stats])
+    std = np.concatenate([s[1] for s in stats])
+
+    tmp_dir = tempfile.mkdtemp(prefix="niak_subtype_", dir=volumes.scratch_dir())
+    try:
+        sim_path = os.path.join(tmp_dir, "sim.npy")
+        sim = np.lib.format.open_memmap(sim_path, mode="w+", dtype=np.float64, shape=(n_rows, n_rows))
+        del sim
+        jobs = [(data_path, sim_path, blocks[i], blocks[j], mean, std)
+                for i in range(len(blocks)) for j in range(i, len(blocks))]
+        run_pool(_sim_tile, jobs, n_workers)
+        return np.array(np.load(sim_path, mmap_mode="r"))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _group_sums(job):
+    data_path, rows, part, nb_subtype, center = job
+    x = np.asarray(np.load(data_path, mmap_mode="r")[rows], dtype=np.float64)
+    indicator = (part[rows][None, :] == np.arange(1, nb_subtype + 1)[:, None]).astype(np.float64)
+    if center is None:
+        return indicator.dot(x), x.sum(axis=0)
+    dev = (x - center) ** 2
+    return indicator.dot(dev), dev.sum(axis=0)
+
+
+def _group_medians(job):
+    data_path, cols, part, nb_subtype = job
+    x = np.asarray(np.load(data_path, mmap_mode="r")[:, cols], dtype=np.float64)
+    return np.array([np.median(x[part == k], axis=0) for k in range(1, nb_subtype + 1)])
+
+
+def subtype_stats(data_path, part, nb_subtype, sub_map_type="mean", n_workers=1, block_bytes=volumes.BLOCK_BYTES):
+    """
+    The maps of niak_brick_subtyping, in two passes over the stack: the sums
+    of each subtype, then the squared deviations to the grand mean
+    :return: a dictionary with map, ttest, mean_eff, gd_mean and gd_std,
+        arrays (subtypes, voxels) or (1, voxels)
+    """
+    n_rows, n_cols = np.load(data_path, mmap_mode="r").shape
+    blocks = row_blocks(n_rows, n_cols, block_bytes)
+    counts = np.bincount(part, minlength=nb_subtype + 1)[1:].astype(np.float64)[:, None]
+
+    sums = run_pool(_group_sums, [(data_path, rows, part, nb_subtype, None) for rows in blocks], n_workers)
+    sum_k = sum(s[0] for s in sums)
+    total = sum(s[1] for s in sums)
+    gd_mean = total / n_rows
+    devs = run_pool(_group_sums, [(data_path, rows, part, nb_subtype, gd_mean) for rows in blocks], n_workers)
+    dev_k = sum(d[0] for d in devs)
+    dev_total = sum(d[1] for d in devs)
+
+    # Welch t-test of each subtype against the other subjects, like niak_ttest
+    mean_k = sum_k / counts
+    count_r = n_rows - counts
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_r = (total - sum_k) / count_r
+        var_k = np.where(counts > 1, (dev_k - counts * (mean_k - gd_mean) ** 2) / (counts - 1), 0)
+        var_r = np.where(count_r > 1, (dev_total - dev_k - count_r * (mean_r - gd_mean) ** 2) / (count_r - 1), 0)
+        mean_eff = mean_k - mean_r
+        ttest = mean_eff / np.sqrt(np.maximum(var_k, 0) / counts + np.maximum(var_r, 0) / count_r)
+
+    if sub_map_type == "median":
+        blocks = row_blocks(n_cols, n_rows, block_bytes)
+        maps = np.concatenate(run_pool(_group_medians, [(data_path, cols, part, nb_subtype) for cols in blocks],
+                                       n_workers), axis=1)
+    elif sub_map_type == "mean":
+        maps = mean_k
+    else:
+        raise ValueError("{0}: unknown type of subtype map".format(sub_map_type))
+    return {"map": maps, "ttest": ttest, "mean_eff": mean_eff, "gd_mean": gd_mean[None, :],
+            "gd_std": np.sqrt(dev_total / n_rows)[None, :]}
+
+
+def write_maps(path, mask_path, ind, maps):
+    """
+    Write maps (n, voxels) as a volume, like niak_tseries2vol
+    """
+    with volumes.Volume(mask_path) as like:
+        shape = like.shape[:3]
+        vol = np.zeros((int(np.prod(shape)), maps.shape[0]))
+        vol[ind] = maps.T
+        vol = vol.reshape(shape + (maps.shape[0],), order="F")
+        volumes.write_vol(path, like, vol if maps.shape[0] > 1 else vol[..., 0])
+
+
+def subtyping(files_in, files_out=None, opt=None, n_workers=1, block_bytes=volumes.BLOCK_BYTES):
+    """
+    Python version of niak_brick_subtyping, without the figures
+    :param files_in: {"data": the .mat file of a stack, "mask": file}
+    """
+    log = logging.getLogger(__file__)
+    opt = defaults(opt, SUBTYPE_DEFAULTS)
+    if opt["nb_subtype"] is None:
+        raise ValueError("Please specify OPT.NB_SUBTYPE")
+    nb_subtype = int(opt["nb_subtype"])
+    ext = volumes.fileparts(files_in["mask"])[2]
+    path_out = opt["folder_out"]
+    names = {"subtype": "subtype.mat", "subtype_map": "{0}_subtype{1}".format(opt["sub_map_type"], ext),
+             "grand_mean_map": "grand_mean" + ext, "grand_std_map": "grand_std" + ext,
+             "ttest_map": "ttest_subtype" + ext, "eff_map": "eff_subtype" + ext, "provenance": "provenance.mat"}
+    files_out = dict(files_out or {})
+    for key, name in names.items():
+        if key not in files_out:
+            files_out[key] = os.path.join(path_out, name) if path_out else OMITTED
+    for path in files_out.values():
+        folder = os.path.dirname(os.path.abspath(path))
+        if path != OMITTED and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    stack = Stack(files_in["data"])
+    log.info("Similarity of {0} subjects".format(stack.shape[0]))
+    sim_matrix = similarity_matrix(stack.data_path, n_workers, block_bytes)
+    log.info("Hierarchical clustering")
+    hier = hierarchical_clustering_vec(mat2vec(sim_matrix), type_sim=opt["type_sim"])
+    subj_order = hier2order(hier)
+    part = threshold_hierarchy(hier, nb_subtype)
+
+    sub = subtype_stats(stack.data_path, part, nb_subtype, opt["sub_map_type"], n_workers, block_bytes)
+    mask_vol, ind, mask = read_mask(files_in["mask"])
+    mask_vol.close()
+    for key, field in [("subtype_map", "map"), ("ttest_map", "ttest"), ("eff_map", "mean_eff"),
+                       ("grand_mean_map", "gd_mean"), ("grand_std_map", "gd_std")]:
+        if files_out[key] != OMITTED:
+            write_maps(files_out[key], files_in["mask"], ind, sub[field])
+
+    if files_out["subtype"] != OMITTED:
+        volumes.save_mat(files_out["subtype"], {
+            "subj_order": subj_order.astype(np.float64), "sim_matrix": sim_matrix, "sub": sub, "hier": hier,
+            "part": part.astype(np.float64), "list_subject": np.array(stack.list_subject, dtype=object)})
+    if files_out["provenance"] != OMITTED:
+        volumes.save_mat(files_out["provenance"], {"provenance": stack.provenance, "opt": opt})
+    return files_out
+
+
+def load_subtype_maps(path):
+    """
+    :return: the subtype maps (sub.map) of a subtype .mat file
+    """
+    return np.asarray(volumes.load_mat(path)["sub"]["map"][0, 0], dtype=np.float64)
+
+
+def _weights(job):
+    data_path, rows, maps = job
+    x = np.asarray(np.load(data_path, mmap_mode="r")[rows], dtype=np.float64)
+    x = x - x.mean(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x /= np.sqrt((x ** 2).sum(axis=1, keepdims=True))
+    return x.dot(maps.T)
+
+
+def write_weights_csv(path, weights, list_subject):
+    """
+    Like niak_write_csv with a precision of 3
+    """
+    with open(path, "w") as fp:
+        fp.write(",".join(['""'] + ['"sub{0}"'.format(k + 1) for k in range(weights.shape[1])]) + "\n")
+        for subject, row in zip(list_subject, weights):
+            fp.write(",".join(['"{0}"'.format(subject)] + ["{0:1.3f}".format(v) for v in row]) + "\n")
+
+
+def subtype_weight(files_in, files_out=None, opt=None, n_workers=1, block_bytes=volumes.BLOCK_BYTES):
+    """
+    Python version of niak_brick_subtype_weight, without the figures
+    :param files_in: {"data": {network: stack .mat file}, "subtype": {network: subtype .mat file}}
+    """
+    opt = defaults(opt, WEIGHT_DEFAULTS)
+    list_network = list(files_in["data"])
+    if sorted(files_in["subtype"]) != sorted(list_network):
+        raise ValueError("The order or set of networks in files_in.subtype and files_in.data does not match!")
+    scales = opt["scales"] or range(1, len(list_network) + 1)
+    path_out = opt["folder_out"]
+    files_out = dict(files_out or {})
+    if "weights" not in files_out:
+        files_out["weights"] = os.path.join(path_out, "subtype_weights.mat") if path_out else OMITTED
+    if "weights_csv" not in files_out:
+        files_out["weights_csv"] = [os.path.join(path_out, "sbt_weights_net_{0}.csv".format(s)) for s in scales] \
+            if path_out else []
+
+    weight_mat = None
+    for net_id, network in enumerate(list_network):
+        stack = Stack(files_in["data"][network])
+        maps = load_subtype_maps(files_in["subtype"][network])
+        maps = maps - maps.mean(axis=1, keepdims=True)
+        maps /= np.sqrt((maps ** 2).sum(axis=1, keepdims=True))
+        blocks = row_blocks(*stack.shape, block_bytes=block_bytes)
+        weights = np.clip(np.concatenate(run_pool(_weights, [(stack.data_path, rows, maps) for rows in blocks],
+                                                  n_workers)), -1, 1)
+        if weight_mat is None:
+            weight_mat = np.zeros(weights.shape + (len(list_network),))
+        weight_mat[:, :, net_id] = weights
+        if net_id < len(files_out["weights_csv"]):
+            write_weights_csv(files_out["weights_csv"][net_id], weights, stack.list_subject)
+
+    if files_out["weights"] != OMITTED:
+        volumes.save_mat(files_out["weights"], {"weight_mat": weight_mat,
+                                                "list_subject": np.array(stack.list_subject, dtype=object),
+                                                "list_network": np.array(list_network, dtype=object)})
+    return files_out
+
+
+def run(files_in, opt=None, n_workers=1, block_bytes=volumes.BLOCK_BYTES):
+    """
+    The stack, subtyping and weight extraction stages of niak_pipeline_subtype
+    :param files_in: {"data": {network: {subject: file}}, "mask": file, "model": csv file,
+        "subtype": {network: file} to extract weights on subtypes computed beforehand}
+    :param opt: {"folder_out": ..., "stack": {"regress_conf": [...]},
+        "subtype": {"nb_subtype": 2, "sub_map_type": "mean"}}
+    :return: the subtype weights file
+    """
+    log = logging.getLogger(__file__)
+    opt = defaults(opt, {"folder_out": None, "stack": {}, "subtype": {}})
+    if not opt["folder_out"]:
+        raise ValueError("Please specify OPT.FOLDER_OUT")
+    sub_opt = defaults(opt["subtype"], {"nb_subtype": 2, "sub_map_type": "mean"})
+    external = files_in.get("subtype") or OMITTED
+    list_net = list(files_in["data"])
+    if external != OMITTED and sorted(external) != sorted(list_net):
+        raise ValueError("The external networks in FILES_IN.SUBTYPE are different from those in FILES_IN.DATA. "
+                         "These have to be the same. Exiting!")
+
+    weight_in = {"data": {}, "subtype": {}}
+    weight_out = {"weights": os.path.join(opt["folder_out"], "subtype_weights.mat"), "weights_csv": []}
+    for net_name in list_net:
+        log.info("Network {0}".format(net_name))
+        network_folder = os.path.join(opt["folder_out"], "networks", net_name)
+        stack_opt = dict(opt["stack"], network=1)
+        weight_in["data"][net_name] = network_stack(
+            {"data": files_in["data"][net_name], "mask": files_in["mask"], "model": files_in.get("model")},
+            os.path.join(network_folder, "stack_{0}.mat".format(net_name)), stack_opt, n_workers, block_bytes)
+        weight_out["weights_csv"].append(os.path.join(network_folder, "sbt_weights_net_{0}.csv".format(net_name)))
+        if external == OMITTED:
+            sub_out = subtyping({"data": weight_in["data"][net_name], "mask": files_in["mask"]},
+                                {"subtype": os.path.join(network_folder, "subtype_{0}.mat".format(net_name))},
+                                dict(sub_opt, folder_out=network_folder), n_workers, block_bytes)
+            weight_in["subtype"][net_name] = sub_out["subtype"]
+        else:
+            weight_in["subtype"][net_name] = external[net_name]
+
+    subtype_weight(weight_in, weight_out, {"folder_out": opt["folder_out"]}, n_workers, block_bytes)
+    return weight_out["weights"]
@@ -0,0 +1,185 @@
+"""
+The python confound bricks on a small synthetic run, against a dense
+transcription of niak_brick_build_confounds and niak_brick_regress_confounds
+"""
+__author__ = 'poquirion'
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from pyniak.common import OMITTED
+
+try:
+    import nibabel
+    import scipy.io
+    deps_loaded = True
+except ImportError:
+    deps_loaded = False
+
+NT = 50
+SHAPE = (6, 5, 4)
+TR = 2.
+
+
+def rigid(angles, shift):
+    """
+    :return: a 4x4 transformation, rotations around x, y and z (radians) then a translation
+    """
+    transf = np.eye(4)
+    for axis, angle in enumerate(angles):
+        i, j = [a for a in range(3) if a != axis]
+        rot = np.eye(4)
+        rot[[i, i, j, j], [i, j, i, j]] = [np.cos(angle), -np.sin(angle), np.sin(angle), np.cos(angle)]
+        transf = rot.dot(transf)
+    transf[:3, 3] = shift
+    return transf
+
+
+@unittest.skipUnless(deps_loaded, "nibabel and scipy are needed")
+class TestConfounds(unittest.TestCase):
+
+    def setUp(self):
+        # Imported here, the test is skipped without nibabel
+        import pyniak.confounds
+        import pyniak.volumes
+        self.confounds = pyniak.confounds
+        self.volumes = pyniak.volumes
+
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        t = np.arange(NT)
+        common = np.sin(t / 3.)
+        vol = 100 + rng.randn(*(SHAPE + (NT,))) + common * rng.rand(*SHAPE)[..., None]
+        self.vol = vol
+        self.brain = np.zeros(SHAPE)
+        self.brain[1:-1, 1:-1, :] = 1
+        self.wm = np.zeros(SHAPE)
+        self.wm[1:3, 1:3, :2] = 1
+        self.vent = np.zeros(SHAPE)
+        self.vent[3:5, 2:4, 2:] = 1
+
+        self.files_in = {"fmri": self.write_nii("fmri.nii", vol),
+                         "mask_brain": self.write_nii("brain.nii", self.brain),
+                         "mask_wm": self.write_nii("wm.nii", self.wm),
+                         "mask_vent": self.write_nii("vent.nii", self.vent),
+                         "motion_param": self.path("motion.mat"),
+                         "dc_low": self.path("dc_low.mat"),
+                         "dc_high": self.path("dc_high.mat")}
+        self.time_frames = t * TR
+        scipy.io.savemat(self.path("fmri_extra.mat"), {"time_frames": self.time_frames, "comment": "x"})
+
+        jump = np.where(t >= 30, 0.8, 0.)
+        transf = np.stack([rigid(0.0005 * np.sin([n, 2 * n, 3 * n]), [0.02 * n + jump[n], 0.01 * np.cos(n), 0.005 * n])
+                           for n in t], axis=2)
+        scipy.io.savemat(self.files_in["motion_param"], {"transf": transf})
+        self.slow_drift = np.cos(np.pi * np.outer(t + 0.5, np.arange(1, 3)) / NT)
+        scipy.io.savemat(self.files_in["dc_low"], {"tseries_dc_low": np.column_stack([np.ones(NT), self.slow_drift])})
+        scipy.io.savemat(self.files_in["dc_high"], {"tseries_dc_high": np.zeros((0, 0))})
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def write_nii(self, name, values):
+        img = nibabel.Nifti1Image(values.astype(np.float32), np.diag([3., 3., 3., 1.]))
+        img.header.set_xyzt_units("mm", "sec")
+        img.header["pixdim"][4] = TR
+        nibabel.save(img, self.path(name))
+        return self.path(name)
+
+    def build(self):
+        files_out = {"confounds": self.path("confounds.tsv.gz")}
+        self.confounds.build_confounds(self.files_in, files_out, {"flag_verbose": False})
+        return self.volumes.read_csv(files_out["confounds"])
+
+    def test_build_confounds(self):
+        labels, x = self.build()
+        labels = np.array(labels)
+        # The compcor mask is not in files_out, it is omitted
+        self.assertEqual(glob.glob(self.path("*compcor_mask*")), [])
+
+        y = self.vol.reshape(-1, NT).T
+        y_mean = y - y.mean(axis=0)
+        self.assertTrue(np.allclose(x[:, labels == "wm_avg"].ravel(), y_mean[:, self.wm.ravel() > 0].mean(axis=1),
+                                    atol=1e-5))
+        self.assertTrue(np.allclose(x[:, labels == "vent_avg"].ravel(),
+                                    y_mean[:, self.vent.ravel() > 0].mean(axis=1), atol=1e-5))
+        self.assertTrue(np.allclose(x[:, labels == "slow_drift"], self.slow_drift, atol=1e-6))
+
+        fd = x[:, labels == "FD"].ravel()
+        self.assertEqual(fd[-1], 0)
+        self.assertGreater(fd[29], 0.5)
+        scrub = x[:, labels == "scrub"].ravel().astype(bool)
+        expected = (self.time_frames >= self.time_frames[29] - 3) & (self.time_frames <= self.time_frames[29] + 6)
+        self.assertTrue(np.array_equal(scrub, expected))
+
+        # sub_pc_spatial_av, the principal component the closest to the global average
+        tseries = y[:, self.brain.ravel() > 0]
+        u = np.linalg.svd(tseries, full_matrices=False)[0]
+        av = tseries.mean(axis=1)
+        av = (av - av.mean()) / av.std(ddof=1)
+        u = (u - u.mean(axis=0)) / u.std(axis=0, ddof=1)
+        pc = u[:, np.argmax(np.abs(av.dot(u)))]
+        pc *= np.sign(pc.dot(av))
+        self.assertTrue(np.allclose(x[:, labels == "global_signal_pca"].ravel(), pc, atol=1e-4))
+
+    def test_regress_confounds(self):
+        labels, x = self.build()
+        labels = np.array(labels)
+        files_in = {"fmri": self.files_in["fmri"], "confounds": self.path("confounds.tsv.gz")}
+        files_out = {"filtered_data": self.path("fmri_cor.nii")}
+        os.makedirs(self.path("out"))
+        self.confounds.regress_confounds([(files_in, files_out, {"flag_verbose": False}),
+                                          (files_in, {"filtered_data": OMITTED, "scrubbing": ""},
+                                           {"folder_out": self.path("out"), "flag_verbose": False})])
+        # A missing output is omitted, an empty one gets its default name
+        self.assertFalse(os.path.exists(self.path("fmri_scrub.mat")))
+        self.assertTrue(os.path.exists(os.path.join(self.path("out"), "fmri_scrub.mat")))
+
+        # Lines 190 to 330 of niak_brick_regress_confounds, default options
+        scrub = x[:, labels == "scrub"].ravel().astype(bool)
+        keep = ~scrub
+
+        def norm(a):
+            return (a - a.mean(axis=0)) / a.std(axis=0, ddof=1)
+
+        motion = np.column_stack([norm(x[:, np.isin(labels, ["motion_rx", "motion_ry", "motion_rz"])]),
+                                  norm(x[:, np.isin(labels, ["motion_tx", "motion_ty", "motion_tz"])])])
+        motion = np.column_stack([motion, motion ** 2])
+        u, sing = np.linalg.svd(motion, full_matrices=False)[:2]
+        nb_comp = int(np.flatnonzero(np.cumsum(sing ** 2) / np.sum(sing ** 2) > 0.95)[0]) + 1
+        x2 = np.column_stack([x[:, labels == "slow_drift"], u[:, :nb_comp],
+                              x[:, labels == "wm_avg"], x[:, labels == "vent_avg"]])
+        y = self.vol.reshape(-1, NT).T
+        y_mean = y[keep].mean(axis=0)
+        y_n = (y - y_mean) / y[keep].std(axis=0, ddof=1)
+        x2 = (x2 - x2[keep].mean(axis=0)) / x2[keep].std(axis=0, ddof=1)
+        beta = np.linalg.lstsq(x2[keep], y_n[keep], rcond=None)[0]
+        expected = (y_n - x2.dot(beta) + y_mean).T.reshape(self.vol.shape)
+
+        result = nibabel.load(files_out["filtered_data"]).get_fdata()
+        self.assertTrue(np.allclose(result, expected, rtol=1e-5, atol=1e-3))
+
+        extra = self.volumes.load_mat(self.path("fmri_cor_extra.mat"))
+        self.assertTrue(np.array_equal(extra["mask_scrubbing"].ravel().astype(bool), scrub))
+        self.assertEqual(extra["confounds"].shape, x2.shape)
+
+    def test_no_extra_without_time_frames(self):
+        os.remove(self.path("fmri_extra.mat"))
+        self.build()
+        files_in = {"fmri": self.files_in["fmri"], "confounds": self.path("confounds.tsv.gz")}
+        files_out = {"filtered_data": self.path("fmri_cor.nii")}
+        self.confounds.regress_confounds([(files_in, files_out, {"flag_verbose": False})])
+        # niak_write_vol only writes the companion when it has time_frames
+        self.assertTrue(os.path.exists(files_out["filtered_data"]))
+        self.assertFalse(os.path.exists(self.path("fmri_cor_extra.mat")))
+
+if __name__ == "__main__":
+    unittest.main()
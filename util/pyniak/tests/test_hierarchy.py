@@ -0,0 +1,45 @@
+"""
+The vectorized hierarchical clustering, used by the subtype and
+stability_tseries backends, against the port of the octave code on a
+square matrix.
+"""
+__author__ = 'poquirion'
+
+import unittest
+
+import numpy as np
+
+from pyniak.hierarchy import hierarchical_clustering, hierarchical_clustering_vec, mat2vec
+from pyniak.kmeans import Kernel
+
+TYPES_SIM = ["single", "complete", "average", "ward"]
+
+
+def random_sim(n, rng):
+    """
+    :return: a random symmetric similarity matrix (n, n)
+    """
+    x = rng.randn(n, 5)
+    return -((x[:, None, :] - x[None, :, :]) ** 2).sum(axis=2)
+
+
+class TestHierarchy(unittest.TestCase):
+
+    def test_vec_matches_square(self):
+        rng = np.random.RandomState(0)
+        for n in [7, 60]:
+            sim = random_sim(n, rng)
+            p = rng.rand(n) + 0.5
+            for type_sim in TYPES_SIM:
+                hier = hierarchical_clustering(sim.copy(), p=p.copy(), type_sim=type_sim)
+                hier_vec = hierarchical_clustering_vec(mat2vec(sim), p=p.copy(), type_sim=type_sim)
+                self.assertTrue(np.allclose(hier, hier_vec), "{0}, n={1}".format(type_sim, n))
+
+    def test_kernel_sq_distances_vec(self):
+        rng = np.random.RandomState(1)
+        kernel = Kernel(rng.randn(30, 50), rng.rand(30) + 0.5, "mean_var")
+        self.assertTrue(np.allclose(kernel.sq_distances_vec(), mat2vec(kernel.sq_distances())))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+"""
+The stages and subjects of the jobs of NIAK pipelines in the job index
+"""
+__author__ = 'poquirion'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyniak.job_index import JobIndex, split_job_name
+
+# Jobs of niak_pipeline_fmri_preprocess for one run of subject1
+FMRI_PREPROCESS_JOBS = {
+    "t1_preprocess_subject1": "t1_preprocess",
+    "pve_subject1": "t1_preprocess",
+    "slice_timing_subject1_session1_rest": "slice_timing",
+    "motion_target_subject1_session1_rest": "motion_correction",
+    "motion_parameters_subject1_session1_rest": "motion_correction",
+    "qc_motion_subject1": "motion_correction",
+    "anat2func_subject1": "resample_vol",
+    "resample_subject1_session1_rest": "resample_vol",
+    "time_filter_subject1_session1_rest": "time_filter",
+    "build_confounds_subject1_session1_rest": "build_confounds",
+    "regress_confounds_subject1_session1_rest": "regress_confounds",
+    "mask_confounds_subject1": "corsica",
+    "corsica_mask_brain_subject1_rest": "corsica",
+    "sica_subject1_rest": "corsica",
+    "component_sel_ventricle_subject1_rest": "corsica",
+    "component_supp_subject1_rest": "corsica",
+    "qc_corsica_subject1_rest": "corsica",
+    "smooth_subject1_session1_rest": "smooth_vol",
+}
+
+
+class TestJobIndex(unittest.TestCase):
+
+    def test_fmri_preprocess_stages(self):
+        for name, stage in FMRI_PREPROCESS_JOBS.items():
+            self.assertEqual(split_job_name(name), (stage, "subject1"), name)
+
+    def test_group_jobs(self):
+        self.assertEqual(split_job_name("qc_group_motion_estimation"), ("motion_correction", None))
+        self.assertEqual(split_job_name("resample_aal"), ("resample_vol", None))
+
+    def test_failed_in_stage(self):
+        path_logs = tempfile.mkdtemp()
+        try:
+            for name in FMRI_PREPROCESS_JOBS:
+                tag = "failed" if FMRI_PREPROCESS_JOBS[name] == "corsica" else "finished"
+                open(os.path.join(path_logs, "{0}.{1}".format(name, tag)), "w").close()
+            index = JobIndex(path_logs)
+            index.update()
+            expected = sorted(n for n, s in FMRI_PREPROCESS_JOBS.items() if s == "corsica")
+            self.assertEqual(index.failed_jobs(stage="corsica"), expected)
+            self.assertEqual(index.subjects(status="failed", stage="corsica"), ["subject1"])
+        finally:
+            shutil.rmtree(path_logs)
+
+
+if __name__ == "__main__":
+    unittest.main()
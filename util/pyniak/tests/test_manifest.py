@@ -0,0 +1,68 @@
+"""
+The plan of a manifest: the stages shared by the variants are computed once
+"""
+__author__ = 'poquirion'
+
+import collections
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyniak.manifest import Manifest
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def manifest(self, variants, **kwargs):
+        path = os.path.join(self.folder, "manifest.json")
+        content = {"pipeline": "Niak_fmri_preprocess", "file_in": self.folder,
+                   "folder_out": os.path.join(self.folder, "sweep"),
+                   "options": {"--opt-time_filter-hp": 0.01}, "variants": variants}
+        content.update(kwargs)
+        with open(path, "w") as fp:
+            json.dump(content, fp)
+        return Manifest(path)
+
+    def stage_runs(self, manifest):
+        """
+        :return: {stage: number of times it is computed by the plan}
+        """
+        runs = collections.Counter()
+        for chain in manifest.plan():
+            for _, stages in manifest.computed_stages(chain):
+                runs.update(stages)
+        return runs
+
+    def test_shared_preprocessing_runs_once(self):
+        variants = [{"name": "fd_{0}".format(n), "options": {"--opt-regress_confounds-thre_fd": 0.1 * n}}
+                    for n in range(1, 7)]
+        variants.append({"name": "fwhm_8", "options": {"--opt-smooth_vol-fwhm": 8}})
+        manifest = self.manifest(variants)
+        runs = self.stage_runs(manifest)
+
+        self.assertEqual(len(manifest.chains), 1)
+        stages = manifest.pipeline_class.STAGES
+        for stage in stages[:stages.index("regress_confounds")]:
+            self.assertEqual(runs[stage], 1, stage)
+        # fd_5 has the default threshold, like fwhm_8 up to smooth_vol
+        self.assertEqual(runs["regress_confounds"], 6)
+        self.assertEqual(runs["smooth_vol"], 7)
+
+    def test_identical_variants_are_aliases(self):
+        manifest = self.manifest([{"name": "a", "options": {"--opt-smooth_vol-fwhm": 8}},
+                                  {"name": "b", "options": {"--opt-smooth_vol-fwhm": 8}}])
+        chains = manifest.plan()
+        self.assertEqual([[v.name for v in c] for c in chains], [["a"]])
+        self.assertEqual(chains[0][0].aliases, ["b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+The flat octave path file and its stamp
+"""
+__author__ = 'poquirion'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyniak import octave_path
+
+
+class TestOctavePath(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        # Outside of the tree, writing it would change the stamp
+        self.config = tempfile.mkdtemp()
+        self.path_file = os.path.join(self.config, octave_path.PATH_FILE)
+        for path in ["commands/niak_a.m", "demos/niak_demo_a.m", "examples/ex.m", "commands/private/p.m",
+                     "extensions/README"]:
+            self.touch(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.config)
+
+    def touch(self, path):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "w").close()
+
+    def listed(self):
+        with open(self.path_file) as fp:
+            return fp.read()
+
+    def test_function_dirs(self):
+        dirs = octave_path.function_dirs(self.root)
+        self.assertEqual(dirs, [os.path.join(os.path.realpath(self.root), d) for d in ["commands", "demos"]])
+
+    def test_new_function_dir_under_a_dir_without_functions(self):
+        self.assertTrue(octave_path.setup(self.path_file, root=self.root))
+        self.assertFalse(octave_path.setup(self.path_file, root=self.root))
+        self.assertNotIn("toolbox", self.listed())
+        # A class below a directory with no function, only the mtime of
+        # that directory changes
+        self.touch("extensions/toolbox/@table/table.m")
+        self.assertTrue(octave_path.setup(self.path_file, root=self.root))
+        self.assertIn(os.path.join("extensions", "toolbox"), self.listed())
+        self.assertNotIn("@table", self.listed())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+Region growing on a small synthetic volume with a known partition
+"""
+__author__ = 'poquirion'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from pyniak.region_growing import NeighbourGraph, region_growing
+
+# Signals of the voxels: 0 and 1 for two large halves, 2 for a region of
+# two voxels between them, weakly correlated with the half 1
+LARGE_A, LARGE_B, SMALL = 0, 1, 2
+
+
+class TestRegionGrowing(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        nt = 60
+        signals = rng.randn(3, nt)
+        signals[SMALL] += 0.4 * signals[LARGE_B]
+        self.mask = np.ones((8, 3, 2))
+        truth = np.where(np.arange(8) < 4, LARGE_A, LARGE_B)[:, None, None] * np.ones((8, 3, 2), dtype=int)
+        truth[4, :2, 0] = SMALL
+        self.graph = NeighbourGraph.build(self.mask)
+        self.truth = truth.ravel(order="F")[self.graph.ind]
+        self.tseries = np.array([signals[s] + 0.1 * rng.randn(nt) for s in self.truth]).T
+
+    def test_known_partition(self):
+        part = region_growing(self.tseries, self.graph.lo, self.graph.hi, {"thre_sim": 0.5, "flag_size": False})
+        # Same partition as the truth, up to the numbering of the regions
+        pairs = set(zip(part, self.truth))
+        self.assertEqual(len(pairs), 3)
+        self.assertEqual(len(set(part)), 3)
+
+    def test_minimum_size(self):
+        thre_size = 5
+        part = region_growing(self.tseries, self.graph.lo, self.graph.hi, {"thre_sim": 0.5, "thre_size": thre_size})
+        sizes = np.bincount(part)[1:]
+        self.assertGreater(sizes.min(), thre_size)
+        for label in set(part):
+            self.assertFalse({LARGE_A, LARGE_B} <= set(self.truth[part == label]), label)
+        # The small region went to its most similar large neighbour
+        small = set(part[self.truth == SMALL])
+        self.assertEqual(len(small), 1)
+        self.assertIn(LARGE_B, set(self.truth[part == small.pop()]))
+
+    def test_neighbour_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            graph = NeighbourGraph.cached(self.mask, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached = NeighbourGraph.cached(self.mask, cache_dir=cache_dir)
+            for key in ["ind", "labels", "lo", "hi"]:
+                self.assertTrue(np.array_equal(getattr(graph, key), getattr(cached, key)), key)
+                self.assertTrue(np.array_equal(getattr(graph, key), getattr(self.graph, key)), key)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_neighbours(self):
+        # 26-connexity in a 2x2x1 volume, every pair of voxels is an edge
+        graph = NeighbourGraph.build(np.ones((2, 2, 1)))
+        self.assertEqual(sorted(zip(graph.lo, graph.hi)), [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,420 @@
+"""
+Read and write the files of NIAK bricks from python.
+
+Volumes are NIfTI files opened as memory maps, gzipped ones are first
+decompressed in the run scratch (see pyniak.scratch), so that bricks can
+walk them in blocks of slices instead of loading whole 4D runs. The
+helpers for .mat, csv/tsv and _extra.mat side files follow what
+niak_read_vol, niak_write_vol and niak_write_csv_cell do.
+
+MINC volumes can be read (MincVolume, through nibabel, h5py is needed for
+MINC2), to compare the outputs of the octave bricks, but not written.
+"""
+__author__ = 'poquirion'
+
+import gzip
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+try:
+    import nibabel
+    nibabel_loaded = True
+except ImportError:
+    nibabel_loaded = False
+
+try:
+    import scipy.io
+    scipy_loaded = True
+except ImportError:
+    scipy_loaded = False
+
+NIFTI_OFFSET = 352
+NIFTI_EXT = [".nii", ".nii.gz"]
+MINC_EXT = [".mnc", ".mnc.gz"]
+# Default memory allowed for the data of one block, in bytes
+BLOCK_BYTES = 256 * 1024 ** 2
+
+
+def scratch_dir():
+    """
+    :return: The scratch folder of the current run, or the system temp folder
+    """
+    scratch = os.getenv("NIAK_SCRATCH")
+    if scratch:
+        return os.path.realpath(scratch)
+    return tempfile.gettempdir()
+
+
+def require(flag, name):
+    if not flag:
+        raise ImportError("{0} is needed to run NIAK bricks from pyniak".format(name))
+
+
+def fileparts(path):
+    """
+    Like niak_fileparts
+    :return: folder, name without extension, extension (.nii.gz counts as one)
+    """
+    folder, base = os.path.split(path)
+    name, ext = os.path.splitext(base)
+    if ext == ".gz":
+        name, ext2 = os.path.splitext(name)
+        ext = ext2 + ext
+    return folder, name, ext
+
+
+def extra_path(path):
+    folder, name, ext = fileparts(path)
+    return os.path.join(folder, "{0}_extra.mat".format(name))
+
+
+def write_extra(path, extra, nt):
+    """
+    Write the _extra.mat companion of a 3D+t volume the way niak_write_vol
+    does: only if it holds more than one variable, including time_frames
+    with one entry per volume
+    :param path: the volume, not its companion
+    :param nt: the number of volumes
+    :return: True if the companion was written
+    """
+    if len(extra) > 1 and np.size(extra.get("time_frames", [])) == nt:
+        save_mat(extra_path(path), extra)
+        return True
+    return False
+
+
+class Volume(object):
+    """
+    A NIfTI volume, data is a read only memory map in voxel order (x, y, z, t)
+    """
+
+    def __init__(self, path):
+
+        require(nibabel_loaded, "nibabel")
+        if fileparts(path)[2] not in NIFTI_EXT:
+            raise ValueError("{0}: only NIfTI volumes are supported".format(path))
+        self.path = path
+        self._tmp = None
+        source = path
+        if path.endswith(".gz"):
+            fd, self._tmp = tempfile.mkstemp(prefix="niak_vol_", suffix=".nii", dir=scratch_dir())
+            with os.fdopen(fd, "wb") as out, gzip.open(path, "rb") as fp:
+                shutil.copyfileobj(fp, out, 16 * 1024 ** 2)
+            source = self._tmp
+        self.img = nibabel.load(source, mmap=True)
+        self.header = self.img.header
+        self.affine = self.img.affine
+        self.shape = self.img.shape
+        self.data = self.img.dataobj
+
+    @property
+    def zooms(self):
+        """
+        :return: the size of the voxels (and the TR), in the order of data
+        """
+        return tuple(self.header.get_zooms())
+
+    @property
+    def units(self):
+        return self.header.get_xyzt_units()
+
+    @property
+    def tr(self):
+        """
+        :return: the repetition time in seconds
+        """
+        zooms = self.header.get_zooms()
+        if len(zooms) < 4:
+            return None
+        units = self.header.get_xyzt_units()[1]
+        return zooms[3] / 1000. if units == "msec" else float(zooms[3])
+
+    def block(self, z_slice):
+        """
+        :return: the voxels of a slab of slices, an array (x, y, nz[, t]) of floats
+        """
+        return np.asarray(self.data[:, :, z_slice], dtype=np.float64)
+
+    def read(self):
+        return np.asarray(self.data, dtype=np.float64)
+
+    def extra(self):
+        """
+        :return: the content of the _extra.mat file, an empty dictionary if
+            there is none
+        """
+        if os.path.exists(extra_path(self.path)):
+            return load_mat(extra_path(self.path))
+        return {}
+
+    def close(self):
+        self.data = None
+        self.img = None
+        if self._tmp is not None and os.path.exists(self._tmp):
+            os.remove(self._tmp)
+        self._tmp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+
+class MincVolume(Volume):
+    """
+    A MINC volume, read as a whole. MINC stores the dimensions from the
+    slowest (time) to the fastest (xspace), they are reversed so that data
+    is in voxel order (x, y, z, t) as for a NIfTI Volume.
+    """
+
+    def __init__(self, path):
+
+        require(nibabel_loaded, "nibabel")
+        if fileparts(path)[2] not in MINC_EXT:
+            raise ValueError("{0}: not a MINC volume".format(path))
+        self.path = path
+        self._tmp = None
+        source = path
+        # MINC2 files are HDF5, which can not be read from a gzip stream
+        if path.endswith(".gz"):
+            fd, self._tmp = tempfile.mkstemp(prefix="niak_vol_", suffix=".mnc", dir=scratch_dir())
+            with os.fdopen(fd, "wb") as out, gzip.open(path, "rb") as fp:
+                shutil.copyfileobj(fp, out, 16 * 1024 ** 2)
+            source = self._tmp
+        self.img = nibabel.load(source)
+        self.header = self.img.header
+        self.affine = self.img.affine
+        self.data = np.asarray(self.img.dataobj).T
+        self.shape = self.data.shape
+
+    @property
+    def zooms(self):
+        return tuple(reversed(self.header.get_zooms()))
+
+    @property
+    def units(self):
+        # Millimeters and seconds in MINC
+        return "mm", "sec"
+
+    @property
+    def tr(self):
+        return float(self.zooms[3]) if len(self.shape) > 3 else None
+
+
+def open_volume(path):
+    """
+    :return: a MincVolume for a MINC file, a Volume otherwise
+    """
+    if fileparts(path)[2] in MINC_EXT:
+        return MincVolume(path)
+    return Volume(path)
+
+
+class OutputVolume(object):
+    """
+    A NIfTI volume written block by block through a memory map. Gzipped
+    outputs are written in the scratch first and compressed on close.
+
+    :param path: the file to write
+    :param like: a Volume to copy the header from
+    :param shape: the shape of the data, the one of like by default
+    """
+
+    def __init__(self, path, like, shape=None, dtype=np.float32):
+
+        require(nibabel_loaded, "nibabel")
+        self.path = path
+        shape = tuple(like.shape if shape is None else shape)
+        self.shape = shape
+
+        header = nibabel.Nifti1Header()
+        for key in ["pixdim", "qform_code", "sform_code", "xyzt_units", "descrip"]:
+            if key in like.header:
+                header[key] = like.header[key]
+        header.set_qform(like.header.get_qform(), int(header["qform_code"]))
+        header.set_sform(like.header.get_sform(), int(header["sform_code"]))
+        header.set_data_shape(shape)
+        header.set_data_dtype(dtype)
+        header["vox_offset"] = NIFTI_OFFSET
+        header["scl_slope"] = 1
+        header["scl_inter"] = 0
+        header["cal_min"] = 0
+        header["cal_max"] = 0
+
+        if path.endswith(".gz"):
+            fd, self._tmp = tempfile.mkstemp(prefix="niak_vol_", suffix=".nii", dir=scratch_dir())
+            os.close(fd)
+        else:
+            self._tmp = None
+        self._target = self._tmp or path
+
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(self._target, "wb") as fp:
+            header.write_to(fp)
+            fp.write(b"\0" * (NIFTI_OFFSET - fp.tell()))
+            fp.truncate(NIFTI_OFFSET + nbytes)
+        self.data = np.memmap(self._target, dtype=header.get_data_dtype(), mode="r+",
+                              offset=NIFTI_OFFSET, shape=shape, order="F")
+
+    def write_block(self, z_slice, values):
+        self.data[:, :, z_slice] = values
+
+    def close(self):
+        if self.data is None:
+            return
+        self.data.flush()
+        self.data = None
+        if self._tmp is not None:
+            with open(self._tmp, "rb") as fp, gzip.open(self.path, "wb", compresslevel=6) as out:
+                shutil.copyfileobj(fp, out, 16 * 1024 ** 2)
+            os.remove(self._tmp)
+            self._tmp = None
+
+    def discard(self):
+        """
+        Remove a partially written output
+        """
+        self.data = None
+        for f in [self._tmp, self.path]:
+            if f is not None and os.path.exists(f):
+                os.remove(f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
+
+
+def read_shape(path):
+    """
+    :return: the shape of a volume, read from its header only
+    """
+    require(nibabel_loaded, "nibabel")
+    return tuple(nibabel.load(path).shape)
+
+
+def write_vol(path, like, values, dtype=np.float32):
+    """
+    Write a whole (small) volume at once, like niak_write_vol
+    """
+    with OutputVolume(path, like, shape=values.shape, dtype=dtype) as out:
+        out.data[...] = values
+
+
+def slabs(shape, bytes_per_voxel, max_bytes=BLOCK_BYTES):
+    """
+    Cut a volume in slabs of whole slices along z
+    :param shape: the shape of the volume (x, y, z, ...)
+    :param bytes_per_voxel: memory used for one voxel of the block, all
+        time points and all copies included
+    :return: a list of slices along the third dimension
+    """
+    slice_bytes = shape[0] * shape[1] * bytes_per_voxel
+    step = max(1, int(max_bytes // max(slice_bytes, 1)))
+    return [slice(z, min(z + step, shape[2])) for z in range(0, shape[2], step)]
+
+
+def load_mat(path):
+    """
+    Load a .mat file saved by octave or matlab, in the binary format or in
+    the octave text format
+    :return: a dictionary of numpy arrays
+    """
+    if scipy_loaded:
+        try:
+            return {k: v for k, v in scipy.io.loadmat(path).items() if not k.startswith("__")}
+        except (ValueError, TypeError, NotImplementedError):
+            pass
+    return load_octave_text(path)
+
+
+def load_octave_text(path):
+    """
+    Read the numeric variables of a file saved in the octave text format
+    """
+    variables = {}
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as fp:
+        lines = fp.read().splitlines()
+    i = 0
+    while i < len(lines):
+        if not lines[i].startswith("# name:"):
+            i += 1
+            continue
+        name = lines[i].split(":", 1)[1].strip()
+        kind = lines[i + 1].split(":", 1)[1].strip()
+        i += 2
+        if kind in ["scalar", "bool"]:
+            variables[name] = np.array([[float(lines[i])]])
+            i += 1
+        elif kind in ["matrix", "bool matrix"]:
+            if lines[i].startswith("# ndims:"):
+                dims = [int(d) for d in lines[i + 1].split()]
+                values = []
+                i += 2
+                while i < len(lines) and lines[i].strip() and not lines[i].startswith("#"):
+                    values.append(float(lines[i]))
+                    i += 1
+                variables[name] = np.array(values).reshape(dims, order="F")
+            else:
+                rows = int(lines[i].split(":", 1)[1])
+                cols = int(lines[i + 1].split(":", 1)[1])
+                i += 2
+                data = [[float(v) for v in lines[i + r].split()] for r in range(rows)]
+                variables[name] = np.array(data).reshape(rows, cols)
+                i += rows
+        else:
+            raise ValueError("{0}: variable {1} of type {2} is not supported".format(path, name, kind))
+    return variables
+
+
+def save_mat(path, variables):
+    require(scipy_loaded, "scipy")
+    scipy.io.savemat(path, variables, oned_as="column")
+
+
+def read_csv(path):
+    """
+    Read a csv or tsv file like niak_read_csv_cell followed by str2double
+    :return: the labels of the first row, and the values as a float array
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    separator = "\t" if ".tsv" in os.path.basename(path) else ","
+    with opener(path, "rt") as fp:
+        rows = [line.rstrip("\n").split(separator) for line in fp if line.strip()]
+    labels = [l.strip() for l in rows[0]]
+    values = np.array([[float(v) if v.strip() else np.nan for v in row] for row in rows[1:]])
+    return labels, values.reshape(len(rows) - 1, len(labels))
+
+
+def format_csv_value(v):
+    if np.isnan(v):
+        return "NaN"
+    if np.isinf(v):
+        return "Inf" if v > 0 else "-Inf"
+    if v == round(v):
+        return "{0:d}".format(int(v))
+    return "{0:1.15f}".format(v)
+
+
+def write_csv(path, labels, values):
+    """
+    Write a table like niak_write_csv_cell, tab separated for .tsv files and
+    gzipped for .gz files
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    separator = "\t" if ".tsv" in os.path.basename(path) else ","
+    with opener(path, "wt") as fp:
+        fp.write(separator.join(labels) + "\n")
+        for row in values:
+            fp.write(separator.join(format_csv_value(v) for v in row) + "\n")